@@ -1,6 +1,11 @@
-from flask import Flask, request, make_response, jsonify
-import logging, sys, os, requests, json
+from flask import Flask, request, make_response, jsonify, Response, stream_with_context
+import logging, sys, os, requests, json, re, calendar, time, uuid, threading
 from requests.exceptions import HTTPError
+from requests.adapters import HTTPAdapter
+from confluent_kafka import Producer, Consumer, TopicPartition
+from confluent_kafka.admin import AdminClient, NewTopic
+from prometheus_client import Counter, Gauge, Histogram
+from service_metrics import instrument, debugSample
 
 #CONFIGURATION
 DB_MANAGER_PORT= os.environ["DB_MANAGER_PORT"]
@@ -18,8 +23,149 @@ KAFKA_STATIC_URL = KAFKA_ADDRESS_STATIC+":"+KAFKA_PORT_STATIC
 TOPIC_MANAGER_PORT= os.environ["TOPIC_MANAGER_PORT"]
 TOPIC_MANAGER_URL = "http://topicmanager:"+TOPIC_MANAGER_PORT
 
+KAFKA_INTERNAL_PORT= os.environ["KAFKA_INTERNAL_PORT"]
+KAFKA_INTERNAL_URL = "kafka:"+KAFKA_INTERNAL_PORT
+
+#LOGGING CONFIGURATION
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+
+#PROXY CONFIGURATION
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "32")) #MAX KEEP-ALIVE CONNECTIONS TO EACH INTERNAL SERVICE
+PROXY_CHUNK_SIZE = 64 * 1024 #BYTES READ FROM THE INTERNAL SERVICE BEFORE FORWARDING THEM
+#HEADERS VALID ONLY FOR A SINGLE CONNECTION, THEY ARE NOT FORWARDED
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailer", "trailers", "transfer-encoding", "upgrade"}
+#HEADERS OF THE REQUEST FORWARDED TO THE INTERNAL SERVICE, THEY SELECT THE FORMAT AND THE COMPRESSION OF THE RESPONSE
+NEGOTIATION_HEADERS = ["Accept", "Accept-Encoding"]
+
+#TOPICS CACHE CONFIGURATION
+TOPICS_CACHE_TTL = float(os.environ.get("TOPICS_CACHE_TTL", "1")) #SECONDS THE TOPICS ARE USED BEFORE ASKING THE TOPIC MANAGER IF THEY CHANGED
+
+#REPLAY CONFIGURATION
+REPLAY_TOPIC_PREFIX = "_replay_" #THE TOPICS STARTING WITH AN UNDERSCORE ARE NOT STORED BY THE DATA PUMP
+REPLAY_TOPIC_PATTERN = re.compile(r'^_replay_(\d+)_[0-9a-f]+$') #THE NAME OF A REPLAY TOPIC HAS ITS CREATION TIME (IN SECONDS)
+REPLAY_TTL = int(os.environ.get("REPLAY_TTL", "24")) * 3600 #SECONDS A REPLAY TOPIC IS KEPT IN KAFKA
+REPLAY_END_HEADER = "oda-replay-end" #HEADER OF THE LAST MSG OF A REPLAY, ITS VALUE IS THE NUMBER OF RECORDS REPLAYED
+REPLAY_ERROR_HEADER = "oda-replay-error" #HEADER OF THE LAST MSG OF A REPLAY STOPPED BY AN ERROR
+KAFKA_TIMEOUT = 10 #SECONDS
+KAFKA_POLL_INTERVAL = 0.05 #SECONDS BETWEEN THE CHECKS OF THE PENDING KAFKA OPERATIONS, WITHOUT BLOCKING THE OTHER REQUESTS
+TIMESTAMP_PATTERN = re.compile(r'^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(?:\.(\d{1,9}))?Z$')
+
 app = Flask(__name__)
-logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+logging.basicConfig(stream=sys.stdout, level=LOG_LEVEL)
+
+#METRICS
+REQUEST_SECONDS = Histogram("apigateway_request_seconds", "Time to answer a request (to the first chunk of a proxied response)", ["endpoint", "status"])
+UPSTREAM_SECONDS = Histogram("apigateway_upstream_seconds", "Time to the response headers of an internal service", ["service", "status"])
+ERRORS = Counter("apigateway_errors", "Failed requests and background tasks", ["kind"])
+TOPICS_LOOKUPS = Counter("apigateway_topics_cache_lookups", "Reads of the cached topics", ["result"])
+TOPICS_REFRESHES = Counter("apigateway_topics_cache_refreshes", "Requests of the topics to the topic manager", ["result"])
+REGISTRATIONS = Counter("apigateway_registrations", "Registrations of data generators", ["path"])
+REPLAYS = Counter("apigateway_replays", "Ended replays", ["result"])
+REPLAYS_RUNNING = Gauge("apigateway_replays_running", "Replays writing records to Kafka", multiprocess_mode="livesum")
+REPLAYED_RECORDS = Counter("apigateway_replayed_records", "Records written to the replay topics")
+instrument(app, REQUEST_SECONDS)
+
+#SHARED SESSION REUSING THE CONNECTIONS TO THE INTERNAL SERVICES
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE))
+
+#TOPICS KNOWN BY THE TOPIC MANAGER
+'''
+The topics are read again from the topic manager after TOPICS_CACHE_TTL seconds, sending the ETag of the last response:
+the topic manager answers 304 if they did not change. While a request reads them, the other requests use the previous ones.
+'''
+class TopicsCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.topics = None
+        self.known = set()
+        self.etag = None
+        self.checked = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        if self.topics is not None and time.monotonic() - self.checked < self.ttl:
+            TOPICS_LOOKUPS.labels("hit").inc()
+            return self.topics
+        if not self.lock.acquire(blocking=self.topics is None):
+            TOPICS_LOOKUPS.labels("stale").inc()
+            return self.topics
+        TOPICS_LOOKUPS.labels("refresh").inc()
+        try:
+            if self.topics is None or time.monotonic() - self.checked >= self.ttl:
+                try:
+                    self.refresh()
+                except Exception as e:
+                    TOPICS_REFRESHES.labels("error").inc()
+                    # The previous topics are still valid, the registered topics are never removed
+                    if self.topics is None:
+                        raise
+                    app.logger.error(f"Using the previous topics: {repr(e)}")
+            return self.topics
+        finally:
+            self.lock.release()
+
+    def refresh(self):
+        URL = TOPIC_MANAGER_URL + '/topics'
+        app.logger.debug(f"Asking for topics to {URL}")
+        x = upstream("topicmanager", "GET", URL, headers={"If-None-Match": self.etag} if self.etag else None)
+        if x.status_code == 304:
+            TOPICS_REFRESHES.labels("not_modified").inc()
+        else:
+            x.raise_for_status()
+            self.topics = x.json()["topics"]
+            self.known = set(self.topics)
+            self.etag = x.headers.get("ETag")
+            TOPICS_REFRESHES.labels("changed").inc()
+            app.logger.debug(f"Topics received: {len(self.topics)} topics")
+        self.checked = time.monotonic()
+
+    #Returns True if all the topics are known to be registered
+    def registered(self, names):
+        self.get()
+        return all(name in self.known for name in names)
+
+    def invalidate(self):
+        self.checked = 0
+
+topics_cache = TopicsCache(TOPICS_CACHE_TTL)
+
+#KAFKA CLIENTS USED BY THE REPLAYS
+admin = AdminClient({'bootstrap.servers': KAFKA_INTERNAL_URL})
+producer = Producer({
+    'bootstrap.servers': KAFKA_INTERNAL_URL,
+    'enable.idempotence': True, #THE RECORDS ARE WRITTEN ONCE AND IN ORDER, ALSO WHEN A BATCH IS SENT AGAIN
+    'linger.ms': 50,
+    'compression.type': 'lz4'
+})
+consumer = Consumer({
+    'bootstrap.servers': KAFKA_INTERNAL_URL,
+    'group.id': 'apigateway', #ONLY USED TO READ THE OFFSETS, IT NEVER SUBSCRIBES OR COMMITS
+    'enable.auto.commit': False
+})
+
+#Sends a request to an internal service through the shared session, observing the time to its response headers
+def upstream(service, method, URL, **kwargs):
+    try:
+        x = session.request(method, URL, **kwargs)
+    except Exception:
+        ERRORS.labels("upstream_" + service).inc()
+        raise
+    UPSTREAM_SECONDS.labels(service, x.status_code).observe(x.elapsed.total_seconds())
+    return x
+
+#Returns the headers of the response of an internal service that can be forwarded
+def forwardedHeaders(x):
+    hop_by_hop = HOP_BY_HOP_HEADERS | {h.strip().lower() for h in x.headers.get("Connection", "").split(",")}
+    return [(k, v) for k, v in x.headers.items() if k.lower() not in hop_by_hop]
+
+#Forwards the body of the response of an internal service chunk by chunk, as it is received (still compressed)
+def streamBody(x):
+    try:
+        for chunk in x.raw.stream(PROXY_CHUNK_SIZE, decode_content=False):
+            yield chunk
+    finally:
+        x.close()
 
 
 #QUERY DB SERVICE
@@ -29,8 +175,15 @@ The payload for a query must be a JSON having at least one of the following fiel
 "stop": string formatted in ISO 8601 YYYY:MM:DDTHH:MM:SSZ
 "topic": string
 "generator_id": string
+"limit": int (optional, max number of records in the response)
+"order": "asc" (default) | "desc" (optional)
+"cursor": string (optional, the X-Next-Cursor header of the previous page)
+"format": "json" (default) | "ndjson" | "arrow" | "parquet" (optional, or else selected by the Accept header)
+"compression": "gzip" (default) | "zstd" (optional, or else selected by the Accept-Encoding header)
 
-The response is an unsorted JSON array with all the records that match the query.
+The response is a JSON array with all the records that match the query, sorted by timestamp.
+With a limit, the header X-Next-Cursor of the response (forwarded from the Database Manager) is the cursor
+of the next page, missing on the last page.
 Each record has the following structure:
 {
     "timestamp": string formatted in ISO 8601 YYYY:MM:DDTHH:MM:SSZ,
@@ -42,26 +195,26 @@ Each record has the following structure:
 def query():
     try:
         msg = request.get_json()
-        app.logger.info(f"Received query: {msg}")
         if not msg:
             return make_response("Empty query", 404)
         if "aggregator" in msg:
+            service = "queryaggregator"
             URL = QUERY_AGGREGATOR_URL + '/query'
         else:
+            service = "dbmanager"
             URL= DB_MANAGER_URL + '/query'
-        app.logger.info(f"Sending query to {URL}")
-        app.logger.info(f"Query: {msg}")
-        x = requests.post(URL, json=msg, stream=True)
+        debugSample("Sending query to %s: %s", URL, msg)
+        headers = {h: request.headers[h] for h in NEGOTIATION_HEADERS if h in request.headers}
+        x = upstream(service, "POST", URL, json=msg, headers=headers, stream=True)
         x.raise_for_status()
-        logging.info("Query sent")
-        resp = make_response(x.raw.read(), x.status_code, x.headers.items())
-        return resp
+        return Response(stream_with_context(streamBody(x)), status=x.status_code, headers=forwardedHeaders(x))
         
         #return make_response(x.json(), 200)
     except HTTPError as e:
         app.logger.error(f'HTTP error occurred: {e.response.url} - {e.response.status_code} - {e.response.text}')
         return make_response(e.response.text, e.response.status_code)
     except Exception as e:
+        ERRORS.labels("query").inc()
         app.logger.error(repr(e))
         return make_response(repr(e), 500)
     
@@ -70,22 +223,20 @@ def register_dc():
     try:
         static_param = request.args.get('static', default=None, type=str)
         static_param = static_param.lower() == 'true' if static_param else False
-        URL= TOPIC_MANAGER_URL + '/topics'
-        app.logger.info(f"Asking for topics to {URL}")
-        x = requests.get(URL)
-        x.raise_for_status()
-        app.logger.info(f"Topics received: {x.content.decode('utf-8')}")
-        resp = {}
-        resp = json.loads(x.content.decode('utf-8'))
+        resp = {"topics": topics_cache.get()}
         if static_param:
             resp["KAFKA_ENDPOINT"]=KAFKA_STATIC_URL
         else:
             resp["KAFKA_ENDPOINT"]=KAFKA_URL
-        return make_response(json.dumps(resp), 200)
+        # A consumer asking again with the ETag of its last response receives 304 if the topics did not change
+        response = make_response(json.dumps(resp), 200)
+        response.add_etag()
+        return response.make_conditional(request)
     except HTTPError as e:
         app.logger.error(f'HTTP error occurred: {e.response.url} - {e.response.status_code} - {e.response.text}')
         return make_response(e.response.text, e.response.status_code)
     except Exception as e:
+        ERRORS.labels("register").inc()
         app.logger.error(repr(e))
         return make_response(repr(e), 500)
 @app.route("/register/dg", methods=["POST"]) 
@@ -96,12 +247,17 @@ def register_dg():
         msg = request.get_json()
         if not msg:
             return make_response("Empty Registration", 400)
-        URL= TOPIC_MANAGER_URL + '/register'
-        app.logger.info(f"Sending registration to {URL}")
-        app.logger.info(f"Registration topics: {msg}")
-        x = requests.post(URL, json=msg)
-        x.raise_for_status()
-        logging.info("Registration sent to K Admin")
+        # A generator registering again the same topics, without asking for partitions, does not need the topic manager
+        topics = msg.get("topics")
+        if not (isinstance(topics, list) and topics and "partitions" not in msg and all(isinstance(t, str) for t in topics) and topics_cache.registered(topics)):
+            URL= TOPIC_MANAGER_URL + '/register'
+            debugSample("Sending registration to %s: %s", URL, msg)
+            x = upstream("topicmanager", "POST", URL, json=msg)
+            x.raise_for_status()
+            topics_cache.invalidate()
+            REGISTRATIONS.labels("forwarded").inc()
+        else:
+            REGISTRATIONS.labels("cached").inc()
         if static_param:
             URL_TO_SEND=KAFKA_STATIC_URL
         else:
@@ -111,5 +267,174 @@ def register_dg():
         app.logger.error(f'HTTP error occurred: {e.response.url} - {e.response.status_code} - {e.response.text}')
         return make_response(e.response.text, e.response.status_code)
     except Exception as e:
+        ERRORS.labels("register").inc()
+        app.logger.error(repr(e))
+        return make_response(repr(e), 500)
+
+#REPLAY SERVICE
+'''
+Replays the records stored in ODA into a new Kafka topic, so that large backfills are read with a Kafka client
+instead of a single HTTP response. The payload is the same of /query, without the aggregator.
+Without "stop" the replay stops at the time of the request.
+
+The response (status code 202) is sent as soon as the topic is created, while the records are written to it:
+{
+    "topic": string, the name of the replay topic (with a single partition, the records are sorted by timestamp),
+    "KAFKA_ENDPOINT": string,
+    "start": string, "stop": string,
+    "offsets": [{"partition": int, "offset": int}] (only with "topic"), the offsets of the first msgs of the topic
+               with a Kafka time after stop, to consume the live data after the replay
+}
+The last msg of the replay topic has an empty value and the header oda-replay-end with the number of records
+replayed (and the header oda-replay-error if the replay was stopped by an error).
+The offsets are found by the Kafka time of the msgs: the time they were received by Kafka for the topics registered
+in ODA, the time set by the producer for the other topics. It can differ from the timestamp of the records:
+a consumer joining the replay with the live data may receive a few records twice.
+A replay topic is deleted after REPLAY_TTL seconds.
+'''
+@app.route("/replay", methods=["POST"])
+def replay():
+    try:
+        static_param = request.args.get('static', default=None, type=str)
+        static_param = static_param.lower() == 'true' if static_param else False
+        msg = request.get_json()
+        if not msg:
+            return make_response("Empty query", 400)
+        if "aggregator" in msg:
+            return make_response("Aggregated queries cannot be replayed", 400)
+        if not msg.get("stop"):
+            msg["stop"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        stop_ms = timestampMillis(msg["stop"])
+        offsets = liveOffsets(msg["topic"], stop_ms) if msg.get("topic") else None
+
+        deleteExpiredReplays()
+        topic = f"{REPLAY_TOPIC_PREFIX}{int(time.time())}_{uuid.uuid4().hex[:12]}"
+        waitFutures(admin.create_topics([NewTopic(topic, num_partitions=1, config={"retention.ms": str(REPLAY_TTL * 1000)})]))
+        app.logger.info(f"Replaying into {topic}")
+        debugSample("Replay query of %s: %s", topic, msg)
+        threading.Thread(target=replayRecords, args=(topic, msg), daemon=True).start()
+
+        resp = {"topic": topic, "KAFKA_ENDPOINT": KAFKA_STATIC_URL if static_param else KAFKA_URL, "start": msg.get("start"), "stop": msg["stop"]}
+        if offsets is not None:
+            resp["offsets"] = offsets
+        return make_response(jsonify(resp), 202)
+    except KeyError:
+        return make_response(f"Unknown topic: {msg.get('topic')}", 404)
+    except ValueError as e:
+        return make_response(str(e), 400)
+    except Exception as e:
+        ERRORS.labels("replay").inc()
+        app.logger.error(repr(e))
+        return make_response(repr(e), 500)
+
+#KAFKA OFFSETS SERVICE
+'''
+The payload must be a JSON {"topic": string, "timestamp": string formatted in ISO 8601 YYYY:MM:DDTHH:MM:SSZ}.
+The response has the offsets of the first msgs with a Kafka time at or after the timestamp (the time they were received
+by Kafka for the topics registered in ODA), for each partition of the topic (the end of the partition if there are none):
+{
+    "topic": string,
+    "offsets": [{"partition": int, "offset": int}]
+}
+'''
+@app.route("/offsets", methods=["POST"])
+def offsets():
+    try:
+        msg = request.get_json()
+        if not msg or not msg.get("topic") or not msg.get("timestamp"):
+            return make_response("The query must have a topic and a timestamp", 400)
+        return make_response(jsonify(topic=msg["topic"], offsets=liveOffsets(msg["topic"], timestampMillis(msg["timestamp"]))), 200)
+    except KeyError:
+        return make_response(f"Unknown topic: {msg.get('topic')}", 404)
+    except ValueError as e:
+        return make_response(str(e), 400)
+    except Exception as e:
+        ERRORS.labels("offsets").inc()
         app.logger.error(repr(e))
-        return make_response(repr(e), 500)
\ No newline at end of file
+        return make_response(repr(e), 500)
+
+#Parses a timestamp YYYY-MM-DDTHH:MM:SS[.fraction]Z, returns the milliseconds since epoch
+def timestampMillis(timestamp):
+    match = TIMESTAMP_PATTERN.match(timestamp)
+    if not match:
+        raise ValueError(f"Invalid timestamp: {timestamp}")
+    seconds = calendar.timegm(time.strptime(match.group(1), "%Y-%m-%dT%H:%M:%S"))
+    return seconds * 1000 + int((match.group(2) or "").ljust(3, "0")[:3])
+
+#Returns the offsets of the first msgs of each partition of a topic with a Kafka time at or after a time
+def liveOffsets(topic, time_ms):
+    metadata = consumer.list_topics(topic, timeout=KAFKA_TIMEOUT).topics[topic]
+    if metadata.error is not None:
+        raise KeyError(topic)
+    partitions = [TopicPartition(topic, p, time_ms) for p in sorted(metadata.partitions)]
+    offsets = []
+    for tp in consumer.offsets_for_times(partitions, timeout=KAFKA_TIMEOUT):
+        offset = tp.offset
+        if offset < 0:
+            # No msgs after the time, the live data starts at the end of the partition
+            offset = consumer.get_watermark_offsets(TopicPartition(topic, tp.partition), timeout=KAFKA_TIMEOUT)[1]
+        offsets.append({"partition": tp.partition, "offset": offset})
+    return offsets
+
+#Waits for the results of the futures of the Kafka admin client, raising their errors
+def waitFutures(futures):
+    deadline = time.monotonic() + KAFKA_TIMEOUT
+    for future in futures.values():
+        while not future.done():
+            if time.monotonic() > deadline:
+                raise TimeoutError("Kafka did not answer")
+            time.sleep(KAFKA_POLL_INTERVAL)
+        future.result()
+
+#Deletes the replay topics older than REPLAY_TTL
+def deleteExpiredReplays():
+    expired = []
+    for topic in admin.list_topics(timeout=KAFKA_TIMEOUT).topics:
+        match = REPLAY_TOPIC_PATTERN.match(topic)
+        if match and int(match.group(1)) + REPLAY_TTL < time.time():
+            expired.append(topic)
+    if expired:
+        app.logger.info(f"Deleting expired replay topics: {expired}")
+        admin.delete_topics(expired)
+
+#Reads the records of the query from the DB Manager and writes them to the replay topic, then writes the end msg
+def replayRecords(topic, msg):
+    count = 0
+    headers = []
+    REPLAYS_RUNNING.inc()
+    try:
+        with upstream("dbmanager", "POST", DB_MANAGER_URL + '/query', json=dict(msg, stream=True, format="ndjson", compression="gzip"), stream=True) as x:
+            if x.status_code != 404:
+                x.raise_for_status()
+                for line in x.iter_lines(chunk_size=PROXY_CHUNK_SIZE):
+                    if line:
+                        produce(topic, line)
+                        count += 1
+    except Exception as e:
+        ERRORS.labels("replay").inc()
+        app.logger.error(f"Replay into {topic} stopped after {count} records: {repr(e)}")
+        headers.append((REPLAY_ERROR_HEADER, repr(e)))
+    headers.append((REPLAY_END_HEADER, str(count)))
+    produce(topic, b'', headers)
+    while producer.flush(0):
+        time.sleep(KAFKA_POLL_INTERVAL)
+    REPLAYS_RUNNING.dec()
+    REPLAYED_RECORDS.inc(count)
+    REPLAYS.labels("failed" if len(headers) > 1 else "completed").inc()
+    app.logger.info(f"Replayed {count} records into {topic}")
+
+#Writes a msg to Kafka, waiting while the queue of the producer is full
+def produce(topic, value, headers=None):
+    while True:
+        try:
+            producer.produce(topic, value, headers=headers, on_delivery=onDelivery)
+            break
+        except BufferError:
+            producer.poll(0)
+            time.sleep(KAFKA_POLL_INTERVAL)
+    producer.poll(0)
+
+def onDelivery(err, msg):
+    if err is not None:
+        ERRORS.labels("replay_delivery").inc()
+        app.logger.error(f"Replay msg not delivered to {msg.topic()}: {err}")
@@ -0,0 +1,12 @@
+from gunicorn_base import *
+
+#GUNICORN CONFIGURATION OF THE API GATEWAY
+'''
+Every worker has its own HTTP session, topics cache and Kafka clients, whose librdkafka threads would not survive a fork.
+Most of the threads wait for the internal services, so a worker runs more threads than the default.
+'''
+bind = env("SERVER_PORT", "0.0.0.0:50005")
+workers = env("GUNICORN_WORKERS", 2)
+threads = env("GUNICORN_THREADS", 32)
+
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus_apigateway")
@@ -0,0 +1,43 @@
+import os, shutil
+
+#GUNICORN CONFIGURATION SHARED BY THE SERVICES
+'''
+The gunicorn.conf.py of each service imports these settings and overrides the ones with a different default.
+Each setting reads its GUNICORN_* environment variable, e.g. GUNICORN_WORKERS for workers.
+
+Each worker imports the service after the fork (preload_app is False), so every worker has its own clients
+(InfluxDB, Kafka, HTTP sessions) and no connection or background thread is shared with the master process.
+The gthread workers run each request in its own thread, so a request waiting for another service, or running
+a CPU-heavy computation, does not block the other requests of the worker.
+
+SIGHUP reloads the configuration and replaces the workers gracefully: new workers are started, the old ones stop
+accepting requests and have graceful_timeout seconds to end them.
+'''
+#Reads a setting from the environment, converted to the type of its default
+def env(name, default):
+    return type(default)(os.environ.get(name, default))
+
+bind = env("SERVER_PORT", "0.0.0.0:8000")
+worker_class = "gthread"
+workers = env("GUNICORN_WORKERS", 2)
+threads = env("GUNICORN_THREADS", 8) #CONCURRENT REQUESTS OF EACH WORKER
+keepalive = env("GUNICORN_KEEPALIVE", 5) #SECONDS AN IDLE CONNECTION IS KEPT OPEN
+timeout = env("GUNICORN_TIMEOUT", 120) #SECONDS A WORKER CAN BE UNRESPONSIVE BEFORE BEING RESTARTED
+graceful_timeout = env("GUNICORN_GRACEFUL_TIMEOUT", 30) #SECONDS A STOPPING WORKER HAS TO END ITS REQUESTS
+max_requests = env("GUNICORN_MAX_REQUESTS", 0) #REQUESTS SERVED BY A WORKER BEFORE IT IS REPLACED (0: NEVER)
+max_requests_jitter = max_requests // 10 #THE WORKERS ARE NOT REPLACED ALL AT ONCE
+preload_app = False
+
+#PROMETHEUS METRICS OF THE WORKERS
+'''
+Each worker writes its metrics to the files in PROMETHEUS_MULTIPROC_DIR (set by the gunicorn.conf.py of the service),
+so that /metrics reports the metrics of all the workers whichever worker serves it. The directory is emptied when
+gunicorn starts (not on SIGHUP), and the gauges of a worker are dropped when it exits.
+'''
+def on_starting(server):
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
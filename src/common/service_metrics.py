@@ -0,0 +1,35 @@
+from flask import Response, request, g, current_app
+from prometheus_client import CollectorRegistry, REGISTRY, generate_latest, multiprocess, CONTENT_TYPE_LATEST
+import logging, os, random, time
+
+#METRICS AND SAMPLED LOGS SHARED BY THE SERVICES
+'''
+The metrics are exposed in the Prometheus text format at /metrics. Under gunicorn each worker writes its metrics
+to the files in PROMETHEUS_MULTIPROC_DIR (see gunicorn_base.py) and /metrics merges the metrics of all the workers.
+'''
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "0.01")) #FRACTION OF THE REQUESTS WHOSE PARAMETERS ARE LOGGED AT DEBUG LEVEL
+
+#Adds /metrics to the app and observes the time to answer each request in request_seconds (labels endpoint and status)
+def instrument(app, request_seconds):
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        registry = REGISTRY
+        if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+    @app.before_request
+    def beginRequest():
+        g.start = time.perf_counter()
+        g.log_sample = random.random() < LOG_SAMPLE_RATE
+
+    @app.after_request
+    def endRequest(response):
+        request_seconds.labels(request.endpoint or "unknown", response.status_code).observe(time.perf_counter() - g.start)
+        return response
+
+#Logs a debug message only for the sampled requests, so that the parameters of the requests are logged without slowing down every request
+def debugSample(message, *args):
+    if g.get("log_sample") and current_app.logger.isEnabledFor(logging.DEBUG):
+        current_app.logger.debug(message, *args)
@@ -1,8 +1,8 @@
-from confluent_kafka import Consumer
-from confluent_kafka.admin import AdminClient
-import json, signal, requests, logging, sys, os, concurrent.futures, asyncio
+from confluent_kafka import Consumer, TopicPartition
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+import json, signal, httpx, logging, sys, os, asyncio, time, collections, threading, socket
 
-logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+logging.basicConfig(stream=sys.stdout, level=os.environ.get("LOG_LEVEL", "INFO").upper())
 
 #OTHER SERVICES CONFIGURATION
 KAFKA_PORT= os.environ["KAFKA_INTERNAL_PORT"]
@@ -10,24 +10,78 @@ DB_MANAGER_PORT= os.environ["DB_MANAGER_PORT"]
 DB_SERVICE_URL = "http://dbmanager:"+DB_MANAGER_PORT
 KAFKA_SERVICE_URL = "kafka:"+KAFKA_PORT
 
+#NAME OF THIS REPLICA, STABLE ACROSS RESTARTS
+#Docker resolves the address of the container to its name (e.g. oda-datapump-2), the hostname is used if it cannot
+def instanceName():
+    name = os.environ.get("DATA_PUMP_INSTANCE_ID")
+    if name:
+        return name
+    try:
+        return socket.gethostbyaddr(socket.gethostbyname(socket.gethostname()))[0].split('.')[0]
+    except Exception:
+        return socket.gethostname()
+
 #CONSUMER CONFIGURATION
-GROUP_INSTANCE_ID = 'dataservicegroup' #EACH CONSUMER MUST HAVE A UNIQUE GROUP INSTANCE ID TO BE REMBERED BY KAFKA
+GROUP_INSTANCE_ID = 'dataservicegroup-' + instanceName() #EACH CONSUMER MUST HAVE A UNIQUE GROUP INSTANCE ID TO BE REMBERED BY KAFKA
 CLIENT_ID = 'dataservice'
-GROUP_ID = 'dataservicegroupid' #TO RECEIVE ALL THE MESSAGE IT MUST BE ALONE IN THE GROUP
+GROUP_ID = 'dataservicegroupid' #ALL THE REPLICAS OF THE DATA PUMP SHARE THE GROUP, EACH PARTITION IS CONSUMED BY ONE OF THEM
+PARTITION_ASSIGNMENT_STRATEGY = 'cooperative-sticky' #A REPLICA JOINING OR LEAVING MOVES ONLY THE PARTITIONS IT GAINS OR LOSES
 AUTO_OFFSET_RESET = 'earliest' #TO RECEIVE ALL THE MESSAGE STORED IN KAFKA
 AUTO_COMMIT_INTERVAL_MS = '250' #COMMIT OFFSET INTERVAL (IN MILLISECONDS)
 
 #POLLING TIMEOUT
 _TIMEOUT = 0.5 #SECONDS
-#SUBSCRIPTION TO ALL TOPICS TIMEOUT
-_SUBSCRIBE_TIMEOUT = 60
+#SUBSCRIPTION TO ALL TOPICS
+TOPIC_PATTERN = '^[^_].*' #A REGEX SUBSCRIPTION INCLUDES THE NEW TOPICS WITHOUT SUBSCRIBING AGAIN
+METADATA_REFRESH_INTERVAL_MS = '1000' #MAX TIME BEFORE A NEW TOPIC IS CONSUMED (IN MILLISECONDS)
+
+#BATCHING CONFIGURATION
+BATCH_MODE = os.environ.get("BATCH_MODE", "true").lower() == "true" #SEND MSGS TO THE DB SERVICE IN BATCHES INSTEAD OF ONE BY ONE
+BATCH_SIZE = int(os.environ.get("BATCH_SIZE", "500")) #MAX NUMBER OF MSGS IN A BATCH
+BATCH_MAX_BYTES = int(os.environ.get("BATCH_MAX_BYTES", "1048576")) #MAX SIZE OF THE PAYLOADS IN A BATCH (IN BYTES)
+BATCH_TIMEOUT = float(os.environ.get("BATCH_TIMEOUT", "1")) #MAX TIME A MSG WAITS IN A BATCH BEFORE BEING SENT (IN SECONDS)
+
+#DELIVERY CONFIGURATION
+HTTP_CONCURRENCY = int(os.environ.get("HTTP_CONCURRENCY", "8")) #MAX NUMBER OF CONCURRENT REQUESTS (AND KEEP-ALIVE CONNECTIONS) TO THE DB SERVICE
+HTTP_TIMEOUT = 30 #(IN SECONDS)
+MAX_IN_FLIGHT = int(os.environ.get("MAX_IN_FLIGHT", "64")) #MAX NUMBER OF MSGS (OR BATCHES) WAITING FOR THE DB SERVICE BEFORE PAUSING THE CONSUMPTION
+
+#COMMIT CONFIGURATION (MANUAL COMMIT REQUIRES BATCH MODE)
+MANUAL_COMMIT = BATCH_MODE and os.environ.get("MANUAL_COMMIT", "false").lower() == "true" #COMMIT OFFSETS ONLY AFTER THE DB SERVICE HAS WRITTEN THE MSGS
+RETRY_INTERVAL = 1 #FIRST DELAY BEFORE SENDING AGAIN A FAILED BATCH (IN SECONDS)
+MAX_RETRY_INTERVAL = 30 #(IN SECONDS)
+DEAD_LETTER_DIR = os.environ.get("DEAD_LETTER_DIR", "/app/deadletter") #DIRECTORY OF THE FILES WITH THE BATCHES REFUSED BY THE DB SERVICE ("" TO ONLY LOG THEM)
+
+#METRICS CONFIGURATION
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9100")) #PORT OF THE HTTP SERVER EXPOSING THE METRICS AT /metrics
+LAG_INTERVAL = 5 #SECONDS BETWEEN THE UPDATES OF THE CONSUMER LAG
+
+#METRICS
+'''
+The metrics are exposed in the Prometheus text format at http://<replica>:METRICS_PORT/metrics, each replica of the data pump has its own.
+'''
+MSGS_CONSUMED = Counter("datapump_messages_consumed", "Msgs read from Kafka", ["topic"])
+MSGS_WRITTEN = Counter("datapump_messages_written", "Msgs written by the DB service")
+MSGS_REJECTED = Counter("datapump_messages_rejected", "Msgs discarded because bad formatted or refused by the DB service")
+WRITE_SECONDS = Histogram("datapump_write_seconds", "Time of a request to the DB service", ["path", "status"])
+BATCH_MSGS = Histogram("datapump_batch_messages", "Msgs in a batch sent to the DB service", buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000))
+RETRIES = Counter("datapump_retries", "Batches sent again after a failed delivery")
+DEAD_LETTERS = Counter("datapump_dead_letter_messages", "Msgs of the batches moved to the dead letter file")
+ERRORS = Counter("datapump_errors", "Failed deliveries and Kafka errors", ["kind"])
+IN_FLIGHT = Gauge("datapump_in_flight", "Deliveries waiting for the DB service")
+PAUSES = Counter("datapump_pauses", "Times the consumption was paused by MAX_IN_FLIGHT")
+CONSUMER_LAG = Gauge("datapump_consumer_lag", "Msgs in Kafka after the position of the consumer", ["topic", "partition"])
 
 c= Consumer({
     'bootstrap.servers': KAFKA_SERVICE_URL,
-    'group.instance.id': GROUP_INSTANCE_ID, 
+    'group.instance.id': GROUP_INSTANCE_ID,
     'group.id': GROUP_ID,
+    'client.id': CLIENT_ID,
+    'partition.assignment.strategy': PARTITION_ASSIGNMENT_STRATEGY,
     'auto.offset.reset': AUTO_OFFSET_RESET,
-    'auto.commit.interval.ms': AUTO_COMMIT_INTERVAL_MS
+    'enable.auto.commit': not MANUAL_COMMIT,
+    'auto.commit.interval.ms': AUTO_COMMIT_INTERVAL_MS,
+    'topic.metadata.refresh.interval.ms': METADATA_REFRESH_INTERVAL_MS
 })
 
 
@@ -37,69 +91,390 @@ def handler(sig, frame):
     c.unsubscribe()
     c.close()
     exit(0)
-    
+
 signal.signal(signal.SIGINT, handler)
 
-#KAFKA ADMIN CLIENT TO RETRIEVE ALL THE TOPICS
-admin = AdminClient({'bootstrap.servers': KAFKA_SERVICE_URL})
+#KAFKA CONSUMER SUBSCRIBED TO ALL TOPICS THAT SENDS MESSAGES TO DB SERVICE
+'''
+The consumer subscribes once to all the topics matching TOPIC_PATTERN, which excludes the Kafka internal topics
+(e.g. __consumer_offsets) and any other topic starting with an underscore.
+Kafka checks for new matching topics every METADATA_REFRESH_INTERVAL_MS and assigns them to the group,
+the partitions of the topics already subscribed are not moved.
+'''
+def subscribeAll():
+    c.subscribe([TOPIC_PATTERN], on_revoke=onRevoke)
+    logging.info(f"Subscribed to {TOPIC_PATTERN}")
 
-#KAFKA CONSUMER TO SUBSCRIBE TO ALL TOPICS AND SEND MESSAGES TO DB SERVICE
+#POOLED HTTP CLIENT TO THE DB SERVICE, CREATED IN THE MAIN LOOP
+http = None
+#LIMITS THE NUMBER OF CONCURRENT REQUESTS TO THE DB SERVICE
+http_slots = None
+#DELIVERIES WAITING FOR THE DB SERVICE
+in_flight = set()
+#TASKS RUNNING IN THE BACKGROUND, THE EVENT LOOP KEEPS ONLY A WEAK REFERENCE TO A TASK
+background_tasks = set()
+#MSGS POLLED WHILE THE CONSUMPTION WAS PAUSED, FROM PARTITIONS ASSIGNED DURING THE PAUSE
+held_msgs = collections.deque()
+#TRUE WHILE ALL THE ASSIGNED PARTITIONS ARE PAUSED BY MAX_IN_FLIGHT
+consumption_paused = False
+#(TOPIC, PARTITION) -> NUMBER OF ITS BATCHES BEING SENT AGAIN, THE PARTITION STAYS PAUSED UNTIL THEY ARE WRITTEN
+retrying = collections.Counter()
+IN_FLIGHT.set_function(lambda: len(in_flight))
 
-#LIST OF TOPICS ALREADY SUBSCRIBED
-sub_topics = []
-#FUNCTION TO SUBSCRIBE TO ALL THE TOPICS (EXCEPT __consumer_offsets WHICH IS A KAFKA INTERNAL TOPIC)
-#ASYNCRONOUS RESPECT TO THE MAIN LOOP
-async def subscribeAll():
-    logging.info("Starting subscription routine...")
-    while True:
+#RAISED WHEN THE DB SERVICE REFUSES A WHOLE BATCH, SENDING IT AGAIN WOULD NOT HELP
+class BatchRejected(Exception):
+    pass
+#FUNCTION TO POST AN ALREADY ENCODED JSON BODY TO THE DB SERVICE
+#If sync is True, the DB service answers only after the msgs are written
+async def postToDB(path, body, sync=False):
+    async with http_slots:
+        start = time.perf_counter()
+        status = "error"
+        try:
+            x = await http.post(path, content=body, headers={'Content-Type': 'application/json'}, params={'sync': 'true'} if sync else None)
+            status = x.status_code
+            return x
+        finally:
+            WRITE_SECONDS.labels(path, status).observe(time.perf_counter() - start)
+#FUNCTION TO CHECK THE RESPONSE OF THE DB SERVICE
+def checkResponse(x):
+    if 400 <= x.status_code < 500 and x.status_code != 429:
+        raise BatchRejected(f'{x.status_code}: {x.text}')
+    x.raise_for_status()
+#FUNCTION TO SEND THE MSG TO THE DB SERVICE
+#The raw msg is forwarded as it is, bad formatted msgs are checked by the DB service
+async def sendToDB(payload):
+    checkResponse(await postToDB('/writeDB', payload))
+    MSGS_WRITTEN.inc()
+#FUNCTION TO CHECK THAT A MSG IS VALID JSON
+def isJSON(payload):
+    try:
+        json.loads(payload)
+        return True
+    except Exception:
+        return False
+#FUNCTION TO SEND A BATCH OF MSGS TO THE DB SERVICE WITH A SINGLE REQUEST
+#The raw msgs are joined in a JSON array without decoding them, the DB service reports the msgs it cannot write
+#Only if the array is not valid JSON the msgs are decoded to discard the bad formatted ones
+async def sendBatchToDB(payloads, sync=False):
+    if not payloads:
+        return
+    x = await postToDB('/writeDB/batch', b'[' + b','.join(payloads) + b']', sync)
+    if x.status_code == 400:
+        valid = [payload for payload in payloads if isJSON(payload)]
+        if len(valid) < len(payloads):
+            logging.error(f'Discarding {len(payloads) - len(valid)} bad formatted messages')
+            MSGS_REJECTED.inc(len(payloads) - len(valid))
+            if not valid:
+                return
+            x = await postToDB('/writeDB/batch', b'[' + b','.join(valid) + b']', sync)
+    checkResponse(x)
+    result = x.json()
+    MSGS_WRITTEN.inc(result.get("written", 0))
+    rejected = result.get("rejected", [])
+    if rejected:
+        MSGS_REJECTED.inc(len(rejected))
+        logging.error(f'DB service rejected {len(rejected)} messages: {rejected}')
+
+#OFFSETS OF THE BATCHES WAITING FOR THE DB SERVICE
+'''
+For each partition, the tracker keeps the last offset of every batch in the order the batches were created.
+An offset is committed only when its batch and all the previous batches of the same partition are acknowledged.
+The tracker is locked because partitions are revoked by the thread consuming from Kafka.
+'''
+class OffsetTracker:
+    def __init__(self):
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    #Registers a batch given the last offset of each of its partitions, returns the entries to acknowledge
+    def track(self, last_offsets):
+        entries = []
+        with self.lock:
+            for tp, offset in last_offsets.items():
+                entry = [offset, False]
+                self.pending.setdefault(tp, collections.deque()).append(entry)
+                entries.append(entry)
+        return entries
+
+    def ack(self, entries):
+        with self.lock:
+            for entry in entries:
+                entry[1] = True
+
+    #Returns the offsets that can be committed and forgets them, only for the given (topic, partition) keys if not None
+    def committable(self, partitions=None):
+        offsets = []
+        with self.lock:
+            for (topic, partition), entries in self.pending.items():
+                if partitions is not None and (topic, partition) not in partitions:
+                    continue
+                last = None
+                while entries and entries[0][1]:
+                    last = entries.popleft()[0]
+                if last is not None:
+                    offsets.append(TopicPartition(topic, partition, last + 1))
+        return offsets
+
+    def revoke(self, partitions):
+        with self.lock:
+            for p in partitions:
+                self.pending.pop((p.topic, p.partition), None)
+
+tracker = OffsetTracker()
+
+#COMMITS THE OFFSETS OF ALL THE ACKNOWLEDGED BATCHES
+def commitAcked():
+    offsets = tracker.committable()
+    if offsets:
+        c.commit(offsets=offsets, asynchronous=True)
+
+#CALLBACK FOR PARTITIONS ASSIGNED TO ANOTHER CONSUMER, THEIR UNACKNOWLEDGED MSGS WILL BE CONSUMED AGAIN BY THE NEW OWNER
+def onRevoke(consumer, partitions):
+    if not MANUAL_COMMIT:
+        return
+    # The acknowledged offsets of the partitions still assigned stay in the tracker, they are committed with the next batch
+    offsets = tracker.committable({(p.topic, p.partition) for p in partitions})
+    if offsets:
         try:
-            await asyncio.sleep(_SUBSCRIBE_TIMEOUT)
-            dict = admin.list_topics().topics
-            for topic in dict.keys():
-                if topic not in sub_topics and topic != "__consumer_offsets":
-                    sub_topics.append(topic)
-            if sub_topics:
-                c.subscribe(sub_topics)
-                logging.info(f"Subscribed to {sub_topics}")
+            consumer.commit(offsets=offsets, asynchronous=False)
         except Exception as e:
             logging.error(f'Exception: {repr(e)}')
-#FUNCTION TO SEND THE MSG TO THE DB SERVICE
-def sendToDB(msg):
-    x = requests.post(DB_SERVICE_URL + f'/writeDB', json=json.loads(msg))
-    x.raise_for_status()
-#CALLBACK FOR THE THREAD
-def threadCallback(future):
+    tracker.revoke(partitions)
+
+#APPENDS THE MSGS OF A BATCH REFUSED BY THE DB SERVICE TO THE DEAD LETTER FILE OF THIS REPLICA, ONE MSG PER LINE
+#The msgs can be sent again to the DB service (e.g. to /writeDB/batch) once the cause of the failure is fixed
+def deadLetter(batch, reason):
+    DEAD_LETTERS.inc(len(batch))
+    if not DEAD_LETTER_DIR:
+        logging.error(f'Dropping a batch of {len(batch)} messages ({reason}): {batch}')
+        return
+    path = os.path.join(DEAD_LETTER_DIR, GROUP_INSTANCE_ID + '.ndjson')
     try:
-        future.result()
+        os.makedirs(DEAD_LETTER_DIR, exist_ok=True)
+        with open(path, 'ab') as f:
+            f.write(b''.join(payload.replace(b'\n', b' ') + b'\n' for payload in batch))
+        logging.error(f'Moved a batch of {len(batch)} messages to {path}: {reason}')
+    except OSError as e:
+        logging.error(f'Cannot write {path} ({repr(e)}), dropping a batch of {len(batch)} messages ({reason}): {batch}')
+
+#Returns the assigned partitions among the (topic, partition) keys
+def assignedPartitions(keys):
+    assigned = {(tp.topic, tp.partition) for tp in c.assignment()}
+    return [TopicPartition(topic, partition) for topic, partition in keys if (topic, partition) in assigned]
+
+#Pauses the partitions of a batch being sent again
+def pauseRetrying(keys):
+    for key in keys:
+        retrying[key] += 1
+    partitions = assignedPartitions(keys)
+    if partitions:
+        c.pause(partitions)
+
+#Resumes the partitions of a batch written, unless another batch of theirs is still sent again
+def resumeRetried(keys):
+    for key in keys:
+        retrying[key] -= 1
+        if retrying[key] <= 0:
+            del retrying[key]
+    if consumption_paused:
+        return
+    partitions = assignedPartitions([key for key in keys if key not in retrying])
+    if partitions:
+        c.resume(partitions)
+
+#SENDS A BATCH UNTIL THE DB SERVICE CONFIRMS THE WRITE, THEN ACKNOWLEDGES ITS OFFSETS
+'''
+A batch that the DB service could not write (connection errors, timeouts, 5xx and 429 responses) is sent again,
+waiting from RETRY_INTERVAL up to MAX_RETRY_INTERVAL between the attempts, until the DB service is back.
+Meanwhile the partitions of the batch are paused and their offsets are not committed, so their msgs wait in Kafka.
+Only a batch refused by the DB service (4xx) is moved to the dead letter file and acknowledged.
+The batch is dropped if its partitions are revoked, their new owner consumes its msgs again.
+'''
+async def deliverBatch(batch, entries, keys):
+    delay = RETRY_INTERVAL
+    paused = False
+    try:
+        while True:
+            try:
+                await sendBatchToDB(batch, True)
+                break
+            except BatchRejected as e:
+                MSGS_REJECTED.inc(len(batch))
+                await asyncio.to_thread(deadLetter, batch, repr(e))
+                break
+            except Exception as e:
+                ERRORS.labels("delivery").inc()
+                if not assignedPartitions(keys):
+                    logging.warning(f'Exception: {repr(e)}, dropping a batch of {len(batch)} messages of revoked partitions')
+                    return
+                if not paused:
+                    pauseRetrying(keys)
+                    paused = True
+                RETRIES.inc()
+                logging.error(f'Exception: {repr(e)}, sending the batch again in {delay} seconds')
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_INTERVAL)
+    finally:
+        if paused:
+            resumeRetried(keys)
+    tracker.ack(entries)
+    commitAcked()
+#CALLBACK FOR THE DELIVERIES
+def deliveryCallback(task):
+    try:
+        task.result()
     except Exception as e:
+        ERRORS.labels("delivery").inc()
         logging.error(f'Exception: {repr(e)}')
+#FUNCTION TO START A DELIVERY TO THE DB SERVICE WITHOUT WAITING FOR IT
+'''
+When MAX_IN_FLIGHT deliveries are waiting for the DB service, the assigned partitions are paused
+so that Kafka stops fetching msgs, and are resumed when half of the deliveries are completed.
+While paused the consumer keeps polling, otherwise after max.poll.interval.ms it would leave the group and lose
+its partitions. The paused partitions return no msgs, the msgs of the partitions assigned during the pause
+are held for the main loop and their partitions are paused too.
+'''
+async def dispatch(coro, callback=None):
+    global consumption_paused
+    task = asyncio.create_task(coro)
+    in_flight.add(task)
+    task.add_done_callback(in_flight.discard)
+    if callback:
+        task.add_done_callback(callback)
+    if len(in_flight) < MAX_IN_FLIGHT:
+        return
+    c.pause(c.assignment())
+    consumption_paused = True
+    PAUSES.inc()
+    logging.warning(f"{len(in_flight)} deliveries waiting for the DB service, consumption paused")
+    while len(in_flight) > MAX_IN_FLIGHT // 2:
+        await asyncio.wait(in_flight, timeout=_TIMEOUT, return_when=asyncio.FIRST_COMPLETED)
+        msgs = c.consume(BATCH_SIZE, 0)
+        if msgs:
+            held_msgs.extend(msgs)
+            c.pause(c.assignment())
+    consumption_paused = False
+    # The partitions with a batch being sent again stay paused
+    partitions = [tp for tp in c.assignment() if (tp.topic, tp.partition) not in retrying]
+    if partitions:
+        c.resume(partitions)
+#CONSUMER LAG OF THE ASSIGNED PARTITIONS
+'''
+The lag of a partition is the number of msgs after the position of the consumer, up to the high watermark
+cached by the consumer from its last fetch (no request is sent to Kafka). Without a position yet, the lag
+is counted from the low watermark, since the consumer starts from the earliest msg.
+The gauges of the partitions revoked since the last update are removed.
+'''
+lag_partitions = set()
+
+def updateLag():
+    global lag_partitions
+    assigned = c.assignment()
+    current = set()
+    for tp in c.position(assigned) if assigned else []:
+        low, high = c.get_watermark_offsets(tp, cached=True)
+        if high < 0:
+            continue
+        position = tp.offset if tp.offset >= 0 else low
+        labels = (tp.topic, str(tp.partition))
+        CONSUMER_LAG.labels(*labels).set(max(high - position, 0))
+        current.add(labels)
+    for labels in lag_partitions - current:
+        CONSUMER_LAG.remove(*labels)
+    lag_partitions = current
+
+async def lagLoop():
+    while True:
+        await asyncio.sleep(LAG_INTERVAL)
+        try:
+            updateLag()
+        except Exception as e:
+            logging.error(f'Cannot update the consumer lag: {repr(e)}')
+
 #FUNCTION IMPLMENTING THE MAIN LOOP
 '''
-Every _SUBSCRIBE_TIMEOUT seconds, the consumer retrieves all the topics from Kafka and subscribes to all of them.
-Every _TIMEOUT seconds, the consumer poll msgs from Kafka.
-Every new msg is sent to the DB service using a different thread.
+The consumer subscribes to all the topics and polls msgs from Kafka in a separate thread, so that the deliveries go on while it waits for new msgs.
+Every new msg is sent to the DB service without waiting for the previous ones, reusing the connections of a shared pool.
 Bad formatted msgs are checked by the DB service and will return a 400 status code which generate an exception in the consumer.
 '''
 async def main():
-    logging.info("Starting main loop...")
-    asyncio.create_task(subscribeAll())
-    with concurrent.futures.ProcessPoolExecutor(max_workers=4) as executor:
-        msg = None
-        while True:
-            await asyncio.sleep(_TIMEOUT)
-            if sub_topics:
-                msg = c.poll(0.5)
-            if msg is None:
-                continue
+    global http, http_slots
+    logging.info(f"Starting main loop of {GROUP_INSTANCE_ID}...")
+    http = httpx.AsyncClient(base_url=DB_SERVICE_URL, timeout=HTTP_TIMEOUT,
+                             limits=httpx.Limits(max_connections=HTTP_CONCURRENCY, max_keepalive_connections=HTTP_CONCURRENCY))
+    http_slots = asyncio.Semaphore(HTTP_CONCURRENCY)
+    start_http_server(METRICS_PORT)
+    lag_task = asyncio.create_task(lagLoop())
+    background_tasks.add(lag_task)
+    lag_task.add_done_callback(background_tasks.discard)
+    subscribeAll()
+    if BATCH_MODE:
+        await batchLoop()
+        return
+    while True:
+        msg = held_msgs.popleft() if held_msgs else await asyncio.to_thread(c.poll, _TIMEOUT)
+        if msg is None:
+            continue
+        if msg.error():
+            ERRORS.labels("kafka").inc()
+            logging.error("Message error: {}".format(msg.error()))
+            continue
+        MSGS_CONSUMED.labels(msg.topic()).inc()
+        await dispatch(sendToDB(msg.value()), deliveryCallback)
+
+#FUNCTION IMPLEMENTING THE BATCHED MAIN LOOP
+'''
+The consumer reads msgs from Kafka in groups of at most BATCH_SIZE msgs.
+A batch is sent to the DB service when it holds BATCH_SIZE msgs, when its payloads exceed BATCH_MAX_BYTES,
+or when its oldest msg has waited BATCH_TIMEOUT seconds.
+Every batch is written by the DB service with a single InfluxDB write.
+With MANUAL_COMMIT, the offsets of a batch are committed only after the DB service confirms the write
+and failed batches are sent again until they are written (see deliverBatch).
+'''
+async def batchLoop():
+    logging.info(f"Batch mode: size={BATCH_SIZE}, max_bytes={BATCH_MAX_BYTES}, timeout={BATCH_TIMEOUT}s, manual_commit={MANUAL_COMMIT}")
+    batch = []
+    batch_bytes = 0
+    batch_started = None
+    last_offsets = {}
+    while True:
+        timeout = BATCH_TIMEOUT
+        if batch_started is not None:
+            timeout = max(0, BATCH_TIMEOUT - (time.monotonic() - batch_started))
+        if held_msgs:
+            msgs = list(held_msgs)
+            held_msgs.clear()
+        else:
+            msgs = await asyncio.to_thread(c.consume, BATCH_SIZE - len(batch), timeout)
+        consumed = collections.Counter()
+        for msg in msgs:
             if msg.error():
+                ERRORS.labels("kafka").inc()
                 logging.error("Message error: {}".format(msg.error()))
                 continue
-            try:
-                payload = msg.value().decode('utf-8')
-            except Exception as e:
-                logging.error(f'Exception: {repr(e)}')
+            consumed[msg.topic()] += 1
+            if batch_started is None:
+                batch_started = time.monotonic()
+            last_offsets[(msg.topic(), msg.partition())] = msg.offset()
+            payload = msg.value()
+            if not payload:
                 continue
-            future = executor.submit(sendToDB,payload)
-            future.add_done_callback(threadCallback)
+            batch.append(payload)
+            batch_bytes += len(payload)
+        for topic, n in consumed.items():
+            MSGS_CONSUMED.labels(topic).inc(n)
+        if batch_started is None:
+            continue
+        if len(batch) >= BATCH_SIZE or batch_bytes >= BATCH_MAX_BYTES or time.monotonic() - batch_started >= BATCH_TIMEOUT:
+            BATCH_MSGS.observe(len(batch))
+            if MANUAL_COMMIT:
+                await dispatch(deliverBatch(batch, tracker.track(last_offsets), list(last_offsets)))
+            elif batch:
+                await dispatch(sendBatchToDB(batch), deliveryCallback)
+            batch = []
+            batch_bytes = 0
+            batch_started = None
+            last_offsets = {}
 #START THE MAIN LOOP
-asyncio.run(main())
\ No newline at end of file
+asyncio.run(main())
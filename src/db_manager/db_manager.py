@@ -1,71 +1,652 @@
-from flask import Flask, request, make_response, jsonify
-from datetime import datetime
-import influxdb_client, logging, sys, os, gzip, json, uuid
-from influxdb_client.client.write_api import SYNCHRONOUS
+from flask import Flask, request, make_response, jsonify, Response, stream_with_context
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+import influxdb_client, logging, sys, os, json, atexit, threading, zlib, hashlib, itertools, re, calendar, time, collections, fcntl, base64, math, queue, contextlib
+from influxdb_client.client.write_api import SYNCHRONOUS, WriteOptions
+from influxdb_client.domain.write_precision import WritePrecision
+import pyarrow as pa, pyarrow.ipc, pyarrow.parquet, zstandard
+from prometheus_client import Counter, Gauge, Histogram
+from service_metrics import instrument, debugSample
 
 #CONFIGURATION
 DB_PORT= os.environ["DB_PORT"]
-bucket = os.environ["DOCKER_INFLUXDB_INIT_BUCKET"]
+bucket = os.environ.get("DB_BUCKET") or os.environ["DOCKER_INFLUXDB_INIT_BUCKET"]
 org = os.environ["DOCKER_INFLUXDB_INIT_ORG"]
 token = os.environ["DOCKER_INFLUXDB_INIT_ADMIN_TOKEN"]
 url="http://influxdb:"+DB_PORT
 
+#LOGGING CONFIGURATION
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+
+#WRITE PIPELINE CONFIGURATION
+WRITE_BATCH_SIZE = int(os.environ.get("WRITE_BATCH_SIZE", "5000")) #MAX NUMBER OF POINTS IN A SINGLE INFLUXDB WRITE
+WRITE_FLUSH_INTERVAL = int(os.environ.get("WRITE_FLUSH_INTERVAL", "1000")) #MAX TIME A POINT WAITS BEFORE BEING WRITTEN (IN MILLISECONDS)
+WRITE_JITTER_INTERVAL = int(os.environ.get("WRITE_JITTER_INTERVAL", "200")) #RANDOM DELAY ADDED TO EACH FLUSH (IN MILLISECONDS)
+WRITE_RETRY_INTERVAL = int(os.environ.get("WRITE_RETRY_INTERVAL", "1000")) #FIRST RETRY DELAY OF A FAILED WRITE (IN MILLISECONDS)
+WRITE_MAX_RETRIES = int(os.environ.get("WRITE_MAX_RETRIES", "5"))
+WRITE_MAX_RETRY_DELAY = int(os.environ.get("WRITE_MAX_RETRY_DELAY", "30000")) #(IN MILLISECONDS)
+WRITE_EXPONENTIAL_BASE = int(os.environ.get("WRITE_EXPONENTIAL_BASE", "2"))
+WRITE_MAX_PENDING = int(os.environ.get("WRITE_MAX_PENDING", "100000")) #MAX NUMBER OF POINTS QUEUED, NEW WRITES ARE REFUSED WHEN FULL
+
+#DATA LAYOUT
+MEASUREMENT = "misure"
+RAW_FIELD = "data" #FIELD STORING THE DATA STRING AS RECEIVED
+UNIT_TAG_SUFFIX = "_unit" #THE UNIT OF A NUMERIC FIELD IS STORED IN THE TAG <field>_unit
+DIGITS_TAG = "timestamp_digits" #DIGITS OF THE FRACTION OF SECOND OF THE RECEIVED TIMESTAMP, THE TIEBREAK IS BELOW THEM
+TAGS = {"topic", "generator_id", "id", DIGITS_TAG} #id IS A UNIQUE TAG PER POINT FOUND ONLY IN DATA STORED WITH THE PREVIOUS LAYOUT
+TIMESTAMP_PATTERN = re.compile(r'^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(?:\.(\d{1,9}))?Z$')
+STORE_NUMERIC_FIELDS = os.environ.get("STORE_NUMERIC_FIELDS", "true").lower() == "true" #STORE EACH NUMERIC VALUE OF THE DATA AS A FIELD
+STORE_RAW_DATA = os.environ.get("STORE_RAW_DATA", "true").lower() == "true" #STORE ALSO THE DATA STRING (ALWAYS STORED IF IT HAS NO NUMERIC VALUES)
+
+#STREAMING CONFIGURATION
+STREAM_CHUNK_SIZE = 64 * 1024 #UNCOMPRESSED BYTES COLLECTED BEFORE COMPRESSING AND SENDING A CHUNK
+
+#RESPONSE FORMATS CONFIGURATION
+QUERY_FORMATS = {"json": "application/json", "ndjson": "application/x-ndjson", "arrow": "application/vnd.apache.arrow.stream", "parquet": "application/vnd.apache.parquet"}
+QUERY_COMPRESSIONS = ["gzip", "zstd"] #CONTENT ENCODINGS OF THE RESPONSES, THE FIRST IS THE DEFAULT
+COLUMNAR_BATCH_ROWS = 64 * 1024 #RECORDS IN AN ARROW RECORD BATCH OR A PARQUET ROW GROUP
+ZSTD_LEVEL = 3 #COMPRESSION LEVEL OF THE zstd RESPONSES
+
+#QUERY PLANNER CONFIGURATION
+QUERY_SHARD_DURATION = int(os.environ.get("QUERY_SHARD_HOURS", "24")) * 3600 * 10**9 #LONGER WINDOWS ARE READ IN SHARDS OF THIS DURATION (IN NANOSECONDS)
+QUERY_PARALLELISM = int(os.environ.get("QUERY_PARALLELISM", "4")) #SHARDS READ CONCURRENTLY BY EACH QUERY
+REQUEST_THREADS = int(os.environ.get("REQUEST_THREADS", "16")) #REQUESTS ANSWERED CONCURRENTLY BY EACH WORKER (SET BY gunicorn.conf.py)
+QUERY_SHARD_BUFFER = int(os.environ.get("QUERY_SHARD_BUFFER", "10000")) #RECORDS OF A SHARD READ AHEAD OF THE RESPONSE
+QUERY_POOL_SIZE = int(os.environ.get("QUERY_POOL_SIZE", "32")) #CONNECTIONS TO INFLUXDB KEPT BY EACH WORKER
+
+#QUERY CACHE CONFIGURATION
+QUERY_CACHE = os.environ.get("QUERY_CACHE", "true").lower() == "true" #CACHE THE RESPONSES OF /query FOR TIME WINDOWS FULLY IN THE PAST
+QUERY_CACHE_MAX_BYTES = int(os.environ.get("QUERY_CACHE_MAX_BYTES", str(32 * 1024 * 1024))) #MEMORY BUDGET OF THE COMPRESSED RESPONSES CACHED BY EACH WORKER
+QUERY_CACHE_TTL = int(os.environ.get("QUERY_CACHE_TTL", "3600")) #SECONDS A RESPONSE STAYS IN THE CACHE (0: UNTIL EVICTED OR INVALIDATED)
+QUERY_CACHE_JOURNAL = os.environ.get("QUERY_CACHE_JOURNAL", "/dev/shm/dbmanager_writes") #FILE SHARING THE TIME WINDOWS WRITTEN BY THE WORKERS ("" FOR A SINGLE WORKER)
+QUERY_CACHE_JOURNAL_MAX_BYTES = 4 * 1024 * 1024 #SIZE OF THE JOURNAL BEFORE IT IS REPLACED BY A NEW ONE
+QUERY_CACHE_RECENT_WRITES = 1024 #WRITTEN WINDOWS REMEMBERED TO CHECK THE RESPONSES OF THE QUERIES RUNNING DURING A WRITE
+
+#ROLLUP CONFIGURATION
+ROLLUPS = os.environ.get("ROLLUPS", "true").lower() == "true" #KEEP THE PARTIAL AGGREGATES (count, sum, min, max) OF THE NUMERIC FIELDS PER MINUTE
+ROLLUP_MEASUREMENT = "rollup"
+ROLLUP_COVERAGE_MEASUREMENT = "rollup_coverage" #A POINT PER TOPIC AND BLOCK WHOSE PARTIAL AGGREGATES HAVE BEEN COMPUTED
+ROLLUP_RESOLUTION = 60 * 10**9 #TIME WINDOW OF A PARTIAL AGGREGATE (IN NANOSECONDS)
+ROLLUP_BLOCK = 3600 * 10**9 #TIME WINDOW WHOSE PARTIAL AGGREGATES ARE COMPUTED TOGETHER THE FIRST TIME THEY ARE QUERIED (IN NANOSECONDS)
+ROLLUP_MAX_SPAN = 7 * 24 * 3600 * 10**9 #MAX TIME WINDOW READ BY A SINGLE QUERY COMPUTING PARTIAL AGGREGATES (IN NANOSECONDS)
+ROLLUP_INTERVAL = int(os.environ.get("ROLLUP_INTERVAL", "10")) #SECONDS BETWEEN THE UPDATES OF THE PARTIAL AGGREGATES OF THE MINUTES RECEIVING DATA
+ROLLUP_DELAY = int(os.environ.get("ROLLUP_DELAY", "120")) #SECONDS AFTER WHICH A MINUTE IS CLOSED AND ITS PARTIAL AGGREGATES ARE USED
+
 app = Flask(__name__)
-client = influxdb_client.InfluxDBClient(url=url,token=token,org=org)
-logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+client = influxdb_client.InfluxDBClient(url=url,token=token,org=org,connection_pool_maxsize=QUERY_POOL_SIZE)
+# Every request can read QUERY_PARALLELISM shards at once, so a request waiting for a slow client
+# does not keep the shards of the other requests waiting (the threads are started when needed)
+query_executor = ThreadPoolExecutor(max_workers=REQUEST_THREADS * QUERY_PARALLELISM, thread_name_prefix="query-shard")
+logging.basicConfig(stream=sys.stdout, level=LOG_LEVEL)
+
+#METRICS
+REQUEST_SECONDS = Histogram("dbmanager_request_seconds", "Time to answer a request (to the first chunk of a streamed response)", ["endpoint", "status"])
+FLUX_QUERY_SECONDS = Histogram("dbmanager_flux_query_seconds", "Time spent running a Flux query and reading its records", ["kind"])
+ENCODE_SECONDS = Histogram("dbmanager_encode_seconds", "Time spent encoding the records of a /query response", ["format"])
+COMPRESS_SECONDS = Histogram("dbmanager_compress_seconds", "Time spent compressing a /query response", ["compression"])
+SYNC_WRITE_SECONDS = Histogram("dbmanager_sync_write_seconds", "Time of a synchronous write to InfluxDB")
+POINTS_WRITTEN = Counter("dbmanager_points_written", "Points written to InfluxDB")
+POINTS_FAILED = Counter("dbmanager_points_failed", "Points dropped after a failed write")
+WRITE_RETRIES = Counter("dbmanager_write_retries", "Writes retried after an error")
+PENDING_POINTS = Gauge("dbmanager_pending_points", "Points queued in the write pipeline", multiprocess_mode="livesum")
+REJECTED_MESSAGES = Counter("dbmanager_rejected_messages", "Bad formatted messages of the batches")
+ERRORS = Counter("dbmanager_errors", "Failed requests and background tasks", ["kind"])
+CACHE_LOOKUPS = Counter("dbmanager_query_cache_lookups", "Lookups of the query cache", ["result"])
+CACHE_DROPS = Counter("dbmanager_query_cache_drops", "Responses dropped from the query cache", ["reason"])
+CACHE_BYTES = Gauge("dbmanager_query_cache_bytes", "Bytes of the responses in the query cache", multiprocess_mode="livesum")
+instrument(app, REQUEST_SECONDS)
+
+#Raised when the write pipeline holds WRITE_MAX_PENDING points
+class WriteQueueFull(Exception):
+    pass
+
+#Statistics of the write pipeline of this process
+write_stats = {"pending_points": 0, "written_points": 0, "failed_points": 0, "retries": 0}
+write_stats_lock = threading.Lock()
+
+#Number of points in a line protocol batch
+def countLines(data):
+    if isinstance(data, str):
+        data = data.encode('utf8')
+    return data.count(b'\n') + 1
+
+#Escaped characters of the line protocol, the series (measurement and tags) of a line and the topic tag of a series
+LINE_ESCAPE_PATTERN = re.compile(rb'\\(.)')
+LINE_SERIES_PATTERN = re.compile(rb'^((?:[^ \\]|\\.)*) ')
+LINE_TOPIC_PATTERN = re.compile(rb',topic=((?:[^,\\]|\\.)*)')
+
+#Returns the topic and the timestamp (in nanoseconds) of the points of a line protocol batch
+def lineSeries(data):
+    if isinstance(data, str):
+        data = data.encode('utf8')
+    series = []
+    for line in data.split(b'\n'):
+        if not line:
+            continue
+        topic = None
+        match = LINE_SERIES_PATTERN.match(line)
+        if match:
+            match = LINE_TOPIC_PATTERN.search(match.group(1))
+        if match:
+            topic = LINE_ESCAPE_PATTERN.sub(rb'\1', match.group(1)).decode('utf8')
+        series.append((topic, int(line.rsplit(b' ', 1)[1])))
+    return series
+
+#Called after the points of a line protocol batch have been written
+def onPointsWritten(data):
+    series = lineSeries(data)
+    if not series:
+        return
+    times = [ns for _, ns in series]
+    query_cache.written(min(times), max(times))
+    if ROLLUPS:
+        markRollups(series)
+
+def onWriteSuccess(conf, data):
+    n = countLines(data)
+    with write_stats_lock:
+        write_stats["pending_points"] -= n
+        write_stats["written_points"] += n
+    PENDING_POINTS.dec(n)
+    POINTS_WRITTEN.inc(n)
+    onPointsWritten(data)
+
+def onWriteError(conf, data, exception):
+    n = countLines(data)
+    with write_stats_lock:
+        write_stats["pending_points"] -= n
+        write_stats["failed_points"] += n
+    PENDING_POINTS.dec(n)
+    POINTS_FAILED.inc(n)
+    logging.error('Dropping %d points after a failed write: %r', n, exception)
+
+def onWriteRetry(conf, data, exception):
+    with write_stats_lock:
+        write_stats["retries"] += 1
+    WRITE_RETRIES.inc()
+    logging.warning('Retrying a write of %d points: %r', countLines(data), exception)
+
+#Process-wide write APIs: points are queued and written in batches, or written synchronously when the caller needs an acknowledgment
+write_api = client.write_api(write_options=WriteOptions(batch_size=WRITE_BATCH_SIZE,
+                                                        flush_interval=WRITE_FLUSH_INTERVAL,
+                                                        jitter_interval=WRITE_JITTER_INTERVAL,
+                                                        retry_interval=WRITE_RETRY_INTERVAL,
+                                                        max_retries=WRITE_MAX_RETRIES,
+                                                        max_retry_delay=WRITE_MAX_RETRY_DELAY,
+                                                        exponential_base=WRITE_EXPONENTIAL_BASE),
+                             success_callback=onWriteSuccess,
+                             error_callback=onWriteError,
+                             retry_callback=onWriteRetry)
+sync_write_api = client.write_api(write_options=SYNCHRONOUS)
+
+#Flushes the queued points before the process exits
+def closeWritePipeline():
+    logging.info('Flushing %d pending points...', write_stats["pending_points"])
+    write_api.close()
+    client.close()
+
+atexit.register(closeWritePipeline)
+
+#Writes the points, converted to line protocol by the caller, through the batching pipeline or synchronously if sync is True
+#The points are converted before being counted as pending, so a point that cannot be converted is never counted
+def writePoints(lines, sync=False):
+    if sync:
+        n = len(lines)
+        lines = "\n".join(lines)
+        with SYNC_WRITE_SECONDS.time():
+            sync_write_api.write(bucket=bucket, org=org, record=lines)
+        POINTS_WRITTEN.inc(n)
+        onPointsWritten(lines)
+        return
+    with write_stats_lock:
+        if write_stats["pending_points"] + len(lines) > WRITE_MAX_PENDING:
+            raise WriteQueueFull(f'{write_stats["pending_points"]} points waiting to be written')
+        write_stats["pending_points"] += len(lines)
+    PENDING_POINTS.inc(len(lines))
+    try:
+        write_api.write(bucket=bucket, org=org, record=lines)
+    except Exception:
+        with write_stats_lock:
+            write_stats["pending_points"] -= len(lines)
+        PENDING_POINTS.dec(len(lines))
+        raise
+
+#QUERY CACHE
+'''
+Each worker keeps the compressed responses of the queries on time windows fully in the past,
+evicting the least recently used ones beyond QUERY_CACHE_MAX_BYTES and the ones older than QUERY_CACHE_TTL.
+A response is dropped only when a point with a timestamp in its window is written: the workers append the
+window of each written batch to a journal shared through QUERY_CACHE_JOURNAL, and every worker reads the
+new windows from the journal before using its cache. When the journal is replaced by a new one, the workers
+clear their cache, since they may have missed some windows.
+'''
+class QueryCache:
+    def __init__(self, max_bytes, ttl, journal_path):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.journal_path = journal_path
+        self.entries = collections.OrderedDict() #key -> (start_ns, stop_ns, content, expiry)
+        self.size = 0
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0, "evictions": 0}
+        self.lock = threading.Lock()
+        self.version = 0 #NUMBER OF WRITTEN WINDOWS SEEN BY THIS WORKER
+        self.recent = collections.deque(maxlen=QUERY_CACHE_RECENT_WRITES) #(version, first_ns, last_ns) OF THE LAST WRITTEN WINDOWS
+        self.oldest = 0 #OLDEST VERSION WHOSE WRITTEN WINDOWS ARE ALL IN recent
+        self.journal = None
+        self.partial = b''
+
+    #Returns the cached response of the key, or None
+    def get(self, key):
+        self.sync()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[3] is not None and entry[3] < time.monotonic():
+                self.drop(key)
+                CACHE_DROPS.labels("expiration").inc()
+                entry = None
+            if entry is None:
+                self.stats["misses"] += 1
+                CACHE_LOOKUPS.labels("miss").inc()
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            CACHE_LOOKUPS.labels("hit").inc()
+            return entry[2]
+
+    #Returns the version to pass to put when the query runs
+    def begin(self):
+        self.sync()
+        return self.version
+
+    #Caches the response of the window [start_ns, stop_ns) read by a query begun at version,
+    #unless a point in the window was written while the query was running
+    def put(self, key, start_ns, stop_ns, content, version):
+        if len(content) > self.max_bytes:
+            return
+        self.sync()
+        with self.lock:
+            if version < self.oldest:
+                return
+            for v, first, last in self.recent:
+                if v > version and first < stop_ns and last >= start_ns:
+                    return
+            if key in self.entries:
+                self.drop(key)
+            expiry = time.monotonic() + self.ttl if self.ttl > 0 else None
+            self.entries[key] = (start_ns, stop_ns, content, expiry)
+            self.size += len(content)
+            CACHE_BYTES.inc(len(content))
+            while self.size > self.max_bytes:
+                self.drop(next(iter(self.entries)))
+                self.stats["evictions"] += 1
+                CACHE_DROPS.labels("eviction").inc()
+
+    #Called after writing points with timestamps from first_ns to last_ns
+    def written(self, first_ns, last_ns):
+        self.invalidate(first_ns, last_ns)
+        if self.journal_path:
+            try:
+                self.append(f"{first_ns} {last_ns}\n".encode('utf8'))
+            except OSError as e:
+                ERRORS.labels("cache_journal").inc()
+                logging.error('Cannot write the query cache journal: %r', e)
+
+    #Drops the cached responses with a window including a timestamp from first_ns to last_ns
+    def invalidate(self, first_ns, last_ns):
+        with self.lock:
+            self.version += 1
+            if len(self.recent) == self.recent.maxlen:
+                self.oldest = self.recent[0][0]
+            self.recent.append((self.version, first_ns, last_ns))
+            for key in [k for k, e in self.entries.items() if e[0] <= last_ns and first_ns < e[1]]:
+                self.drop(key)
+                self.stats["invalidations"] += 1
+                CACHE_DROPS.labels("invalidation").inc()
+
+    #Drops all the cached responses
+    def clear(self):
+        with self.lock:
+            self.version += 1
+            self.oldest = self.version
+            self.entries.clear()
+            CACHE_BYTES.dec(self.size)
+            self.size = 0
+
+    def drop(self, key):
+        size = len(self.entries.pop(key)[2])
+        self.size -= size
+        CACHE_BYTES.dec(size)
+
+    #Appends a line to the journal, replacing it with a new one when it is too big
+    def append(self, line):
+        while True:
+            fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                # Another worker may have replaced the journal while waiting for the lock
+                try:
+                    current = os.stat(self.journal_path).st_ino == os.fstat(fd).st_ino
+                except FileNotFoundError:
+                    current = False
+                if current:
+                    os.write(fd, line)
+                    if os.fstat(fd).st_size > QUERY_CACHE_JOURNAL_MAX_BYTES:
+                        os.replace(self.journal_path, self.journal_path + ".old")
+                    return
+            finally:
+                os.close(fd)
+
+    #Reads the windows written by the other workers since the last call
+    def sync(self):
+        if not self.journal_path:
+            return
+        try:
+            if self.journal is None:
+                self.journal = open(self.journal_path, 'ab+')
+                self.journal.seek(0, os.SEEK_END)
+                return
+            self.apply(self.journal.read())
+            try:
+                replaced = os.stat(self.journal_path).st_ino != os.fstat(self.journal.fileno()).st_ino
+            except FileNotFoundError:
+                return
+            if replaced:
+                self.apply(self.journal.read())
+                self.journal.close()
+                self.journal = open(self.journal_path, 'rb')
+                self.partial = b''
+                self.clear()
+                self.apply(self.journal.read())
+        except OSError as e:
+            ERRORS.labels("cache_journal").inc()
+            logging.error('Cannot read the query cache journal: %r', e)
+            self.clear()
+
+    def apply(self, data):
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        for line in lines:
+            first_ns, last_ns = line.split()
+            self.invalidate(int(first_ns), int(last_ns))
+
+query_cache = QueryCache(QUERY_CACHE_MAX_BYTES, QUERY_CACHE_TTL, QUERY_CACHE_JOURNAL if QUERY_CACHE else "")
+
+#HEALTH CHECK
+'''
+The response reports the state of the write pipeline of the worker serving the request:
+{
+    "status": "ok" | "full",
+    "write_queue": {"pending_points": int, "max_pending_points": int, "written_points": int, "failed_points": int, "retries": int},
+    "query_cache": {"hits": int, "misses": int, "invalidations": int, "evictions": int, "entries": int, "bytes": int, "max_bytes": int}
+}
+'''
+@app.route("/health", methods=["GET"])
+def health():
+    with write_stats_lock:
+        stats = dict(write_stats)
+    stats["max_pending_points"] = WRITE_MAX_PENDING
+    status = "full" if stats["pending_points"] >= WRITE_MAX_PENDING else "ok"
+    with query_cache.lock:
+        cache = dict(query_cache.stats, entries=len(query_cache.entries), bytes=query_cache.size, max_bytes=QUERY_CACHE_MAX_BYTES)
+    return make_response(jsonify(status=status, write_queue=stats, query_cache=cache), 200)
+
+#Accumulates the time spent in the steps of a response, e.g. the encoding of each record, and observes the total in a histogram
+class Stopwatch:
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.elapsed += time.perf_counter() - self.begin
+
+    def observe(self):
+        self.histogram.observe(self.elapsed)
 
 #WRITE IN DB
 '''
 The payload must be a JSON with the following structure:
 {
-    "timestamp": string formatted in ISO 8601 YYYY:MM:DDTHH:MM:SSZ,
+    "timestamp": string formatted in ISO 8601 YYYY:MM:DDTHH:MM:SSZ, with up to 9 digits of fraction of second (e.g. YYYY:MM:DDTHH:MM:SS.123Z),
     "generator_id": string
     "topic": string
-    "data": str
+    "data": str (a number is stored as a string)
+When the data follows the POLIMI data format, e.g. {"power": {"value": 5, "unit": "W"}}, each numeric value
+is stored as a float field (power) with its unit in a tag (power_unit), next to the data string.
+The point is queued and written asynchronously (status code 202), add the query parameter sync=true to wait for the write (status code 200).
+A bad formatted message has status code 400, a failed write 500. If the write queue is full the response has status code 503.
 '''
 @app.route("/writeDB", methods=["POST"])
 def write():
+    msg = None
     try:
         msg = request.get_json()
-        writeDB(msg)
-        return make_response("Data written to InfluxDB", 200)
+        line = buildPoint(msg).to_line_protocol()
     except Exception as e:
+        REJECTED_MESSAGES.inc()
         if msg:
-            app.logger.error('Error writing to DB with message: %s', msg)
+            app.logger.error('Bad formatted message: %s', msg)
+        app.logger.error(repr(e))
+        return make_response(repr(e), 400)
+    sync = isSync()
+    try:
+        writePoints([line], sync)
+    except WriteQueueFull as e:
+        ERRORS.labels("write_queue_full").inc()
+        app.logger.warning(repr(e))
+        return make_response(repr(e), 503)
+    except Exception as e:
+        ERRORS.labels("write").inc()
+        app.logger.error('Error writing to DB with message: %s', msg)
+        app.logger.error(repr(e))
+        return make_response(repr(e), 500)
+    if sync:
+        return make_response("Data written to InfluxDB", 200)
+    return make_response("Data queued for writing to InfluxDB", 202)
+
+#WRITE A BATCH IN DB
+'''
+The payload must be a JSON array of messages having the same structure accepted by /writeDB.
+All the valid messages are queued with a single call, add the query parameter sync=true to wait for the write.
+The bad formatted messages are rejected by their index, the status code 500 means that the write of the valid ones failed.
+With sync=true, the status code 422 means that InfluxDB refused the points of the valid ones (e.g. a field with another type).
+If the write queue is full the response has status code 503.
+The response reports the number of messages written and the messages rejected because bad formatted:
+{
+    "written": int,
+    "rejected": [{"index": int, "error": str}]
+}
+'''
+@app.route("/writeDB/batch", methods=["POST"])
+def write_batch():
+    msgs = None
+    try:
+        msgs = request.get_json()
+        if not isinstance(msgs, list):
+            return make_response("The payload must be a JSON array", 400)
+    except Exception as e:
         app.logger.error(repr(e))
         return make_response(repr(e), 400)
+    try:
+        written, rejected = writeDBBatch(msgs, sync=isSync())
+    except WriteQueueFull as e:
+        ERRORS.labels("write_queue_full").inc()
+        app.logger.warning(repr(e))
+        return make_response(repr(e), 503)
+    except influxdb_client.rest.ApiException as e:
+        # InfluxDB refused the points (e.g. a field with another type), writing them again would fail again
+        if e.status in (400, 413, 422):
+            ERRORS.labels("write_refused").inc()
+            app.logger.error('InfluxDB refused a batch of %d messages: %r', len(msgs), e)
+            return make_response(repr(e), 422)
+        ERRORS.labels("write").inc()
+        app.logger.error('Error writing a batch of %d messages to DB', len(msgs))
+        app.logger.error(repr(e))
+        return make_response(repr(e), 500)
+    except Exception as e:
+        ERRORS.labels("write").inc()
+        app.logger.error('Error writing a batch of %d messages to DB', len(msgs))
+        app.logger.error(repr(e))
+        return make_response(repr(e), 500)
+    if rejected:
+        REJECTED_MESSAGES.inc(len(rejected))
+        app.logger.error('Rejected %d messages of the batch: %s', len(rejected), rejected)
+    return make_response(jsonify(written=written, rejected=rejected), 200)
+
+#True if the request asks to wait for the write
+def isSync():
+    return request.args.get('sync', default='false', type=str).lower() == 'true'
+
+#Takes a list of payloads and write all the valid ones to the InfluxDB with a single call
+#A message that cannot be converted to a point is rejected by its index, the others are written
+def writeDBBatch(msgs, sync=False):
+    lines = []
+    rejected = []
+    for index, msg in enumerate(msgs):
+        try:
+            lines.append(buildPoint(msg).to_line_protocol())
+        except Exception as e:
+            rejected.append({"index": index, "error": repr(e)})
+    if lines:
+        writePoints(lines, sync)
+    return len(lines), rejected
 
-#Takes the payload and write it to the InfluxDB
-def writeDB(msg):
+#Takes the payload and builds the InfluxDB point, raises ValueError if the payload is bad formatted
+#A numeric data is stored as a string, so that the data field of a series has always the same type
+def buildPoint(msg):
+    if not isinstance(msg, dict):
+        raise ValueError("The message must be a JSON object")
     timestamp = msg["timestamp"]
     generator_id = msg["generator_id"]
     topic = msg["topic"]
     data = msg["data"]
-    
-    try:
-        # Try to parse with milliseconds
-        dt = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
-    except ValueError:
-        # If that fails, try parsing without milliseconds
-        dt = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ")
-    
-    unixtimestamp = int(dt.timestamp())
-    id = str(uuid.uuid4())
+    if not isinstance(timestamp, str):
+        raise ValueError(f"Invalid timestamp: {timestamp!r}")
+    if not isinstance(topic, str) or not topic:
+        raise ValueError(f"Invalid topic: {topic!r}")
+    if not isinstance(generator_id, str) or not generator_id:
+        raise ValueError(f"Invalid generator_id: {generator_id!r}")
+    if isinstance(data, (int, float)) and not isinstance(data, bool):
+        data = json.dumps(data)
+    if not isinstance(data, str):
+        raise ValueError(f"Invalid data, it must be a string: {data!r}")
+
+    unixtimestamp, digits = parseTimestamp(timestamp)
+    # A point is identified by its series (topic and generator) and its timestamp: the same reading is stored
+    # once even if received twice, different readings with the same timestamp are told apart by the tiebreak,
+    # which uses all the nanoseconds below the last digit of the timestamp (a second for a timestamp without fraction)
+    unixtimestamp += tiebreak(topic, generator_id, data, digits)
+
+    p = influxdb_client.Point(MEASUREMENT).time(unixtimestamp,WritePrecision.NS).tag("topic", topic).tag("generator_id",generator_id).tag(DIGITS_TAG, str(digits))
+    fields = parseNumericFields(data) if STORE_NUMERIC_FIELDS else {}
+    for name, (value, unit) in fields.items():
+        p.field(name, value)
+        if unit is not None:
+            p.tag(name + UNIT_TAG_SUFFIX, unit)
+    if STORE_RAW_DATA or not fields:
+        p.field(RAW_FIELD, data)
+    return p
+
+#Parses a timestamp YYYY-MM-DDTHH:MM:SS[.fraction]Z, returns the nanoseconds since epoch and the digits of the fraction
+def parseTimestamp(timestamp):
+    match = TIMESTAMP_PATTERN.match(timestamp)
+    if not match:
+        raise ValueError(f"Invalid timestamp: {timestamp}")
+    seconds = calendar.timegm(time.strptime(match.group(1), "%Y-%m-%dT%H:%M:%S"))
+    fraction = match.group(2) or ""
+    return seconds * 10**9 + int(fraction.ljust(9, "0")), len(fraction)
+
+#Formats nanoseconds since epoch as a RFC3339 time for Flux
+def fluxTime(ns):
+    seconds, nanoseconds = divmod(ns, 10**9)
+    return datetime.fromtimestamp(seconds, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S") + f".{nanoseconds:09d}Z"
 
-    write_api = client.write_api(write_options=SYNCHRONOUS)
-    p = influxdb_client.Point("misure").time(unixtimestamp,"s").tag("topic", topic).tag("generator_id",generator_id).tag("id",id).field("data", data)
-    write_api.write(bucket=bucket, org=org, record=p)
+#Converts nanoseconds since epoch to a datetime, truncated to microseconds
+def nsTime(ns):
+    seconds, nanoseconds = divmod(ns, 10**9)
+    return datetime.fromtimestamp(seconds, tz=timezone.utc).replace(microsecond=nanoseconds // 1000)
+
+#Formats a time read from InfluxDB, with milliseconds or microseconds only if the time has a fraction of second
+def formatTime(dt):
+    text = dt.strftime("%Y-%m-%dT%H:%M:%S")
+    if dt.microsecond % 1000:
+        text += f".{dt.microsecond:06d}"
+    elif dt.microsecond:
+        text += f".{dt.microsecond // 1000:03d}"
+    return text + "Z"
+
+#Deterministic offset in nanoseconds of a reading, below the last digit of its timestamp
+def tiebreak(topic, generator_id, data, digits):
+    key = json.dumps([topic, generator_id, data], sort_keys=True).encode('utf8')
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big') % 10**(9 - digits)
+
+#Takes the time of a stored point and returns the time received, without the tiebreak (the points stored without
+#the digits of their timestamp are returned as read, truncated to microseconds)
+def receivedTime(dt, digits):
+    if digits is None:
+        return dt
+    step = 10**(6 - min(int(digits), 6))
+    return dt.replace(microsecond=dt.microsecond - dt.microsecond % step)
+
+#Takes the data of a payload in the POLIMI data format and returns {field: (float value, unit)} for its numeric values
+def parseNumericFields(data):
+    if isinstance(data, str):
+        try:
+            data = json.loads(data)
+        except ValueError:
+            try:
+                data = json.loads(data.replace("'", "\""))
+            except ValueError:
+                return {}
+    if not isinstance(data, dict):
+        return {}
+    fields = {}
+    for name, attr in data.items():
+        if not isinstance(attr, dict) or name == RAW_FIELD or name.startswith("_") or name in TAGS:
+            continue
+        value = attr.get("value")
+        unit = attr.get("unit")
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value) or not name:
+            continue
+        fields[name] = (float(value), unit if isinstance(unit, str) and unit else None)
+    return fields
 
 
 #QUERY DB
 '''
 The payload for a query must be a JSON having at least one of the following fields:
-"start": string formatted in ISO 8601 YYYY:MM:DDTHH:MM:SSZ
-"stop": string formatted in ISO 8601 YYYY:MM:DDTHH:MM:SSZ
+"start": string formatted in ISO 8601 YYYY:MM:DDTHH:MM:SSZ, optionally with a fraction of second
+"stop": string formatted in ISO 8601 YYYY:MM:DDTHH:MM:SSZ, optionally with a fraction of second
 "topic": string
 "generator_id": string
+"fields": list of strings (optional, returns only the numeric values of these fields in the data of each record)
+"limit": int (optional, max number of records in the response)
+"order": "asc" (default) | "desc" (optional, the order of the records by timestamp)
+"cursor": string (optional, the X-Next-Cursor header of the response with the previous page)
+
+The response is a JSON array with all the records that match the query, sorted by timestamp.
+Records with the same timestamp are sorted by topic and generator_id. With a limit the response has at most
+limit records and, if more records match the query, the header X-Next-Cursor with an opaque cursor:
+the same query with this cursor returns the next page, starting after the last record of the response.
+Windows longer than QUERY_SHARD_HOURS are read in shards of that duration, QUERY_PARALLELISM at a time,
+and the records of the shards are sent in the order of the shards.
+The timestamps of the records have milliseconds or microseconds when they have a fraction of second.
+
+With the optional field "stream": true the records are sent while they are read from InfluxDB,
+so the memory used does not depend on the number of records.
 
-The response is an unsorted JSON array with all the records that match the query.
+The optional field "format", or else the Accept header, selects the body of the response:
+"json" (default, application/json) for a JSON array, "ndjson" (application/x-ndjson) for one JSON record per line,
+"arrow" (application/vnd.apache.arrow.stream) for an Arrow IPC stream and "parquet" (application/vnd.apache.parquet)
+for a Parquet file. The Arrow and Parquet responses have the columns timestamp, topic, generator_id and data or,
+with "fields", a float column per field with its unit in the column <field>_unit.
+The optional field "compression", or else the Accept-Encoding header, selects the compression: "gzip" (default) or "zstd".
+The Parquet files are not compressed as a whole, their columns are compressed with the selected codec.
+
+The responses of the queries (not streamed and without a limit or a cursor) with a window fully in the past are cached,
+the header X-Cache of the response is HIT when it was read from the cache and MISS otherwise.
 '''
 @app.route("/query", methods=["POST"]) 
 def query():
@@ -77,62 +658,807 @@ def query():
         stop = msg.get("stop",None)
         topic = msg.get("topic",None)
         generator_id = msg.get("generator_id",None)
+        fields = msg.get("fields",None)
+        if isinstance(fields, str):
+            fields = [fields]
 
-        app.logger.info('Querying db with parameters: start=%s, stop=%s, topic=%s, generator_id=%s', start,stop,topic,generator_id)
+        try:
+            page = parsePage(msg)
+        except ValueError as e:
+            return make_response(str(e), 400)
+        stream = msg.get("stream", False)
+        format, compression = responseFormat(msg)
+        if format not in QUERY_FORMATS:
+            return make_response(f"Unsupported format: {format}", 400)
+        if compression not in QUERY_COMPRESSIONS:
+            return make_response(f"Unsupported compression: {compression}", 400)
 
-        query = f'from(bucket:"{bucket}")'
-        
-        query = buildQuery(query,start,stop,topic,generator_id)
+        debugSample('Querying db with parameters: start=%s, stop=%s, topic=%s, generator_id=%s, fields=%s, page=%s', start,stop,topic,generator_id,fields,page)
 
-        app.logger.info('Query: %s', query)
+        queries = planQuery(start,stop,topic,generator_id,fields,page)
 
-        result = client.query_api().query(org=org, query=query)
-        
-        if not result:
-            return make_response("", 404)
-        result = extractResults(result)
+        debugSample('Query in %d shards: %s', len(queries), queries[0])
 
-        content = gzip.compress(json.dumps(result).encode('utf8'),mtime=0)
-        response = make_response(content)
-        response.headers['Content-length'] = len(content)
-        response.headers['Content-Encoding'] = 'gzip'
-        return response
+        key = None if stream else cacheKey(start, stop, topic, generator_id, fields, page, format, compression)
+        if key:
+            content = query_cache.get(key)
+            if content is not None:
+                return compressedResponse(content, format, compression, "HIT")
+            version = query_cache.begin()
+
+        cursor = None
+        if page["limit"]:
+            records, cursor = readPage(queries, page["limit"])
+        else:
+            records = shardedRecords(queries)
+
+        # Read the first record before answering, to return 404 when there are no records
+        records = iter(records)
+        first = next(records, None)
+        if first is None:
+            chunks = []
+        else:
+            chunks = encodedChunks(itertools.chain([first], records), format, compression, fields)
+
+        if stream:
+            if first is None:
+                return make_response("", 404)
+            return streamQuery(chunks, format, compression, cursor)
+
+        # An empty content is cached for a window without records
+        content = b''.join(chunks)
+        if key:
+            query_cache.put(key, parseTimestamp(start)[0], parseTimestamp(stop)[0], content, version)
+        return compressedResponse(content, format, compression, "MISS" if key else None, cursor)
         #return make_response(jsonify(result), 200)
     except Exception as e:
         if isinstance(e, influxdb_client.exceptions.APIException):
             if 'error in building plan while starting program: cannot query an empty range' in repr(e):
                 return make_response("No data in the time window.", 404)
 
+        ERRORS.labels("query").inc()
         app.logger.error(repr(e))
         return make_response(repr(e), 400)
     
+#Returns the format and the compression of the response of a query, from its fields or else from the Accept headers
+def responseFormat(msg):
+    format = msg.get("format", None)
+    if format is None:
+        mimetype = request.accept_mimetypes.best_match(list(QUERY_FORMATS.values()), default=QUERY_FORMATS["json"])
+        format = next(name for name, value in QUERY_FORMATS.items() if value == mimetype)
+    compression = msg.get("compression", None)
+    if compression is None:
+        compression = request.accept_encodings.best_match(QUERY_COMPRESSIONS, default=QUERY_COMPRESSIONS[0])
+    return format, compression
+
+#Returns the cache key of a query on a window fully in the past, or None if the query is not cached
+def cacheKey(start, stop, topic, generator_id, fields, page, format, compression):
+    if not QUERY_CACHE or not start or not stop or page["limit"] or page["after"] or parseTimestamp(stop)[0] > time.time_ns():
+        return None
+    return json.dumps([parseTimestamp(start)[0], parseTimestamp(stop)[0], topic, generator_id, sorted(set(fields)) if fields else None, page["desc"], format, compression])
+
+#Returns the encoded and compressed records of a query, 404 if empty
+def compressedResponse(content, format, compression, cache=None, cursor=None):
+    if not content:
+        response = make_response("", 404)
+    else:
+        response = make_response(content)
+        response.headers['Content-length'] = len(content)
+        response.headers['Content-Type'] = QUERY_FORMATS[format]
+        if format != "parquet":
+            response.headers['Content-Encoding'] = compression
+    if cache:
+        response.headers['X-Cache'] = cache
+    if cursor:
+        response.headers['X-Next-Cursor'] = cursor
+    return response
+
+#Takes the limit, order and cursor of a query and returns the page {"limit", "desc", "after"} to read
+def parsePage(msg):
+    limit = msg.get("limit", None)
+    order = msg.get("order", "asc")
+    cursor = msg.get("cursor", None)
+    if limit is not None and (isinstance(limit, bool) or not isinstance(limit, int) or limit <= 0):
+        raise ValueError(f"Invalid limit: {limit}")
+    if order not in ("asc", "desc"):
+        raise ValueError(f"Invalid order: {order}")
+    return {"limit": limit, "desc": order == "desc", "after": decodeCursor(cursor) if cursor else None}
+
+#The cursor of a page is the key (nanoseconds, topic, generator_id) of its last record
+def encodeCursor(ns, topic, generator_id):
+    return base64.urlsafe_b64encode(json.dumps([ns, topic, generator_id]).encode('utf8')).decode('ascii').rstrip("=")
+
+def decodeCursor(cursor):
+    try:
+        ns, topic, generator_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    if not isinstance(ns, int) or not isinstance(topic, str) or not isinstance(generator_id, str):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return ns, topic, generator_id
+
+#Reads at most limit records, returns them with the cursor of the next page (None if there are no more records)
+def readPage(queries, limit):
+    with contextlib.closing(shardedRecords(queries)) as records:
+        records = list(itertools.islice(records, limit + 1))
+    if len(records) <= limit:
+        return records, None
+    last = records[limit - 1].values
+    return records[:limit], encodeCursor(last["_ns"], last["topic"], last["generator_id"])
+
+#Builds the DB queries reading the window in shards of at most QUERY_SHARD_DURATION, in the order of the page
+def planQuery(start,stop,topic,generator_id,fields=None,page=None):
+    query = f'from(bucket:"{bucket}")'
+    if page and page["after"]:
+        # The window of the next page starts (or with order desc stops) at the last record of the previous page
+        ns = page["after"][0]
+        if page["desc"]:
+            stop = fluxTime(min(parseTimestamp(stop)[0], ns + 1) if stop else ns + 1)
+        else:
+            start = fluxTime(max(parseTimestamp(start)[0], ns) if start else ns)
+    # InfluxDB returns the records of a series in time order, only the records of several series need to be sorted
+    sort = not singleSeries(query,start,stop,topic,generator_id,fields,page)
+    if not start or not stop:
+        return [buildQuery(query,start,stop,topic,generator_id,fields,page=page,sort=sort)]
+    start_ns = parseTimestamp(start)[0]
+    stop_ns = parseTimestamp(stop)[0]
+    shards = range(start_ns, stop_ns, QUERY_SHARD_DURATION)
+    if len(shards) <= 1:
+        return [buildQuery(query,start,stop,topic,generator_id,fields,page=page,sort=sort)]
+    if page and page["desc"]:
+        shards = reversed(shards)
+    return [buildQuery(query,fluxTime(shard),fluxTime(min(shard + QUERY_SHARD_DURATION, stop_ns)),topic,generator_id,fields,page=page,sort=sort) for shard in shards]
+
+#Tells if the records of an ascending query on a topic and a generator are a single series (the series differ by their units),
+#reading the first point of each series in the window, which the storage engine finds without reading the series
+def singleSeries(query,start,stop,topic,generator_id,fields=None,page=None):
+    if not topic or not generator_id or (page and page["desc"]):
+        return False
+    probe = buildQuery(query,start,stop,topic,generator_id,select=False) + fieldFilter(fields) + '|> first()'
+    series = set()
+    for record in client.query_api().query_stream(org=org, query=probe):
+        series.add(tuple(sorted((k, v) for k, v in record.values.items() if k not in ("result", "table", "_start", "_stop", "_time", "_value", "_field"))))
+        if len(series) > 1:
+            return False
+    return True
+
+#Reads the records of the shards of a query, at most QUERY_PARALLELISM shards at a time, returns them in the order of the shards
+def shardedRecords(queries):
+    if len(queries) == 1:
+        return timedRecords(client.query_api().query_stream(org=org, query=queries[0]), "query")
+    return orderedShards(iter(queries))
+
+#Each shard is streamed through a queue of at most QUERY_SHARD_BUFFER records, so the memory used does not depend on
+#the size of the shards. The readers stop when the records are no longer needed (e.g. the client closed the response)
+#The next shard is submitted when the reader of a shard ends, so a query never reads more than QUERY_PARALLELISM shards at once
+def orderedShards(queries):
+    stop = threading.Event()
+    pending = collections.deque()
+    def submit():
+        query = next(queries, None)
+        if query is not None:
+            buffer = queue.Queue(maxsize=QUERY_SHARD_BUFFER)
+            query_executor.submit(readShard, query, buffer, stop)
+            pending.append(buffer)
+    try:
+        for _ in range(QUERY_PARALLELISM):
+            submit()
+        while pending:
+            buffer = pending.popleft()
+            record = buffer.get()
+            while record is not None:
+                if isinstance(record, Exception):
+                    raise record
+                yield record
+                record = buffer.get()
+            submit()
+    finally:
+        stop.set()
+
+#Reads the records of a shard into the buffer, followed by None when the shard ends or by the exception of a failed read
+def readShard(query, buffer, stop):
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    try:
+        with contextlib.closing(timedRecords(client.query_api().query_stream(org=org, query=query), "query")) as records:
+            for record in records:
+                if not put(record):
+                    return
+        put(None)
+    except Exception as e:
+        put(e)
+
+#Yields the records read by a Flux query, observing the time spent reading them apart from the time spent encoding them
+def timedRecords(records, kind):
+    watch = Stopwatch(FLUX_QUERY_SECONDS.labels(kind))
+    try:
+        while True:
+            with watch:
+                record = next(records, None)
+            if record is None:
+                return
+            yield record
+    finally:
+        watch.observe()
+        records.close()
+
 #Builds the DB query string based on the HTTP query parameters
-def buildQuery(query,start,stop,topic,generator_id):
+def buildQuery(query,start,stop,topic,generator_id,fields=None,select=True,page=None,sort=True):
     if start:
-        start = datetime.strptime(start, "%Y-%m-%dT%H:%M:%SZ").strftime("%Y-%m-%dT%H:%M:%S.000Z")
+        start = fluxTime(parseTimestamp(start)[0])
     else:
         start = "-10"
     if stop:
-        stop = datetime.strptime(stop, "%Y-%m-%dT%H:%M:%SZ").strftime("%Y-%m-%dT%H:%M:%S.000Z")
+        stop = fluxTime(parseTimestamp(stop)[0])
     else:
-        stop = datetime.strftime(datetime.now(),"%Y-%m-%dT%H:%M:%S.000Z")
+        stop = fluxTime(time.time_ns())
     range = f'range(start: {start}, stop: {stop})'
 
     query += f"|> {range}"
+    query += f'|> filter(fn:(r) => r._measurement == {fluxString(MEASUREMENT)})'
     if topic:
-        topic = f'filter(fn:(r) => r["topic"] == "{topic}")'
-        query += f"|> {topic}"
+        query += f'|> filter(fn:(r) => r["topic"] == {fluxString(topic)})'
 
     if generator_id:
-        generator_id = f'filter(fn:(r) => r["generator_id"] == "{generator_id}")'
-        query += f"|> {generator_id}"
+        query += f'|> filter(fn:(r) => r["generator_id"] == {fluxString(generator_id)})'
+
+    if not select:
+        return query
+
+    desc = bool(page and page["desc"])
+    if page and page["after"]:
+        # Only the records after the key of the cursor, in the order of the page
+        ns, after_topic, after_generator_id = page["after"]
+        op = "<" if desc else ">"
+        query += f'|> filter(fn:(r) => r._time {op} {fluxTime(ns)} or (r._time == {fluxTime(ns)} and (r.topic {op} {fluxString(after_topic)}'
+        query += f' or (r.topic == {fluxString(after_topic)} and r.generator_id {op} {fluxString(after_generator_id)}))))'
+
+    # Selects the data string, or the numeric fields joined in a row per point
+    query += fieldFilter(fields)
+    if fields or not STORE_RAW_DATA:
+        query += '|> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")'
+    if sort:
+        query += f'|> group() |> sort(columns: ["_time", "topic", "generator_id"], desc: {"true" if desc else "false"})'
+    if page and page["limit"]:
+        # A record more tells if there is a next page, the cursor needs the timestamp in nanoseconds
+        query += f'|> limit(n: {page["limit"] + 1}) |> map(fn:(r) => ({{r with _ns: int(v: r._time)}}))'
+    return query
+
+#Builds the filter selecting the requested numeric fields, or else the data string
+def fieldFilter(fields=None):
+    if fields:
+        return '|> filter(fn:(r) => ' + ' or '.join(f'r._field == {fluxString(f)}' for f in fields) + ')'
+    if STORE_RAW_DATA:
+        return f'|> filter(fn:(r) => r._field == {fluxString(RAW_FIELD)})'
+    return ''
+
+#Takes an InfluxDB record and create the record for the response
+def recordToDict(record):
+    timestamp = formatTime(receivedTime(record.get_time(), record.values.get(DIGITS_TAG)))
+    data = record.get_value() if "_value" in record.values else pivotedData(record.values)
+    return {"timestamp":timestamp,"data":data,"topic":record.values["topic"],"generator_id":record.values["generator_id"]}
+
+#Takes the columns of a point with a column per field and rebuilds its data string
+def pivotedData(values):
+    if values.get(RAW_FIELD) is not None:
+        return values[RAW_FIELD]
+    data = {}
+    for name, value in values.items():
+        if value is None or name.startswith("_") or name in TAGS or name in ("result", "table") or name.endswith(UNIT_TAG_SUFFIX):
+            continue
+        data[name] = {"value": value, "unit": values.get(name + UNIT_TAG_SUFFIX)}
+    return str(data)
+
+#TIME BOUNDS OF A QUERY
+'''
+The payload is the same of /query. The response has the timestamps of the first and the last record matching the query:
+{
+    "start": string formatted in ISO 8601 YYYY:MM:DDTHH:MM:SSZ,
+    "stop": string formatted in ISO 8601 YYYY:MM:DDTHH:MM:SSZ
+}
+If no record matches the query the response has status code 404.
+'''
+@app.route("/bounds", methods=["POST"])
+def bounds():
+    try:
+        msg = request.get_json()
+        if not msg:
+            return make_response("Empty query", 404)
+        query = buildQuery(f'from(bucket:"{bucket}")', msg.get("start",None), msg.get("stop",None), msg.get("topic",None), msg.get("generator_id",None), select=False)
+        query = f'data = {query} |> keep(columns: ["_time", {fluxString(DIGITS_TAG)}]) |> group() |> map(fn:(r) => ({{r with _value: int(v: r._time)}}))\n'
+        query += 'data |> min() |> yield(name: "start")\ndata |> max() |> yield(name: "stop")\n'
+        debugSample('Bounds query: %s', query)
+        result = {}
+        with FLUX_QUERY_SECONDS.labels("bounds").time():
+            tables = client.query_api().query(org=org, query=query)
+        for table in tables:
+            for record in table.records:
+                result[record.values["result"]] = formatTime(receivedTime(nsTime(record.get_value()), record.values.get(DIGITS_TAG)))
+        if len(result) < 2:
+            return make_response("", 404)
+        return make_response(jsonify(result), 200)
+    except Exception as e:
+        if isinstance(e, influxdb_client.exceptions.APIException):
+            if 'error in building plan while starting program: cannot query an empty range' in repr(e):
+                return make_response("No data in the time window.", 404)
+        ERRORS.labels("bounds").inc()
+        app.logger.error(repr(e))
+        return make_response(repr(e), 400)
+
+#Streams the encoded and compressed records of a query
+def streamQuery(chunks, format, compression, cursor=None):
+    response = Response(stream_with_context(chunks), mimetype=QUERY_FORMATS[format])
+    if format != "parquet":
+        response.headers['Content-Encoding'] = compression
+    if cursor:
+        response.headers['X-Next-Cursor'] = cursor
+    return response
+
+#Encodes the records in the format of the response and compresses them
+def encodedChunks(records, format, compression, fields=None):
+    if format == "parquet":
+        # The columns of a Parquet file are compressed by the writer
+        return bufferedChunks(parquetChunks(records, fields, compression))
+    if format == "arrow":
+        chunks = arrowChunks(records, fields)
+    elif format == "ndjson":
+        chunks = ndjsonChunks(records)
+    else:
+        chunks = jsonArrayChunks(records)
+    return zstdChunks(chunks) if compression == "zstd" else gzipChunks(chunks)
+
+#Encodes the records as the elements of a JSON array
+def jsonArrayChunks(records):
+    watch = Stopwatch(ENCODE_SECONDS.labels("json"))
+    try:
+        yield b'['
+        separator = b''
+        for record in records:
+            with watch:
+                chunk = separator + json.dumps(recordToDict(record)).encode('utf8')
+            yield chunk
+            separator = b','
+        yield b']'
+    finally:
+        watch.observe()
+
+#Encodes the records as JSON lines
+def ndjsonChunks(records):
+    watch = Stopwatch(ENCODE_SECONDS.labels("ndjson"))
+    try:
+        for record in records:
+            with watch:
+                chunk = json.dumps(recordToDict(record)).encode('utf8') + b'\n'
+            yield chunk
+    finally:
+        watch.observe()
+
+#Compresses the chunks incrementally, emitting a gzip member readable as a single file
+def gzipChunks(chunks):
+    watch = Stopwatch(COMPRESS_SECONDS.labels("gzip"))
+    try:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+        buffer = []
+        size = 0
+        for chunk in chunks:
+            buffer.append(chunk)
+            size += len(chunk)
+            if size >= STREAM_CHUNK_SIZE:
+                with watch:
+                    out = compressor.compress(b''.join(buffer))
+                buffer = []
+                size = 0
+                if out:
+                    yield out
+        with watch:
+            out = compressor.compress(b''.join(buffer)) + compressor.flush()
+        yield out
+    finally:
+        watch.observe()
+
+#Compresses the chunks incrementally as a single zstd frame
+def zstdChunks(chunks):
+    watch = Stopwatch(COMPRESS_SECONDS.labels("zstd"))
+    try:
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        for chunk in bufferedChunks(chunks):
+            with watch:
+                out = compressor.compress(chunk)
+            if out:
+                yield out
+        with watch:
+            out = compressor.flush()
+        yield out
+    finally:
+        watch.observe()
+
+#Joins the chunks in chunks of at least STREAM_CHUNK_SIZE bytes
+def bufferedChunks(chunks):
+    buffer = []
+    size = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= STREAM_CHUNK_SIZE:
+            yield b''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield b''.join(buffer)
+
+#Returns the Arrow schema of the records of a query, with a column per field if the query selects fields
+def columnarSchema(fields):
+    columns = [("timestamp", pa.timestamp("us", tz="UTC")), ("topic", pa.string()), ("generator_id", pa.string())]
+    if fields:
+        for field in fields:
+            columns += [(field, pa.float64()), (field + UNIT_TAG_SUFFIX, pa.string())]
+    else:
+        columns.append((RAW_FIELD, pa.string()))
+    return pa.schema(columns)
+
+#Takes InfluxDB records and creates an Arrow record batch
+def recordBatch(records, schema, fields):
+    columns = [
+        [receivedTime(record.get_time(), record.values.get(DIGITS_TAG)) for record in records],
+        [record.values["topic"] for record in records],
+        [record.values["generator_id"] for record in records]
+    ]
+    if fields:
+        for field in fields:
+            columns.append([record.values.get(field) for record in records])
+            columns.append([record.values.get(field + UNIT_TAG_SUFFIX) for record in records])
+    else:
+        columns.append([record.get_value() if "_value" in record.values else pivotedData(record.values) for record in records])
+    return pa.record_batch(columns, schema=schema)
+
+#Collects the bytes written by an Arrow or Parquet writer, to send them while the records are encoded
+class ChunkSink:
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+#Encodes the records as an Arrow IPC stream, a record batch every COLUMNAR_BATCH_ROWS records
+def arrowChunks(records, fields):
+    watch = Stopwatch(ENCODE_SECONDS.labels("arrow"))
+    try:
+        schema = columnarSchema(fields)
+        sink = ChunkSink()
+        with pa.ipc.new_stream(sink, schema) as writer:
+            for batch in iter(lambda: list(itertools.islice(records, COLUMNAR_BATCH_ROWS)), []):
+                with watch:
+                    writer.write_batch(recordBatch(batch, schema, fields))
+                yield sink.drain()
+        yield sink.drain()
+    finally:
+        watch.observe()
+
+#Encodes the records as a Parquet file, a row group every COLUMNAR_BATCH_ROWS records
+#The encoding time includes the compression of the columns
+def parquetChunks(records, fields, compression):
+    watch = Stopwatch(ENCODE_SECONDS.labels("parquet"))
+    try:
+        schema = columnarSchema(fields)
+        sink = ChunkSink()
+        with pa.parquet.ParquetWriter(sink, schema, compression=compression) as writer:
+            for batch in iter(lambda: list(itertools.islice(records, COLUMNAR_BATCH_ROWS)), []):
+                with watch:
+                    writer.write_batch(recordBatch(batch, schema, fields))
+                yield sink.drain()
+        yield sink.drain()
+    finally:
+        watch.observe()
+
+
+#AGGREGATE IN DB
+'''
+Aggregates in InfluxDB the values of a numeric field, for data stored with a field per measured quantity
+and its unit in the tag <field>_unit. The payload must be a JSON with the following structure:
+{
+    "start": string formatted in ISO 8601 YYYY:MM:DDTHH:MM:SSZ,
+    "stop": string formatted in ISO 8601 YYYY:MM:DDTHH:MM:SSZ,
+    "topic": string (optional),
+    "generator_id": string (optional),
+    "field": string,
+    "fun": "sum" | "avg" | "min" | "max" | "count",
+    "frequency": int (optional, minutes of the time buckets, aligned to start),
+    "conversions": {unit: [factor, offset]}
+}
+Only the values having one of the units in "conversions" are aggregated, after converting them to value * factor + offset.
+The response is a JSON array of {"timestamp": end of the bucket, "value": float}, sorted by timestamp.
+Without frequency the array has a single element with timestamp stop.
+'''
+@app.route("/aggregate", methods=["POST"])
+def aggregate():
+    try:
+        msg = request.get_json()
+        if not msg:
+            return make_response("Empty query", 404)
+        query = buildAggregateQuery(msg)
+        debugSample('Aggregate query: %s', query)
+        with FLUX_QUERY_SECONDS.labels("aggregate").time():
+            result = client.query_api().query(org=org, query=query)
+        stop = msg["stop"]
+        values = []
+        for table in result:
+            for record in table.records:
+                if record.get_value() is None:
+                    continue
+                timestamp = stop if msg.get("frequency") is None else formatTime(record.get_time())
+                values.append({"timestamp": timestamp, "value": float(record.get_value())})
+        if not values:
+            return make_response("", 404)
+        values.sort(key=lambda v: v["timestamp"])
+        return make_response(jsonify(values), 200)
+    except Exception as e:
+        if isinstance(e, influxdb_client.exceptions.APIException):
+            if 'error in building plan while starting program: cannot query an empty range' in repr(e):
+                return make_response("No data in the time window.", 404)
+        ERRORS.labels("aggregate").inc()
+        app.logger.error(repr(e))
+        return make_response(repr(e), 400)
+
+#Flux aggregation functions
+flux_functions = {"sum": "sum", "avg": "mean", "min": "min", "max": "max", "count": "count"}
+
+#Quotes a string as a Flux string literal
+def fluxString(s):
+    return json.dumps(str(s), ensure_ascii=False).replace("${", "\\${")
+
+#Builds the Flux query aggregating a numeric field
+def buildAggregateQuery(msg):
+    fun = flux_functions[msg["fun"]]
+    field = msg["field"]
+    conversions = msg["conversions"]
+    frequency = msg.get("frequency", None)
+    if not conversions:
+        raise ValueError("Missing conversions")
+    start_ns = parseTimestamp(msg["start"])[0]
+    stop_ns = parseTimestamp(msg["stop"])[0]
+    unit = f'r[{fluxString(field + UNIT_TAG_SUFFIX)}]'
+
+    query = f'from(bucket:{fluxString(bucket)})'
+    # The stop is included in the last bucket
+    query += f'|> range(start: {fluxTime(start_ns)}, stop: {fluxTime(stop_ns + 1)})'
+    query += f'|> filter(fn:(r) => r._measurement == {fluxString(MEASUREMENT)} and r._field == {fluxString(field)})'
+    if msg.get("topic"):
+        query += f'|> filter(fn:(r) => r["topic"] == {fluxString(msg["topic"])})'
+    if msg.get("generator_id"):
+        query += f'|> filter(fn:(r) => r["generator_id"] == {fluxString(msg["generator_id"])})'
+    query += '|> filter(fn:(r) => ' + ' or '.join(f'{unit} == {fluxString(u)}' for u in conversions) + ')'
+    # Converts all the values to the target unit
+    value = 'float(v: r._value)'
+    converted = value
+    for u, (factor, offset) in conversions.items():
+        converted = f'if {unit} == {fluxString(u)} then {value} * {float(factor)!r} + {float(offset)!r} else {converted}'
+    query += '|> group()'
+    query += f'|> map(fn:(r) => ({{_time: r._time, _start: r._start, _stop: r._stop, _value: {converted}}}))'
+    if frequency is None:
+        query += f'|> {fun}()'
+    else:
+        every = int(frequency) * 60 * 10**9
+        query += f'|> aggregateWindow(every: {every}ns, offset: {start_ns % every}ns, fn: {fun}, createEmpty: false, timeSrc: "_stop")'
     return query
 
-#Takes the query result and create a list of records for the response
-def extractResults(result):
-    results = []
-    for table in result:
+
+
+#ROLLUPS
+'''
+The partial aggregates (count, sum, min, max) of the numeric fields are kept per topic, generator, field, unit
+and minute in the measurement "rollup", so the aggregations over closed time windows merge them instead of
+reading the raw data. They are computed from the raw data, so a reading received twice is counted once:
+the first time a block of an hour of a topic is queried all its minutes are computed and the block is marked
+in the measurement "rollup_coverage", then every worker updates the minutes in which it writes points.
+'''
+
+#Minutes of each topic written since the last update of the partial aggregates, {topic: set of minutes}
+rollup_dirty = {}
+rollup_lock = threading.Lock()
+rollup_updater = None
+
+#Marks the minutes of the written points, their partial aggregates are updated by the background updater
+def markRollups(series):
+    global rollup_updater
+    with rollup_lock:
+        for topic, ns in series:
+            if topic is not None:
+                rollup_dirty.setdefault(topic, set()).add(ns - ns % ROLLUP_RESOLUTION)
+        if rollup_updater is None:
+            rollup_updater = threading.Thread(target=updateRollups, daemon=True)
+            rollup_updater.start()
+
+#Updates the partial aggregates of the written minutes every ROLLUP_INTERVAL seconds
+def updateRollups():
+    while True:
+        time.sleep(ROLLUP_INTERVAL)
+        with rollup_lock:
+            dirty = dict(rollup_dirty)
+            rollup_dirty.clear()
+        for topic, minutes in dirty.items():
+            try:
+                for start_ns, stop_ns in spans(sorted(minutes), ROLLUP_RESOLUTION):
+                    computeRollups(topic, start_ns, stop_ns)
+            except Exception as e:
+                ERRORS.labels("rollup_update").inc()
+                logging.error('Cannot update the partial aggregates of %s: %r', topic, e)
+                with rollup_lock:
+                    rollup_dirty.setdefault(topic, set()).update(minutes)
+
+#Groups the sorted starts of consecutive windows of the given size in spans [start, stop) of at most ROLLUP_MAX_SPAN
+def spans(starts, size):
+    span_start = span_stop = None
+    for start in starts:
+        if span_start is not None and start == span_stop and span_stop - span_start < ROLLUP_MAX_SPAN:
+            span_stop += size
+            continue
+        if span_start is not None:
+            yield span_start, span_stop
+        span_start, span_stop = start, start + size
+    if span_start is not None:
+        yield span_start, span_stop
+
+#Computes from the raw data the partial aggregates of the minutes of a topic in [start_ns, stop_ns) and writes them
+def computeRollups(topic, start_ns, stop_ns):
+    query = f'data = from(bucket:{fluxString(bucket)}) |> range(start: {fluxTime(start_ns)}, stop: {fluxTime(stop_ns)})'
+    query += f'|> filter(fn:(r) => r._measurement == {fluxString(MEASUREMENT)} and r["topic"] == {fluxString(topic)} and r._field != {fluxString(RAW_FIELD)})\n'
+    for fun in ("count", "sum", "min", "max"):
+        query += f'data |> aggregateWindow(every: {ROLLUP_RESOLUTION}ns, fn: {fun}, createEmpty: false, timeSrc: "_start") |> yield(name: "{fun}")\n'
+    # A field is split in several series when the points have different tags, their aggregates are merged
+    partials = {}
+    with FLUX_QUERY_SECONDS.labels("rollup_compute").time():
+        tables = client.query_api().query(org=org, query=query)
+    for table in tables:
+        for record in table.records:
+            if record.get_value() is None:
+                continue
+            field = record.get_field()
+            minute = calendar.timegm(record.get_time().utctimetuple()) * 10**9
+            key = (record.values["generator_id"], field, record.values.get(field + UNIT_TAG_SUFFIX), minute)
+            partial = partials.setdefault(key, {})
+            fun = record.values["result"]
+            value = record.get_value()
+            if fun not in partial:
+                partial[fun] = value
+            elif fun in ("count", "sum"):
+                partial[fun] += value
+            else:
+                partial[fun] = min(partial[fun], value) if fun == "min" else max(partial[fun], value)
+    points = []
+    for (generator_id, field, unit, minute), partial in partials.items():
+        p = influxdb_client.Point(ROLLUP_MEASUREMENT).time(minute, WritePrecision.NS).tag("topic", topic).tag("generator_id", generator_id).tag("field", field)
+        if unit is not None:
+            p.tag("unit", unit)
+        p.field("count", int(partial["count"])).field("sum", float(partial["sum"])).field("min", float(partial["min"])).field("max", float(partial["max"]))
+        points.append(p)
+    for i in range(0, len(points), WRITE_BATCH_SIZE):
+        sync_write_api.write(bucket=bucket, org=org, record=points[i:i + WRITE_BATCH_SIZE])
+    return len(points)
+
+#Computes the partial aggregates of the blocks of a topic in [start_ns, stop_ns) never computed before
+def ensureRollups(topic, start_ns, stop_ns):
+    start_ns -= start_ns % ROLLUP_BLOCK
+    query = f'from(bucket:{fluxString(bucket)}) |> range(start: {fluxTime(start_ns)}, stop: {fluxTime(stop_ns)})'
+    query += f'|> filter(fn:(r) => r._measurement == {fluxString(ROLLUP_COVERAGE_MEASUREMENT)} and r["topic"] == {fluxString(topic)})'
+    query += '|> keep(columns: ["_time", "_value"])'
+    covered = set()
+    for table in client.query_api().query(org=org, query=query):
         for record in table.records:
-            time = record.get_time().strftime("%Y-%m-%dT%H:%M:%SZ")
-            results.append({"timestamp":time,"data":record.get_value(),"topic":record.values["topic"],"generator_id":record.values["generator_id"]})
-    return results
+            covered.add(calendar.timegm(record.get_time().utctimetuple()) * 10**9)
+    missing = [block for block in range(start_ns, stop_ns, ROLLUP_BLOCK) if block not in covered]
+    for span_start, span_stop in spans(missing, ROLLUP_BLOCK):
+        computed = computeRollups(topic, span_start, span_stop)
+        markers = [influxdb_client.Point(ROLLUP_COVERAGE_MEASUREMENT).time(block, WritePrecision.NS).tag("topic", topic).field("complete", True)
+                   for block in range(span_start, span_stop, ROLLUP_BLOCK)]
+        sync_write_api.write(bucket=bucket, org=org, record=markers)
+        app.logger.info('Computed %d partial aggregates of %s in [%s, %s)', computed, topic, fluxTime(span_start), fluxTime(span_stop))
+
+#ROLLUP QUERY
+'''
+Merges the partial aggregates of a numeric field in the closed minutes of a time window. The payload must be a JSON with the following structure:
+{
+    "start": string formatted in ISO 8601 YYYY:MM:DDTHH:MM:SSZ, at the start of a minute,
+    "stop": string formatted in ISO 8601 YYYY:MM:DDTHH:MM:SSZ,
+    "topic": string,
+    "generator_id": string (optional),
+    "field": string,
+    "units": list of strings (the units of the values to aggregate),
+    "frequency": int (optional, minutes of the time buckets, aligned to start)
+}
+The partial aggregates cover the window from start to "until", the data from "until" to stop must be read from the raw data:
+{
+    "until": string formatted in ISO 8601 YYYY:MM:DDTHH:MM:SSZ,
+    "buckets": [{"start": start of the bucket, "unit": string, "count": int, "sum": float, "min": float, "max": float}],
+    "numeric": bool
+}
+Without frequency there is a bucket per unit with the start of the window.
+"numeric" is false when the partial aggregates cannot answer the query: the numeric fields are not stored, or the field
+has no numeric values in the units in the window covered (e.g. the data is not in the POLIMI data format),
+so the aggregation must read the raw data.
+'''
+@app.route("/rollup", methods=["POST"])
+def rollup():
+    try:
+        msg = request.get_json()
+        if not msg:
+            return make_response("Empty query", 404)
+        start_ns = parseTimestamp(msg["start"])[0]
+        stop_ns = parseTimestamp(msg["stop"])[0]
+        topic = msg["topic"]
+        until_ns = rollupEnd(start_ns, stop_ns)
+        if not STORE_NUMERIC_FIELDS:
+            return make_response(jsonify(until=msg["start"], buckets=[], numeric=False), 200)
+        if not ROLLUPS or not topic or until_ns <= start_ns:
+            return make_response(jsonify(until=msg["start"], buckets=[], numeric=True), 200)
+        ensureRollups(topic, start_ns, -(-until_ns // ROLLUP_BLOCK) * ROLLUP_BLOCK)
+        query = buildRollupQuery(msg, start_ns, until_ns)
+        debugSample('Rollup query: %s', query)
+        buckets = {}
+        with FLUX_QUERY_SECONDS.labels("rollup").time():
+            tables = client.query_api().query(org=org, query=query)
+        for table in tables:
+            for record in table.records:
+                if record.get_value() is None:
+                    continue
+                key = (formatTime(record.get_time()), record.values["unit"])
+                buckets.setdefault(key, {"start": key[0], "unit": key[1]})[record.values["result"]] = record.get_value()
+        buckets = [b for b in buckets.values() if b.get("count")]
+        return make_response(jsonify(until=formatTime(nsTime(until_ns)), buckets=buckets, numeric=bool(buckets)), 200)
+    except Exception as e:
+        if isinstance(e, influxdb_client.exceptions.APIException):
+            if 'error in building plan while starting program: cannot query an empty range' in repr(e):
+                return make_response("No data in the time window.", 404)
+        ERRORS.labels("rollup").inc()
+        app.logger.error(repr(e))
+        return make_response(repr(e), 400)
+
+#End of the part of [start_ns, stop_ns) covered by the partial aggregates of the closed minutes
+def rollupEnd(start_ns, stop_ns):
+    if start_ns % ROLLUP_RESOLUTION:
+        return start_ns
+    closed = time.time_ns() - ROLLUP_DELAY * 10**9
+    until_ns = min(stop_ns, closed)
+    until_ns -= until_ns % ROLLUP_RESOLUTION
+    # The block of until must be closed to be computed
+    if -(-until_ns // ROLLUP_BLOCK) * ROLLUP_BLOCK > closed:
+        until_ns -= until_ns % ROLLUP_BLOCK
+    return max(until_ns, start_ns)
+
+#Builds the Flux query merging the partial aggregates of a field in [start_ns, until_ns)
+def buildRollupQuery(msg, start_ns, until_ns):
+    query = f'data = from(bucket:{fluxString(bucket)}) |> range(start: {fluxTime(start_ns)}, stop: {fluxTime(until_ns)})'
+    query += f'|> filter(fn:(r) => r._measurement == {fluxString(ROLLUP_MEASUREMENT)} and r["topic"] == {fluxString(msg["topic"])} and r["field"] == {fluxString(msg["field"])})'
+    if msg.get("generator_id"):
+        query += f'|> filter(fn:(r) => r["generator_id"] == {fluxString(msg["generator_id"])})'
+    query += '|> filter(fn:(r) => ' + ' or '.join(f'r["unit"] == {fluxString(u)}' for u in msg["units"]) + ')'
+    query += '|> group(columns: ["unit", "_field"])\n'
+    frequency = msg.get("frequency", None)
+    for field, fun in (("count", "sum"), ("sum", "sum"), ("min", "min"), ("max", "max")):
+        query += f'data |> filter(fn:(r) => r._field == "{field}")'
+        if frequency is None:
+            query += f'|> {fun}() |> map(fn:(r) => ({{r with _time: {fluxTime(start_ns)}}}))'
+        else:
+            every = int(frequency) * 60 * 10**9
+            query += f'|> aggregateWindow(every: {every}ns, offset: {start_ns % every}ns, fn: {fun}, createEmpty: false, timeSrc: "_start")'
+        query += f'|> yield(name: "{field}")\n'
+    return query
@@ -0,0 +1,14 @@
+from gunicorn_base import *
+
+#GUNICORN CONFIGURATION OF THE DATABASE MANAGER
+'''
+Every worker has its own InfluxDB client, write pipeline and query thread pool. A streamed query keeps its thread
+until the response is sent. A stopping worker flushes its queued points (atexit in db_manager) within graceful_timeout.
+'''
+bind = env("SERVER_PORT", "0.0.0.0:50000")
+workers = env("GUNICORN_WORKERS", 6)
+threads = env("GUNICORN_THREADS", 16)
+
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus_dbmanager")
+# Sizes the pool reading the shards of the queries of a worker
+os.environ["REQUEST_THREADS"] = str(threads)
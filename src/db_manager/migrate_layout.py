@@ -0,0 +1,145 @@
+from argparse import ArgumentParser
+from datetime import datetime, timedelta, timezone
+import logging, sys
+from influxdb_client.client.write_api import SYNCHRONOUS
+from db_manager import client, org, bucket, buildPoint, pivotedData, fluxString, MEASUREMENT, DIGITS_TAG
+
+#MIGRATION TO THE STORAGE LAYOUT WITHOUT THE id TAG
+'''
+Rewrites the points of a bucket with the current storage layout: no id tag (a series per topic and generator),
+nanosecond timestamps with a deterministic tiebreak below the last digit of the timestamp and, if enabled, numeric fields.
+The points are read and written in time chunks, so the migration can run while ODA is running and can be
+repeated on the same window: a point always gets the same timestamp and overwrites its previous copy.
+
+Run it inside the dbmanager container, e.g.:
+    docker exec dbmanager python3 migrate_layout.py --target mybucket_v2
+then set db_bucket=mybucket_v2 in the .env file and restart ODA.
+With --in-place the bucket is rewritten through a temporary bucket and the old points are deleted,
+the points received while a chunk is rewritten may be lost, so prefer it on windows in the past.
+'''
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+WRITE_BATCH_SIZE = 5000
+
+parser = ArgumentParser(prog='migrate_layout.py', description='Rewrite an ODA bucket with the storage layout without the id tag.')
+parser.add_argument('--source', '-s', help='Bucket to migrate', default=bucket)
+parser.add_argument('--target', '-t', help='Bucket receiving the migrated points (created if missing)', default=None)
+parser.add_argument('--in-place', action='store_true', help='Rewrite the source bucket, deleting the old points')
+parser.add_argument('--start', help='Start of the window to migrate, ISO 8601 YYYY-MM-DDTHH:MM:SSZ', default='1970-01-01T00:00:00Z')
+parser.add_argument('--stop', help='Stop of the window to migrate, ISO 8601 YYYY-MM-DDTHH:MM:SSZ (default: now)', default=None)
+parser.add_argument('--chunk-hours', type=int, help='Hours of data read with a single query', default=24)
+
+#Returns the chunks [start, stop) of the window
+def chunks(start, stop, hours):
+    step = timedelta(hours=hours)
+    while start < stop:
+        yield start, min(start + step, stop)
+        start += step
+
+def isoformat(dt):
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+#Returns the timestamp of a point as received: with the digits of its tag, without the tiebreak, or for the points
+#stored with the previous layout with the fraction of second up to its last non zero digit
+def receivedTimestamp(values):
+    seconds, nanoseconds = divmod(values["_ns"], 10**9)
+    fraction = f"{nanoseconds:09d}"
+    digits = values.get(DIGITS_TAG)
+    fraction = fraction[:int(digits)] if digits is not None else fraction.rstrip("0")
+    text = datetime.fromtimestamp(seconds, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+    return text + ("." + fraction if fraction else "") + "Z"
+
+#Returns the start of the first chunk holding data, so that empty years are not scanned
+def firstTimestamp(source, start, stop):
+    query = f'from(bucket:{fluxString(source)}) |> range(start: {isoformat(start)}, stop: {isoformat(stop)})'
+    query += f'|> filter(fn:(r) => r._measurement == {fluxString(MEASUREMENT)}) |> group() |> first(column: "_time")'
+    for table in client.query_api().query(org=org, query=query):
+        for record in table.records:
+            return record.get_time().replace(second=0, microsecond=0)
+    return None
+
+#Copies the points of a chunk from source to target with the current layout, returns the number of points
+def copyChunk(source, target, start, stop, write_api):
+    query = f'from(bucket:{fluxString(source)}) |> range(start: {isoformat(start)}, stop: {isoformat(stop)})'
+    query += f'|> filter(fn:(r) => r._measurement == {fluxString(MEASUREMENT)})'
+    query += '|> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")'
+    query += '|> map(fn:(r) => ({r with _ns: int(v: r._time)}))'
+    points = []
+    copied = 0
+    for record in client.query_api().query_stream(org=org, query=query):
+        points.append(buildPoint({
+            "timestamp": receivedTimestamp(record.values),
+            "topic": record.values["topic"],
+            "generator_id": record.values["generator_id"],
+            "data": pivotedData(record.values)
+        }))
+        if len(points) >= WRITE_BATCH_SIZE:
+            write_api.write(bucket=target, org=org, record=points)
+            copied += len(points)
+            points = []
+    if points:
+        write_api.write(bucket=target, org=org, record=points)
+        copied += len(points)
+    return copied
+
+#Copies the window from source to target chunk by chunk
+def copy(source, target, start, stop, hours):
+    write_api = client.write_api(write_options=SYNCHRONOUS)
+    first = firstTimestamp(source, start, stop)
+    if first is None:
+        logging.info(f"No data to migrate in {source}")
+        return 0
+    total = 0
+    for chunk_start, chunk_stop in chunks(max(start, first), stop, hours):
+        copied = copyChunk(source, target, chunk_start, chunk_stop, write_api)
+        total += copied
+        logging.info(f"{source} -> {target}: {copied} points in [{isoformat(chunk_start)}, {isoformat(chunk_stop)})")
+    return total
+
+#Rewrites the window of source chunk by chunk: the chunk is copied to temp, deleted from source and copied back
+#If the migration stops after deleting a chunk, its points are still in temp and running it again restores them
+def rewrite(source, temp, start, stop, hours):
+    write_api = client.write_api(write_options=SYNCHRONOUS)
+    first = firstTimestamp(source, start, stop)
+    if first is None:
+        logging.info(f"No data to migrate in {source}")
+        return 0
+    total = 0
+    for chunk_start, chunk_stop in chunks(max(start, first), stop, hours):
+        copyChunk(source, temp, chunk_start, chunk_stop, write_api)
+        # The delete window includes its stop, the last deleted nanosecond is the one before chunk_stop
+        last = (chunk_stop - timedelta(microseconds=1)).strftime("%Y-%m-%dT%H:%M:%S.%f") + "999Z"
+        client.delete_api().delete(isoformat(chunk_start), last, f'_measurement="{MEASUREMENT}"', bucket=source, org=org)
+        copied = copyChunk(temp, source, chunk_start, chunk_stop, write_api)
+        total += copied
+        logging.info(f"{source}: {copied} points rewritten in [{isoformat(chunk_start)}, {isoformat(chunk_stop)})")
+    return total
+
+#Returns the bucket with the given name, creating it if missing
+def ensureBucket(name):
+    buckets_api = client.buckets_api()
+    found = buckets_api.find_bucket_by_name(name)
+    if found is None:
+        logging.info(f"Creating bucket {name}")
+        found = buckets_api.create_bucket(bucket_name=name, org=org)
+    return found
+
+def main():
+    args = parser.parse_args()
+    start = datetime.strptime(args.start, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
+    stop = datetime.strptime(args.stop, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc) if args.stop else datetime.now(timezone.utc)
+    if args.in_place == bool(args.target):
+        parser.error("specify either --target or --in-place")
+    if not args.in_place:
+        ensureBucket(args.target)
+        total = copy(args.source, args.target, start, stop, args.chunk_hours)
+        logging.info(f"Migrated {total} points from {args.source} to {args.target}")
+        return
+    temp = ensureBucket(args.source + "_migration")
+    total = rewrite(args.source, temp.name, start, stop, args.chunk_hours)
+    logging.info(f"Rewritten {total} points of {args.source}")
+    client.buckets_api().delete_bucket(temp)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,15 @@
+from gunicorn_base import *
+
+#GUNICORN CONFIGURATION OF THE QUERY AGGREGATOR
+'''
+The aggregations are CPU bound, the aggregations of different workers run in parallel while the other threads
+wait for the Database Manager. The workers are set by GUNICORN_WORKERS (at most one per CPU given to the container),
+not by the CPUs of the host, which the container may not be allowed to use.
+'''
+bind = env("SERVER_PORT", "0.0.0.0:50001")
+workers = env("GUNICORN_WORKERS", 2)
+threads = env("GUNICORN_THREADS", 4)
+timeout = env("GUNICORN_TIMEOUT", 300)
+graceful_timeout = env("GUNICORN_GRACEFUL_TIMEOUT", 60)
+
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus_queryaggregator")
@@ -1,211 +1,804 @@
 from flask import Flask, request, make_response, jsonify
-import logging, sys, os, requests, json, gzip, statistics
+import logging, sys, os, requests, json, gzip, statistics, math
 from requests.exceptions import HTTPError
 from datetime import datetime, timedelta, timezone
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from prometheus_client import Counter, Histogram
+from service_metrics import instrument, debugSample
 
 #CONFIGURATION
 DB_MANAGER_PORT= os.environ["DB_MANAGER_PORT"]
 DB_MANAGER_URL = "http://dbmanager:"+DB_MANAGER_PORT
+#AGGREGATE IN THE DB WHEN THE DATA IS STORED AS NUMERIC FIELDS, FALLING BACK TO THE RAW DATA OTHERWISE
+PUSHDOWN = os.environ.get("AGGREGATION_PUSHDOWN", "false").lower() == "true"
+#MERGE THE PARTIAL AGGREGATES KEPT BY THE DB SERVICE FOR THE CLOSED MINUTES, READING THE RAW DATA ONLY FOR THE OPEN ONES
+ROLLUPS = os.environ.get("AGGREGATION_ROLLUPS", "false").lower() == "true"
+#ENGINE AGGREGATING THE RAW DATA: "numpy" WITH VECTOR OPERATIONS ON COLUMNS OF VALUES, "python" WITH A LOOP PER BUCKET,
+#"stream" WHILE THE RECORDS ARE RECEIVED, KEEPING IN MEMORY ONLY THE PARTIAL AGGREGATES OF THE BUCKETS
+ENGINE = os.environ.get("AGGREGATION_ENGINE", "python").lower()
+STREAM_CHUNK_SIZE = 64 * 1024 #BYTES READ AT ONCE FROM A STREAMED RESPONSE
+SKETCH_ACCURACY = float(os.environ.get("SKETCH_ACCURACY", "0.01")) #RELATIVE ERROR OF THE PERCENTILES COMPUTED WHILE STREAMING
+SKETCH_MAX_BINS = 2048 #MAX NUMBER OF BINS OF A SKETCH, THE SMALLEST VALUES ARE MERGED BEYOND IT
+STREAM_PARTITIONS = int(os.environ.get("STREAM_PARTITIONS", "4")) #SLICES OF A WINDOW READ AT THE SAME TIME BY THE stream ENGINE
+
+#LOGGING CONFIGURATION
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
 
 app = Flask(__name__)
-logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+logging.basicConfig(stream=sys.stdout, level=LOG_LEVEL)
+
+#METRICS
+REQUEST_SECONDS = Histogram("queryaggregator_request_seconds", "Time to answer a request", ["endpoint", "status"])
+UPSTREAM_SECONDS = Histogram("queryaggregator_upstream_seconds", "Time to the response headers of the DB service", ["path", "status"])
+AGGREGATION_SECONDS = Histogram("queryaggregator_aggregation_seconds", "Time to aggregate the data of a query, reading it from the DB service", ["path"])
+ENCODE_SECONDS = Histogram("queryaggregator_encode_seconds", "Time to encode the JSON of a response")
+COMPRESS_SECONDS = Histogram("queryaggregator_compress_seconds", "Time to compress a response with gzip")
+ERRORS = Counter("queryaggregator_errors", "Failed requests", ["kind"])
+instrument(app, REQUEST_SECONDS)
+
+# Percentiles, as the fraction of the values below them
+percentiles = {"p50": 0.5, "p95": 0.95, "p99": 0.99}
 
-# Supported aggregation functions
+# Supported aggregation functions, taking the values of a bucket and their timestamps
 agg_functions = {
-    "sum": sum,
-    "avg": statistics.mean,
-    "min": min,
-    "max": max
+    "sum": lambda values, times: sum(values),
+    "avg": lambda values, times: statistics.mean(values),
+    "min": lambda values, times: min(values),
+    "max": lambda values, times: max(values),
+    "count": lambda values, times: len(values),
+    "variance": lambda values, times: statistics.pvariance(values),
+    "stddev": lambda values, times: statistics.pstdev(values),
+    "first": lambda values, times: values[min(range(len(values)), key=times.__getitem__)],
+    "last": lambda values, times: values[max(range(len(values)), key=lambda i: (times[i], i))],
+    **{name: (lambda q: lambda values, times: percentile(values, q))(q) for name, q in percentiles.items()}
 }
 
+# Aggregation functions reading the timestamps of the values
+time_functions = {"first", "last"}
+
+# Aggregation functions computed from the partial aggregates (count, sum, min, max) of a bucket
+rollup_functions = {
+    "sum": lambda count, total, low, high: total,
+    "avg": lambda count, total, low, high: total / count,
+    "min": lambda count, total, low, high: low,
+    "max": lambda count, total, low, high: high,
+    "count": lambda count, total, low, high: count
+}
+
+# Aggregation functions computed by InfluxDB
+pushdown_functions = {"sum", "avg", "min", "max", "count"}
+
+#Raised when the aggregator of a query is not valid
+class InvalidAggregator(Exception):
+    pass
+
 #AGGREGATOR SERVICE
-@app.route("/query", methods=["POST"]) 
+'''
+The "aggregator" of a query is an object {"fun", "field", "unit", "frequency"}, or a list of objects
+{"fun", "field", "unit", "name"} computed together with a single read of the data. With a list, each value
+is in the data of the result with its "name" (default <field>_<fun>), and the frequency can be set in any
+of the objects, with the same value.
+'''
+@app.route("/query", methods=["POST"])
 def query():
     try:
         msg = request.get_json()
         if not msg or "aggregator" not in msg:
             return make_response("Empty query", 404)
-        
-        fun = msg["aggregator"].get("fun", None)
-        field = msg["aggregator"].get("field", None)
-        unit = msg["aggregator"].get("unit", None)
-        if fun is None:
-            return make_response('Missing aggregation function "fun"', 400)
-        if field is None:
-            return make_response('Missing aggregation field "field"', 400)
-        if unit is None:
-            return make_response('Missing aggregation unit "unit"', 400)
-        
-        if fun not in agg_functions:
-            raise make_response(f"Unsupported aggregation function: {fun}", 400)
-        
+
+        try:
+            specs, frequency = aggregation_specs(msg["aggregator"])
+        except InvalidAggregator as e:
+            return make_response(str(e), 400)
+
+        # The aggregations read all the records of the window as JSON, the pages and the formats of /query do not apply
+        for key in ("limit", "order", "cursor", "stream", "format", "compression"):
+            msg.pop(key, None)
+
+        if ROLLUPS and canUseRollups(msg, specs):
+            with AGGREGATION_SECONDS.labels("rollups").time():
+                aggr = aggregateRollups(msg, specs, frequency)
+            if aggr is not None:
+                if not aggr:
+                    return make_response("No data found", 404)
+                return compressedResponse(aggr)
+
+        if PUSHDOWN and canPushDown(msg, specs):
+            with AGGREGATION_SECONDS.labels("pushdown").time():
+                aggr = pushDown(msg, specs, frequency)
+            if aggr is not None:
+                return compressedResponse(aggr)
+
+        if ENGINE == "stream":
+            with AGGREGATION_SECONDS.labels("stream").time():
+                aggr = streamAggregate(msg, specs, frequency)
+            if aggr is None:
+                return make_response("No data found", 404)
+            return compressedResponse(aggr)
 
         URL= DB_MANAGER_URL + '/query?unzip=true'
-        app.logger.info(f"Sending query to {URL}")
-        app.logger.info(f"Query: {msg}")
-        x = requests.post(URL, json=msg, stream=True)
-        x.raise_for_status()
-        logging.info("Query sent")
-        result = x.json()
-        if not result:
-            return make_response("No data found", 404)
-        aggr = create_aggregated_result(msg, result)
-        app.logger.info('Compressing response')
-        content = gzip.compress(json.dumps(aggr).encode('utf8'),mtime=0)
-        response = make_response(content)
-        response.headers['Content-length'] = len(content)
-        response.headers['Content-Encoding'] = 'gzip'       
-        return response
+        debugSample("Sending query to %s: %s", URL, msg)
+        with AGGREGATION_SECONDS.labels(ENGINE).time():
+            x = postToDB(URL, json=msg, stream=True)
+            x.raise_for_status()
+            result = x.json()
+            if not result:
+                return make_response("No data found", 404)
+            if len(result) == 1:
+                return compressedResponse(result)
+            aggr = aggregation_engines[ENGINE](msg, specs, frequency, result)
+        return compressedResponse(aggr)
     except HTTPError as e:
         app.logger.error(f'HTTP error occurred: {e.response.url} - {e.response.status_code} - {e.response.text}')
         return make_response(e.response.text, e.response.status_code)
     except Exception as e:
+        ERRORS.labels("query").inc()
         app.logger.error(repr(e))
         return make_response(repr(e), 500)
-    
-#Aggregates the data based on the aggregation function
-def create_aggregated_result(msg, result):
+
+#Sends a request to the DB service, observing the time to its response headers
+def postToDB(URL, **kwargs):
+    x = requests.post(URL, **kwargs)
+    UPSTREAM_SECONDS.labels(URL[len(DB_MANAGER_URL):].split("?")[0], x.status_code).observe(x.elapsed.total_seconds())
+    return x
+
+#Creates the gzip compressed JSON response
+def compressedResponse(aggr):
+    with ENCODE_SECONDS.time():
+        content = json.dumps(aggr).encode('utf8')
+    with COMPRESS_SECONDS.time():
+        content = gzip.compress(content,mtime=0)
+    response = make_response(content)
+    response.headers['Content-length'] = len(content)
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+#Takes the aggregator of a query and returns the list of {"name", "field", "fun", "unit"} to compute and the frequency
+def aggregation_specs(aggregator):
+    single = isinstance(aggregator, dict)
+    items = [aggregator] if single else aggregator
+    if not isinstance(items, list) or not items or not all(isinstance(item, dict) for item in items):
+        raise InvalidAggregator('The aggregator must be an object or a list of objects')
+    specs = []
+    frequencies = set()
+    for item in items:
+        fun = item.get("fun", None)
+        field = item.get("field", None)
+        unit = item.get("unit", None)
+        if fun is None:
+            raise InvalidAggregator('Missing aggregation function "fun"')
+        if field is None:
+            raise InvalidAggregator('Missing aggregation field "field"')
+        if unit is None:
+            raise InvalidAggregator('Missing aggregation unit "unit"')
+        if fun not in agg_functions:
+            raise InvalidAggregator(f"Unsupported aggregation function: {fun}")
+        if item.get("frequency", None) is not None:
+            frequencies.add(item["frequency"])
+        name = field if single else item.get("name", f"{field}_{fun}")
+        specs.append({"name": name, "field": field, "fun": fun, "unit": unit})
+    if len(frequencies) > 1:
+        raise InvalidAggregator('The aggregations must have the same "frequency"')
+    if len({spec["name"] for spec in specs}) < len(specs):
+        raise InvalidAggregator('The aggregations must have different names')
+    return specs, frequencies.pop() if frequencies else None
+
+#Takes the aggregated values of each bucket, {bucket end (None without frequency): {name: value}}, and creates the response
+def aggregated_result(msg, specs, frequency, stop, buckets):
+    def record(timestamp, values):
+        return {
+            "timestamp": timestamp,
+            "generator_id": msg.get("generator_id", None),
+            "topic": msg.get("topic", None),
+            "data": str({
+                spec["name"]: {
+                    "unit": spec["unit"],
+                    "value": float(values[spec["name"]])
+                } for spec in specs if spec["name"] in values
+            })
+        }
+    if frequency is None:
+        return record(stop, buckets[None]) if buckets.get(None) else {}
+    return [record(format_timestamp(bucket_end), buckets[bucket_end]) for bucket_end in sorted(buckets) if buckets[bucket_end]]
+
+#True if the aggregation can be computed by InfluxDB: the time window must be known to align the buckets
+def canPushDown(msg, specs):
+    return bool(msg.get("start")) and bool(msg.get("stop")) and all(spec["fun"] in pushdown_functions for spec in specs)
+
+#Asks the DB service to aggregate the numeric fields, returns None if it has no numeric values for a field
+def pushDown(msg, specs, frequency):
+    buckets = defaultdict(dict)
+    URL = DB_MANAGER_URL + '/aggregate'
+    for spec in specs:
+        query = {
+            "start": msg["start"],
+            "stop": msg["stop"],
+            "topic": msg.get("topic", None),
+            "generator_id": msg.get("generator_id", None),
+            "field": spec["field"],
+            "fun": spec["fun"],
+            "frequency": frequency,
+            "conversions": conversionsTo(spec["unit"])
+        }
+        debugSample("Sending aggregation to %s: %s", URL, query)
+        x = postToDB(URL, json=query)
+        if x.status_code == 404:
+            debugSample("No numeric values in the DB, aggregating the raw data")
+            return None
+        x.raise_for_status()
+        for v in x.json():
+            bucket_end = None if frequency is None else parse_timestamp(v["timestamp"])
+            buckets[bucket_end][spec["name"]] = v["value"]
+    return aggregated_result(msg, specs, frequency, msg["stop"], buckets)
+
+#True if the aggregation can be computed from the partial aggregates: they are kept per topic and aligned to the minutes
+def canUseRollups(msg, specs):
+    return bool(msg.get("start")) and bool(msg.get("stop")) and bool(msg.get("topic")) and all(spec["fun"] in rollup_functions for spec in specs)
+
+#Aggregates merging the partial aggregates of the closed minutes and the raw data of the open ones,
+#returns None if the DB service has no numeric values for a field in the closed minutes (the raw data is aggregated instead)
+def aggregateRollups(msg, specs, frequency):
+    start_dt = parse_timestamp(msg["start"])
+    stop_dt = parse_timestamp(msg["stop"])
+    frequency_td = timedelta(minutes=frequency) if frequency is not None else None
+
+    # End of the bucket including ts, None without frequency
+    def bucket_of(ts):
+        if frequency_td is None:
+            return None
+        return min(start_dt + ((ts - start_dt) // frequency_td + 1) * frequency_td, stop_dt)
+
+    # Partial aggregates [count, sum, min, max] of each bucket and aggregation, in the target unit
+    partials = defaultdict(dict)
+    def merge(bucket_end, name, count, total, low, high):
+        partial = partials[bucket_end].get(name)
+        if partial is None:
+            partials[bucket_end][name] = [count, total, low, high]
+        else:
+            partial[0] += count
+            partial[1] += total
+            partial[2] = min(partial[2], low)
+            partial[3] = max(partial[3], high)
+
+    # The first answer sets the end of the partial aggregates, the following ones are asked to stop there
+    URL = DB_MANAGER_URL + '/rollup'
+    until = msg["stop"]
+    for spec in specs:
+        units = conversionsTo(spec["unit"])
+        query = {
+            "start": msg["start"],
+            "stop": until,
+            "topic": msg["topic"],
+            "generator_id": msg.get("generator_id", None),
+            "field": spec["field"],
+            "units": list(units),
+            "frequency": frequency
+        }
+        debugSample("Sending rollup query to %s: %s", URL, query)
+        x = postToDB(URL, json=query)
+        x.raise_for_status()
+        rollup = x.json()
+        if not rollup.get("numeric", True):
+            debugSample("No numeric values of %s in the partial aggregates, aggregating the raw data", spec["field"])
+            return None
+        until = rollup["until"]
+        for b in rollup["buckets"]:
+            factor, offset = units[b["unit"]]
+            # The conversions have a positive factor, so they keep the minimum and the maximum
+            merge(bucket_of(parse_timestamp(b["start"])), spec["name"], b["count"], b["sum"] * factor + b["count"] * offset, b["min"] * factor + offset, b["max"] * factor + offset)
+        debugSample("Merged %d partial aggregates of %s until %s", len(rollup['buckets']), spec['field'], until)
+
+    until_dt = parse_timestamp(until)
+    if until_dt < stop_dt:
+        x = postToDB(DB_MANAGER_URL + '/query', json=dict(msg, start=until))
+        if x.status_code != 404:
+            x.raise_for_status()
+            for item in x.json():
+                ts = parse_timestamp(item["timestamp"])
+                if not until_dt <= ts <= stop_dt:
+                    continue
+                data = get_data_dict(item.get("data"))
+                for spec in specs:
+                    value = spec_value(data, spec)
+                    if value is not None:
+                        merge(bucket_of(ts), spec["name"], 1, value, value, value)
+
+    funs = {spec["name"]: rollup_functions[spec["fun"]] for spec in specs}
+    buckets = {bucket_end: {name: funs[name](*partial) for name, partial in values.items()} for bucket_end, values in partials.items()}
+    return aggregated_result(msg, specs, frequency, msg["stop"], buckets)
+
+#Takes the data of a record as a dict, parsing the data string
+def get_data_dict(data_field):
+    if isinstance(data_field, dict):
+        return data_field
+    elif isinstance(data_field, str):
+        data_field = data_field.replace("'", "\"")
+        try:
+            return json.loads(data_field)
+        except Exception:
+            return {}
+    return {}
+
+#Returns the value of the field of a spec in the data of a record, converted to the unit of the spec, or None
+def spec_value(data, spec):
+    if not data or spec["field"] not in data:
+        return None
+    attr = data.get(spec["field"], {})
+    if not attr:
+        return None
+    return convert(attr.get("value"), attr.get("unit"), spec["unit"])
+
+#Aggregates the data based on the aggregation functions
+def create_aggregated_result(msg, specs, frequency, result):
     start = msg.get("start", None)
     stop = msg.get("stop", None)
     topic = msg.get("topic", None)
     generator_id = msg.get("generator_id", None)
-    fun = msg["aggregator"].get("fun", None)
-    field = msg["aggregator"].get("field", None)
-    target_unit = msg["aggregator"].get("unit", None)
-    frequency = msg["aggregator"].get("frequency", None)
-    
-
-    if len(result) == 1:
-        return result
-   
-    def get_data_dict(data_field):
-        if isinstance(data_field, dict):
-            return data_field
-        elif isinstance(data_field, str):
-            data_field = data_field.replace("'", "\"")
-            try:
-                return json.loads(data_field)
-            except Exception:
-                return {}
-        return {}
 
     # If start and stop are not provided, use the first and last data timestamps
     if not start or not stop:
-        timestamps = [datetime.strptime(item['timestamp'], "%Y-%m-%dT%H:%M:%SZ") for item in result]
+        timestamps = [parse_timestamp(item['timestamp']) for item in result]
         if not start:
-            start = min(timestamps).strftime("%Y-%m-%dT%H:%M:%SZ")
+            start = format_timestamp(min(timestamps))
         if not stop:
-            stop = max(timestamps).strftime("%Y-%m-%dT%H:%M:%SZ")
-
-    app.logger.info(f"Aggregating data with parameters: start={start}, stop={stop}, topic={topic}, generator_id={generator_id}, fun={fun}, field={field}, target_unit={target_unit}, frequency={frequency}")
-
-    agg_fun = agg_functions[fun]
-    
-    # Extract values matching criteria
-    def extract_values(items):
-        values = []
-        for item in items:    
-            data_field = item.get("data")
-            data = get_data_dict(data_field)
-            if not data or field not in data:
-                # Skip if data if empty or does not contain the field
-                continue
-            attr = data.get(field, {})
-            if not attr:
-                # Skip if data if does not contain the field
-                continue
-            val = attr.get("value")
-            unit = attr.get("unit")
-            conv_val = convert(val, unit, target_unit)
-            if conv_val is not None:
-                values.append(conv_val)
-            # if value is not of the target unit and cannot be converted, skip it
-        return values
+            stop = format_timestamp(max(timestamps))
 
-    # Case 1: No frequency
-    if frequency is None:
-        app.logger.info("No frequency provided, aggregating all data")
-        values = extract_values(result)
-        if not values:
-            return {}
-        return {
-            "timestamp": stop,
-            "generator_id": generator_id,
-            "topic": topic,
-            "data": str({
-                field: {
-                    "unit": target_unit,
-                    "value": float(agg_fun(values))
-                }
-            })
-        }
+    debugSample("Aggregating data with parameters: start=%s, stop=%s, topic=%s, generator_id=%s, specs=%s, frequency=%s", start, stop, topic, generator_id, specs, frequency)
 
-    # Case 2: With frequency
-    app.logger.info(f"Aggregating data with frequency: {frequency} minutes")
     start_dt = parse_timestamp(start)
     stop_dt = parse_timestamp(stop)
-    frequency_td = timedelta(minutes=frequency)
-    buckets = defaultdict(list)
+    frequency_td = timedelta(minutes=frequency) if frequency is not None else None
+    needs_time = frequency_td is not None or any(spec["fun"] in time_functions for spec in specs)
+    # Values of each aggregation in each bucket, a single bucket None without frequency, and their timestamps
+    values = defaultdict(lambda: defaultdict(list))
+    times = defaultdict(lambda: defaultdict(list))
 
-    # Create buckets based on frequency
     for item in result:
-        try:
-            ts = parse_timestamp(item["timestamp"])
-        #should not happen, but just in case
-        except Exception:
-            continue
-        if start_dt <= ts <= stop_dt:
+        bucket_end = None
+        ts = None
+        if needs_time:
+            try:
+                ts = parse_timestamp(item["timestamp"])
+            #should not happen, but just in case
+            except Exception:
+                continue
+        if frequency_td is not None:
+            if not start_dt <= ts <= stop_dt:
+                continue
             window_index = (ts - start_dt) // frequency_td
             bucket_end = start_dt + (window_index + 1) * frequency_td
             if bucket_end > stop_dt:
                 bucket_end = stop_dt
-            buckets[bucket_end].append(item)
-
-    app.logger.info(f"Number of buckets created: {len(buckets)}")
-    # Aggregate values in each bucket
-    aggregated = []
-    for bucket_end in sorted(buckets.keys()):
-        values = extract_values(buckets[bucket_end])
-        if values:
-            aggregated.append({
-                "timestamp": bucket_end.strftime("%Y-%m-%dT%H:%M:%SZ"),
-                "generator_id": generator_id,
-                "topic": topic,
-                "data": str({
-                    field: {
-                        "unit": target_unit,
-                        "value": float(agg_fun(values))
-                    }
-                })
-            })
+        data = get_data_dict(item.get("data"))
+        for spec in specs:
+            conv_val = spec_value(data, spec)
+            if conv_val is not None:
+                values[bucket_end][spec["name"]].append(conv_val)
+                times[bucket_end][spec["name"]].append(ts)
+            # if value is not of the target unit and cannot be converted, skip it
+
+    debugSample("Number of buckets created: %d", len(values))
+    funs = {spec["name"]: agg_functions[spec["fun"]] for spec in specs}
+    buckets = {bucket_end: {name: funs[name](vals, times[bucket_end][name]) for name, vals in bucket.items()} for bucket_end, bucket in values.items()}
+    return aggregated_result(msg, specs, frequency, stop, buckets)
+
+# Variance of the values of each bucket, computed from the deviations from the mean of the bucket
+def vector_variance(values, times, buckets, firsts, counts):
+    means = np.bincount(buckets, weights=values, minlength=len(counts)) / counts
+    return np.bincount(buckets, weights=(values - means[buckets]) ** 2, minlength=len(counts)) / counts
+
+# Percentile q of the values of each bucket, interpolating between the closest values as percentile
+def vector_percentile(q):
+    def aggregate(values, times, buckets, firsts, counts):
+        values = values[np.lexsort((values, buckets))]
+        positions = firsts + q * (counts - 1)
+        lower = np.floor(positions).astype(np.intp)
+        upper = np.minimum(lower + 1, firsts + counts - 1)
+        return values[lower] + (values[upper] - values[lower]) * (positions - lower)
+    return aggregate
+
+# Aggregation functions of the vectorised engine, taking the values sorted by bucket, their timestamps, the bucket of each value,
+# the index of the first value of each bucket and the number of values of each bucket
+vector_functions = {
+    "sum": lambda values, times, buckets, firsts, counts: np.bincount(buckets, weights=values, minlength=len(counts)),
+    "avg": lambda values, times, buckets, firsts, counts: np.bincount(buckets, weights=values, minlength=len(counts)) / counts,
+    "min": lambda values, times, buckets, firsts, counts: np.minimum.reduceat(values, firsts),
+    "max": lambda values, times, buckets, firsts, counts: np.maximum.reduceat(values, firsts),
+    "count": lambda values, times, buckets, firsts, counts: counts,
+    "variance": vector_variance,
+    "stddev": lambda values, times, buckets, firsts, counts: np.sqrt(vector_variance(values, times, buckets, firsts, counts)),
+    "first": lambda values, times, buckets, firsts, counts: values[np.lexsort((times, buckets))][firsts],
+    "last": lambda values, times, buckets, firsts, counts: values[np.lexsort((times, buckets))][firsts + counts - 1],
+    **{name: vector_percentile(q) for name, q in percentiles.items()}
+}
+
+#Aggregates the data as create_aggregated_result, reading the records once into columns of timestamps, values and units
+def create_vectorised_result(msg, specs, frequency, result):
+    start = msg.get("start", None)
+    stop = msg.get("stop", None)
+    topic = msg.get("topic", None)
+    generator_id = msg.get("generator_id", None)
+
+    # Single pass over the records: for each field, the numeric values, their unit (as an index in units) and their record
+    columns = {spec["field"]: ([], [], [], {}) for spec in specs}
+    for row, item in enumerate(result):
+        data = get_data_dict(item.get("data"))
+        if not data:
+            continue
+        for field, (values, unit_indexes, rows, units) in columns.items():
+            attr = data.get(field)
+            if not isinstance(attr, dict):
+                continue
+            value = attr.get("value")
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            values.append(value)
+            unit_indexes.append(units.setdefault(attr.get("unit"), len(units)))
+            rows.append(row)
+    timestamps = np.array([item["timestamp"][:-1] for item in result], dtype="datetime64[us]").astype(np.int64)
+
+    # If start and stop are not provided, use the first and last data timestamps
+    if not start:
+        start = format_timestamp(from_microseconds(timestamps.min()))
+    if not stop:
+        stop = format_timestamp(from_microseconds(timestamps.max()))
+
+    debugSample("Aggregating %d records with parameters: start=%s, stop=%s, topic=%s, generator_id=%s, specs=%s, frequency=%s", len(result), start, stop, topic, generator_id, specs, frequency)
+
+    # The end of the bucket of each record is computed in microseconds, the records out of the window are in bucket -1
+    if frequency is None:
+        ends = np.zeros(len(result), dtype=np.int64)
+    else:
+        start_us = to_microseconds(parse_timestamp(start))
+        stop_us = to_microseconds(parse_timestamp(stop))
+        frequency_us = frequency * 60 * 10**6
+        ends = np.minimum(start_us + ((timestamps - start_us) // frequency_us + 1) * frequency_us, stop_us)
+        ends[(timestamps < start_us) | (timestamps > stop_us)] = -1
+
+    buckets = defaultdict(dict)
+    for spec in specs:
+        values, unit_indexes, rows, units = columns[spec["field"]]
+        # Converts all the values to the target unit, the values that cannot be converted are dropped
+        rules = conversionsTo(spec["unit"])
+        factors = np.array([rules.get(unit, (np.nan, 0))[0] for unit in units], dtype=np.float64)
+        offsets = np.array([rules.get(unit, (np.nan, 0))[1] for unit in units], dtype=np.float64)
+        unit_indexes = np.array(unit_indexes, dtype=np.intp)
+        values = np.array(values, dtype=np.float64) * factors[unit_indexes] + offsets[unit_indexes]
+        rows = np.array(rows, dtype=np.intp)
+        value_ends = ends[rows]
+        selected = ~np.isnan(factors[unit_indexes]) & (value_ends >= 0)
+        values = values[selected]
+        if not len(values):
+            continue
+        bucket_ends, value_buckets = np.unique(value_ends[selected], return_inverse=True)
+        order = np.argsort(value_buckets, kind="stable")
+        values = values[order]
+        value_times = timestamps[rows[selected]][order]
+        value_buckets = value_buckets[order]
+        counts = np.bincount(value_buckets, minlength=len(bucket_ends))
+        firsts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        aggregated_values = vector_functions[spec["fun"]](values, value_times, value_buckets, firsts, counts)
+        for bucket_end, value in zip(bucket_ends, aggregated_values):
+            buckets[None if frequency is None else from_microseconds(bucket_end)][spec["name"]] = value
+
+    debugSample("Number of buckets created: %d", len(buckets))
+    return aggregated_result(msg, specs, frequency, stop, buckets)
+
+#Aggregates the records streamed by the DB service as NDJSON, keeping only the partial aggregates of each bucket,
+#returns None without records
+def streamAggregate(msg, specs, frequency):
+    start = msg.get("start", None)
+    stop = msg.get("stop", None)
+
+    # The buckets are aligned to the start, without start it is the timestamp of the first record
+    if frequency is not None and not start:
+        x = postToDB(DB_MANAGER_URL + '/bounds', json=msg)
+        if x.status_code == 404:
+            return None
+        x.raise_for_status()
+        start = x.json()["start"]
+
+    start_dt = parse_timestamp(start) if start else None
+    stop_dt = parse_timestamp(stop) if stop else None
+    frequency_td = timedelta(minutes=frequency) if frequency is not None else None
+    needs_time = frequency_td is not None or stop_dt is None or any(spec["fun"] in time_functions for spec in specs)
+
+    # A window with start and stop is read in STREAM_PARTITIONS slices at the same time,
+    # the partial aggregates of a bucket split between two slices are merged
+    queries = [msg]
+    if start_dt is not None and stop_dt is not None and STREAM_PARTITIONS > 1:
+        step = (stop_dt - start_dt) / STREAM_PARTITIONS
+        bounds = [format_timestamp(start_dt + i * step) for i in range(STREAM_PARTITIONS)] + [stop]
+        queries = [dict(msg, start=a, stop=b) for a, b in zip(bounds, bounds[1:]) if a != b]
+    URL = DB_MANAGER_URL + '/query'
+    debugSample("Streaming query from %s in %d slices: %s", URL, len(queries), msg)
+    def aggregateSlice(query):
+        return streamPartials(URL, query, specs, start_dt, stop_dt, frequency_td, needs_time)
+    if len(queries) == 1:
+        slices = [aggregateSlice(queries[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=len(queries)) as pool:
+            slices = list(pool.map(aggregateSlice, queries))
+
+    # The slices are in time order, the first record is the first one of the first slice with records
+    partials = defaultdict(dict)
+    records = 0
+    first = None
+    last_dt = None
+    for slice_partials, slice_records, slice_first, slice_last_dt in slices:
+        records += slice_records
+        if first is None:
+            first = slice_first
+        if slice_last_dt is not None:
+            last_dt = slice_last_dt if last_dt is None else max(last_dt, slice_last_dt)
+        for bucket_end, values in slice_partials.items():
+            for name, partial in values.items():
+                if name in partials[bucket_end]:
+                    partials[bucket_end][name].merge(partial)
+                else:
+                    partials[bucket_end][name] = partial
+
+    if records == 0:
+        return None
+    if records == 1:
+        return [first]
+    if stop_dt is None:
+        stop = format_timestamp(last_dt)
+        partials = {min(bucket_end, last_dt) if bucket_end is not None else None: values for bucket_end, values in partials.items()}
+    debugSample("Aggregated %d records in %d buckets: start=%s, stop=%s, specs=%s, frequency=%s", records, len(partials), start, stop, specs, frequency)
+    funs = {spec["name"]: partial_functions[spec["fun"]] for spec in specs}
+    buckets = {bucket_end: {name: funs[name](partial) for name, partial in values.items()} for bucket_end, values in partials.items()}
+    return aggregated_result(msg, specs, frequency, stop, buckets)
+
+#Reads the records of a query streamed by the DB service, returns the partial aggregates of each aggregation in each bucket
+#(a single bucket None without frequency), the number of records, the first record and the last timestamp
+def streamPartials(URL, query, specs, start_dt, stop_dt, frequency_td, needs_time):
+    partials = defaultdict(dict)
+    records = 0
+    first = None
+    last_dt = None
+    x = postToDB(URL, json=dict(query, stream=True, format="ndjson"), stream=True)
+    if x.status_code == 404:
+        return partials, records, first, last_dt
+    x.raise_for_status()
+    ts = None
+    for line in x.iter_lines(chunk_size=STREAM_CHUNK_SIZE):
+        if not line:
+            continue
+        item = json.loads(line)
+        records += 1
+        if first is None:
+            first = item
+        bucket_end = None
+        if needs_time:
+            try:
+                ts = parse_timestamp(item["timestamp"])
+            #should not happen, but just in case
+            except Exception:
+                continue
+            last_dt = ts if last_dt is None else max(last_dt, ts)
+            if frequency_td is not None:
+                if ts < start_dt or (stop_dt is not None and ts > stop_dt):
+                    continue
+                # Without stop the last bucket is cut at the last timestamp when all the records have been read
+                bucket_end = start_dt + ((ts - start_dt) // frequency_td + 1) * frequency_td
+                if stop_dt is not None and bucket_end > stop_dt:
+                    bucket_end = stop_dt
+        data = get_data_dict(item.get("data"))
+        for spec in specs:
+            value = spec_value(data, spec)
+            if value is None:
+                continue
+            partial = partials[bucket_end].get(spec["name"])
+            if partial is None:
+                partial = partials[bucket_end][spec["name"]] = Partial(spec["fun"] in percentiles)
+            partial.add(value, ts)
+    return partials, records, first, last_dt
+
+#Running aggregates of the values of a bucket, which can be merged with the ones of the same bucket in other slices of the data
+class Partial:
+    def __init__(self, sketch=False):
+        self.count = 0
+        self.total = 0.0
+        self.low = math.inf
+        self.high = -math.inf
+        self.mean = 0.0
+        self.m2 = 0.0 #SUM OF THE SQUARED DEVIATIONS FROM THE MEAN
+        self.first = None #(timestamp, value)
+        self.last = None #(timestamp, value)
+        self.sketch = DDSketch() if sketch else None
+
+    def add(self, value, ts=None):
+        self.count += 1
+        self.total += value
+        self.low = min(self.low, value)
+        self.high = max(self.high, value)
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if ts is not None:
+            if self.first is None or ts < self.first[0]:
+                self.first = (ts, value)
+            if self.last is None or ts >= self.last[0]:
+                self.last = (ts, value)
+        if self.sketch is not None:
+            self.sketch.add(value)
+
+    def merge(self, other):
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.mean += delta * other.count / count
+        self.count = count
+        self.total += other.total
+        self.low = min(self.low, other.low)
+        self.high = max(self.high, other.high)
+        if other.first is not None and (self.first is None or other.first[0] < self.first[0]):
+            self.first = other.first
+        if other.last is not None and (self.last is None or other.last[0] >= self.last[0]):
+            self.last = other.last
+        if other.sketch is not None:
+            if self.sketch is None:
+                self.sketch = DDSketch()
+            self.sketch.merge(other.sketch)
+
+# Aggregation functions computed from the running aggregates of a bucket
+partial_functions = {
+    "sum": lambda partial: partial.total,
+    "avg": lambda partial: partial.total / partial.count,
+    "min": lambda partial: partial.low,
+    "max": lambda partial: partial.high,
+    "count": lambda partial: partial.count,
+    "variance": lambda partial: partial.m2 / partial.count,
+    "stddev": lambda partial: math.sqrt(partial.m2 / partial.count),
+    "first": lambda partial: partial.first[1],
+    "last": lambda partial: partial.last[1],
+    **{name: (lambda q: lambda partial: partial.sketch.quantile(q))(q) for name, q in percentiles.items()}
+}
+
+#Sketch of the distribution of the values (DDSketch): the values are counted in bins growing exponentially,
+#so a quantile is estimated with a relative error of at most SKETCH_ACCURACY, and two sketches are merged adding their bins
+class DDSketch:
+    def __init__(self, accuracy=SKETCH_ACCURACY, max_bins=SKETCH_MAX_BINS):
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+        self.positive = defaultdict(int) #BIN -> NUMBER OF VALUES
+        self.negative = defaultdict(int) #BIN OF THE ABSOLUTE VALUE -> NUMBER OF VALUES
+        self.zeros = 0
+        self.count = 0
 
-    return aggregated
+    def bin(self, value):
+        return math.ceil(math.log(value) / self.log_gamma)
 
-# Parse timestamps with 'Z' as UTC
+    # Value representing the values of a bin, with the same relative distance from its bounds
+    def value(self, bin):
+        return 2 * self.gamma ** bin / (self.gamma + 1)
+
+    def add(self, value):
+        self.count += 1
+        if value > sys.float_info.min:
+            self.positive[self.bin(value)] += 1
+            self.collapse(self.positive)
+        elif value < -sys.float_info.min:
+            self.negative[self.bin(-value)] += 1
+            self.collapse(self.negative)
+        else:
+            self.zeros += 1
+
+    # Adds the values of a sketch with the same accuracy, whose bins are the same
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            raise ValueError(f"Cannot merge sketches with different accuracy: {self.gamma} and {other.gamma}")
+        for bin, count in other.positive.items():
+            self.positive[bin] += count
+        for bin, count in other.negative.items():
+            self.negative[bin] += count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.collapse(self.positive)
+        self.collapse(self.negative)
+
+    # Merges the bins of the smallest absolute values when there are more than max_bins
+    def collapse(self, bins):
+        if len(bins) <= self.max_bins:
+            return
+        smallest = sorted(bins)[:len(bins) - self.max_bins + 1]
+        bins[smallest[-1]] += sum(bins.pop(bin) for bin in smallest[:-1])
+
+    # Value with a fraction q of the values below it
+    def quantile(self, q):
+        rank = q * (self.count - 1)
+        seen = 0
+        for bin in sorted(self.negative, reverse=True):
+            seen += self.negative[bin]
+            if seen > rank:
+                return -self.value(bin)
+        seen += self.zeros
+        if seen > rank:
+            return 0.0
+        for bin in sorted(self.positive):
+            seen += self.positive[bin]
+            if seen > rank:
+                return self.value(bin)
+        return self.value(max(self.positive)) if self.positive else 0.0
+
+# Engines aggregating the raw data
+aggregation_engines = {
+    "numpy": create_vectorised_result,
+    "python": create_aggregated_result
+}
+
+# A wrong engine stops the service at startup instead of failing every query
+if ENGINE != "stream" and ENGINE not in aggregation_engines:
+    raise ValueError(f"Invalid AGGREGATION_ENGINE: {ENGINE}, it must be one of {', '.join([*aggregation_engines, 'stream'])}")
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Microseconds since epoch of a datetime, and back
+def to_microseconds(dt):
+    return (dt - EPOCH) // timedelta(microseconds=1)
+
+def from_microseconds(us):
+    return EPOCH + timedelta(microseconds=int(us))
+
+# Parse timestamps with 'Z' as UTC, with an optional fraction of second (truncated to microseconds)
 def parse_timestamp(ts):
+    if "." in ts:
+        base, fraction = ts[:-1].split(".")
+        return datetime.strptime(base, "%Y-%m-%dT%H:%M:%S").replace(microsecond=int(fraction[:6].ljust(6, "0")), tzinfo=timezone.utc)
     return datetime.strptime(ts, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
 
+# Percentile q of the values, interpolating between the closest values
+def percentile(values, q):
+    values = sorted(values)
+    position = q * (len(values) - 1)
+    lower = math.floor(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+# Format timestamps with 'Z', with milliseconds or microseconds only if there is a fraction of second
+def format_timestamp(dt):
+    text = dt.strftime("%Y-%m-%dT%H:%M:%S")
+    if dt.microsecond % 1000:
+        text += f".{dt.microsecond:06d}"
+    elif dt.microsecond:
+        text += f".{dt.microsecond // 1000:03d}"
+    return text + "Z"
+
+# Bidirectional conversion rules, each one converts v to v * factor + offset
+conversions = {
+    ("W", "kW"): (1 / 1000, 0),
+    ("kW", "W"): (1000, 0),
+    ("Wh", "kWh"): (1 / 1000, 0),
+    ("kWh", "Wh"): (1000, 0),
+    ("A", "mA"): (1000, 0),
+    ("mA", "A"): (1 / 1000, 0),
+    ("Celsius", "Kelvin"): (1, 273.15),
+    ("Kelvin", "Celsius"): (1, -273.15),
+}
+
+# Returns the units that can be converted to to_unit, with their factor and offset
+def conversionsTo(to_unit):
+    result = {to_unit: (1, 0)}
+    for (from_unit, unit), rule in conversions.items():
+        if unit == to_unit:
+            result[from_unit] = rule
+    return result
+
 def convert(value, from_unit, to_unit):
     if from_unit == to_unit:
         return value
 
-    # Bidirectional conversion rules
-    conversions = {
-        ("W", "kW"): lambda v: v / 1000,
-        ("kW", "W"): lambda v: v * 1000,
-        ("Wh", "kWh"): lambda v: v / 1000,
-        ("kWh", "Wh"): lambda v: v * 1000,
-        ("A", "mA"): lambda v: v * 1000,
-        ("mA", "A"): lambda v: v / 1000,
-        ("Celsius", "Kelvin"): lambda v: v + 273.15,
-        ("Kelvin", "Celsius"): lambda v: v - 273.15,
-    }
-
-    func = conversions.get((from_unit, to_unit))
-    if func:
+    rule = conversions.get((from_unit, to_unit))
+    if rule:
+        factor, offset = rule
         try:
-            return func(value)
+            return value * factor + offset
         except Exception:
             return None  # skip if non-numeric or invalid
     return None  # no conversion path
\ No newline at end of file
@@ -0,0 +1,13 @@
+from gunicorn_base import *
+
+#GUNICORN CONFIGURATION OF THE TOPIC MANAGER
+'''
+Every worker has its own Kafka AdminClient, whose librdkafka threads would not survive a fork. Each worker keeps the
+registered topics in memory and adds the topics registered by the other workers when the topics file changes
+(see _sync_topics in topic_manager). A stopping worker saves the topics file within graceful_timeout.
+'''
+bind = env("SERVER_PORT", "0.0.0.0:50010")
+workers = env("GUNICORN_WORKERS", 2)
+timeout = env("GUNICORN_TIMEOUT", 60)
+
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus_topicmanager")
@@ -1,6 +1,9 @@
 from flask import Flask, request, make_response, jsonify
-from confluent_kafka.admin import AdminClient, NewTopic
-import logging, sys, os, json
+from confluent_kafka import KafkaError, KafkaException
+from confluent_kafka.admin import AdminClient, NewTopic, NewPartitions
+from prometheus_client import Counter, Gauge, Histogram
+from service_metrics import instrument
+import logging, sys, os, json, hashlib, threading, time, atexit, itertools
 
 # CONFIGURATION
 KAFKA_PORT = os.environ["KAFKA_INTERNAL_PORT"]
@@ -8,17 +11,38 @@ KAFKA_URL = "kafka:" + KAFKA_PORT
 
 RESTORE_TOPICS = os.environ.get("RESTORE_TOPICS", "false").lower() == "true"
 TOPICS_FILE = "/app/topiclist/topics.json"
+# Partitions of a new topic when the registration does not specify them, -1 uses the Kafka default
+DEFAULT_PARTITIONS = int(os.environ.get("TOPIC_PARTITIONS", "-1"))
+# Seconds between the saves of the topics file, the registrations received in between are saved together
+# (0 saves the file before answering each registration)
+SAVE_INTERVAL = float(os.environ.get("TOPICS_SAVE_INTERVAL", "1"))
+# The msgs of the created topics have the time they are received by Kafka, so the offsets found by time
+# (e.g. /offsets of the API Gateway) do not depend on the clocks of the generators
+TOPIC_CONFIG = {"message.timestamp.type": "LogAppendTime"}
+KAFKA_TIMEOUT = 10 # Seconds
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
 
 app = Flask(__name__)
-logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+logging.basicConfig(stream=sys.stdout, level=LOG_LEVEL)
 
-def _save_topics_atomically(topics_list):
-    """Write {"topics": [...]} atomically to avoid truncated/empty files."""
+# Metrics exposed at /metrics
+REQUEST_SECONDS = Histogram("topicmanager_request_seconds", "Time to answer a request", ["endpoint", "status"])
+SAVE_SECONDS = Histogram("topicmanager_save_seconds", "Time to merge and save the topics file")
+NEW_TOPICS = Counter("topicmanager_new_topics", "Topics created in Kafka")
+NEW_PARTITIONS = Counter("topicmanager_extended_topics", "Topics extended with more partitions")
+SYNCS = Counter("topicmanager_syncs", "Changes of the topics file read by a worker")
+TOPICS = Gauge("topicmanager_topics", "Registered topics", multiprocess_mode="livemax")
+ERRORS = Counter("topicmanager_errors", "Failed requests and saves", ["kind"])
+instrument(app, REQUEST_SECONDS)
+
+def _save_topics_atomically(topics_list, partitions_dict=None):
+    """Write {"topics": [...], "partitions": {...}} atomically to avoid truncated/empty files."""
     dirpath = os.path.dirname(TOPICS_FILE) or "."
     os.makedirs(dirpath, exist_ok=True)
-    tmp = TOPICS_FILE + ".tmp"
+    # A temporary file per process, the workers can save at the same time
+    tmp = f"{TOPICS_FILE}.{os.getpid()}.tmp"
     with open(tmp, "w", encoding="utf-8") as f:
-        json.dump({"topics": topics_list}, f, ensure_ascii=False)
+        json.dump({"topics": topics_list, "partitions": partitions_dict or {}}, f, ensure_ascii=False)
         f.flush()
         os.fsync(f.fileno())
     os.replace(tmp, TOPICS_FILE)  # atomic on POSIX
@@ -47,54 +71,253 @@ def _load_topics_safe(default_list):
         app.logger.error("Error reading topics file: %r; falling back to default.", e)
         return default_list
 
+def _load_partitions_safe():
+    """Read the partitions requested for each topic from file, {} if they cannot be read."""
+    try:
+        with open(TOPICS_FILE, "r", encoding="utf-8") as f:
+            p = json.load(f).get("partitions", {})
+        return p if isinstance(p, dict) else {}
+    except Exception:
+        return {}
+
+def _new_topic(topic, n=None):
+    return NewTopic(topic, num_partitions=n or partitions.get(topic, DEFAULT_PARTITIONS), config=TOPIC_CONFIG)
+
 admin = AdminClient({'bootstrap.servers': KAFKA_URL})
-topics = list(admin.list_topics().topics.keys())
-if "__consumer_offsets" in topics:
-    topics.remove("__consumer_offsets")
+# The registered topics, a dict keeps them in order of registration with constant time lookups (values are unused)
+# The topics starting with an underscore are reserved to Kafka (e.g. __consumer_offsets) and ODA (e.g. the replays)
+topics = dict.fromkeys(topic for topic in admin.list_topics().topics.keys() if not topic.startswith("_"))
+# Partitions requested at registration, topics not in the dict use DEFAULT_PARTITIONS
+partitions = {}
+# The threads of a worker change the registry one at a time (the save thread and the requests)
+registry_lock = threading.RLock()
 
 if RESTORE_TOPICS:
     # Restore topics from file (with atomic write + safe read)
     try:
         if not os.path.exists(TOPICS_FILE):
-            _save_topics_atomically(topics)
-        topics = _load_topics_safe(default_list=topics)
+            _save_topics_atomically(list(topics))
+        # The topics in Kafka missing from the file (e.g. registered just before a restart) are kept
+        topics = dict.fromkeys(itertools.chain(_load_topics_safe(default_list=list(topics)), topics))
+        partitions = _load_partitions_safe()
         if topics:
-            new_topics = [NewTopic(topic) for topic in topics]
+            new_topics = [_new_topic(topic) for topic in topics]
             admin.create_topics(new_topics)
     except Exception as e:
         app.logger.error(repr(e))
         raise e
-    app.logger.info(f"Restored topics from file: {topics}")
+    app.logger.info(f"Restored topics from file: {list(topics)}")
+
+TOPICS.set(len(topics))
+
+# Body and ETag of the /topics response, computed again after the topics change
+topics_response = None
+# Modification time of the topics file when the topics registered by the other workers were last added
+topics_file_mtime = None
+
+def _file_mtime():
+    try:
+        return os.stat(TOPICS_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def _sync_topics(force=False):
+    """
+    Add the topics registered by the other gunicorn workers. A worker registering a topic creates it in Kafka
+    and then saves the topics file, so when the file changes the other workers add the topics found in Kafka
+    and the partitions found in the file.
+    """
+    global topics_response, topics_file_mtime
+    mtime = _file_mtime()
+    if not force and mtime == topics_file_mtime:
+        return
+    try:
+        names = admin.list_topics(timeout=KAFKA_TIMEOUT).topics.keys()
+    except Exception as e:
+        if force:
+            raise
+        ERRORS.labels("kafka").inc()
+        # The topics of this worker are still valid, the others are added at the next request
+        app.logger.error(repr(e))
+        return
+    with registry_lock:
+        topics_file_mtime = mtime
+        added = [topic for topic in names if not topic.startswith("_") and topic not in topics]
+        for topic in added:
+            topics[topic] = None
+        for topic, n in _load_partitions_safe().items():
+            if topic in topics and isinstance(n, int) and n > partitions.get(topic, 0):
+                partitions[topic] = n
+        SYNCS.inc()
+        TOPICS.set(len(topics))
+        if added:
+            topics_response = None
 
+def _save_topics():
+    """Save the topics of this worker and of the other workers to the topics file."""
+    global topics_file_mtime
+    with SAVE_SECONDS.time():
+        with registry_lock:
+            _sync_topics(force=True)
+            _save_topics_atomically(list(topics), dict(partitions))
+            topics_file_mtime = _file_mtime()
+
+# Saves of the topics file waiting for the next SAVE_INTERVAL
+save_pending = threading.Event()
+save_thread = None
+
+def _topics_changed():
+    global topics_response, save_thread
+    topics_response = None
+    if SAVE_INTERVAL <= 0:
+        _save_topics()
+        return
+    save_pending.set()
+    if save_thread is None:
+        save_thread = threading.Thread(target=_save_loop, daemon=True)
+        save_thread.start()
+
+def _save_loop():
+    """Save the topics file at most once every SAVE_INTERVAL, with all the registrations received meanwhile."""
+    while True:
+        save_pending.wait()
+        time.sleep(SAVE_INTERVAL)
+        save_pending.clear()
+        try:
+            _save_topics()
+        except Exception as e:
+            ERRORS.labels("save").inc()
+            app.logger.error(repr(e))
+            save_pending.set()
+
+@atexit.register
+def _save_pending_topics():
+    if save_pending.is_set():
+        _save_topics()
+
+# Returns the number of partitions of a topic in Kafka
+def _current_partitions(topic):
+    return len(admin.list_topics(topic).topics[topic].partitions)
+
+# Waits for the answer of Kafka to each topic of a request, returns the errors of the topics that failed
+def _wait_kafka(futures):
+    errors = {}
+    deadline = time.monotonic() + KAFKA_TIMEOUT
+    for topic, future in futures.items():
+        try:
+            future.result(timeout=max(deadline - time.monotonic(), 0))
+        except KafkaException as e:
+            # A topic created by another worker (or before the topics file was lost) is registered anyway
+            if e.args[0].code() != KafkaError.TOPIC_ALREADY_EXISTS:
+                errors[topic] = e
+        except Exception as e:
+            errors[topic] = e
+    return errors
+
+'''
+The payload must be a JSON with the list of topics to register, each topic is a string or an object
+with the number of partitions to use for it. The optional "partitions" field applies to the string topics:
+{
+    "topics": [string | {"topic": string, "partitions": int}],
+    "partitions": int
+}
+A registered topic is extended when more partitions than the current ones are requested.
+Only the topics and partitions accepted by Kafka are registered: the response has status code 400 if Kafka refused some of them,
+500 if it did not answer, and the failed ones can be registered again.
+Topic names starting with an underscore are reserved (they are not stored by the data pump).
+'''
 @app.route("/register", methods=["POST"])
 def register():
     msg = request.get_json()
     if not msg:
         return make_response("Empty Registration", 400)
-    new_topics = []
-    # Received new topics
-    rec_topics = msg["topics"]
-    # Add new topics to the list and select new topics
-    for topic in rec_topics:
-        if topic not in topics:
-            topics.append(topic)
-            new_topics.append(NewTopic(topic))
-    # Add new topics to Kafka
-    try:
-        if new_topics:
-            admin.create_topics(new_topics)
-    except Exception as e:
-        app.logger.error(repr(e))
-        return make_response(repr(e), 400)
+    with registry_lock:
+        # Received new topics
+        rec_topics = msg["topics"]
+        default_partitions = msg.get("partitions", None)
+        _sync_topics()
+        # Validate the whole request before changing the registry, a rejected request registers nothing
+        # Topics already registered (e.g. generators connecting again) do not need Kafka or the file
+        added = {}
+        extended = {}
+        try:
+            for topic in rec_topics:
+                n = default_partitions
+                if isinstance(topic, dict):
+                    n = topic.get("partitions", default_partitions)
+                    topic = topic["topic"]
+                if topic.startswith("_"):
+                    return make_response(f"Invalid topic {topic}: names starting with '_' are reserved", 400)
+                if n is not None:
+                    n = int(n)
+                    if n < 1:
+                        return make_response(f"Invalid number of partitions for {topic}: {n}", 400)
+                if topic not in topics:
+                    if topic not in added or n is not None:
+                        added[topic] = n
+                elif n is not None and n > max(partitions.get(topic, 0), extended.get(topic, 0)) and n > _current_partitions(topic):
+                    extended[topic] = n
+        except Exception as e:
+            ERRORS.labels("register").inc()
+            app.logger.error(repr(e))
+            return make_response(repr(e), 400)
+        # Add new topics and partitions to Kafka
+        try:
+            errors = {}
+            if added:
+                errors.update(_wait_kafka(admin.create_topics([_new_topic(topic, n) for topic, n in added.items()])))
+            if extended:
+                errors.update(_wait_kafka(admin.create_partitions([NewPartitions(topic, n) for topic, n in extended.items()])))
+        except Exception as e:
+            ERRORS.labels("kafka").inc()
+            app.logger.error(repr(e))
+            return make_response(repr(e), 400)
+        # Add new topics and partitions to the registry, only the ones Kafka accepted
+        # (the failed ones can be registered again)
+        added = {topic: n for topic, n in added.items() if topic not in errors}
+        extended = {topic: n for topic, n in extended.items() if topic not in errors}
+        NEW_TOPICS.inc(len(added))
+        NEW_PARTITIONS.inc(len(extended))
+        for topic, n in added.items():
+            topics[topic] = None
+            if n is not None:
+                partitions[topic] = n
+        partitions.update(extended)
+        TOPICS.set(len(topics))
 
-    # Add new topics to the file (atomic)
-    try:
-        _save_topics_atomically(topics)
-    except Exception as e:
-        app.logger.error(repr(e))
-        return make_response(repr(e), 500)
-    return make_response("", 200)
+        # Add new topics to the file (atomic)
+        if added or extended:
+            try:
+                _topics_changed()
+            except Exception as e:
+                ERRORS.labels("save").inc()
+                app.logger.error(repr(e))
+                return make_response(repr(e), 500)
+
+        if errors:
+            ERRORS.labels("kafka").inc()
+            app.logger.error(f"Kafka failed to register {errors}")
+            # A topic refused by Kafka (e.g. an invalid name) is a bad request, a timeout or a broker error is not
+            refused = all(isinstance(e, KafkaException) and not e.args[0].retriable() for e in errors.values())
+            body = "; ".join(f"{topic}: {e}" for topic, e in errors.items())
+            return make_response(f"Kafka failed to register {body}", 400 if refused else 500)
+        return make_response("", 200)
 
+'''
+The response has the ETag of the list of topics: a request with the header If-None-Match
+set to the ETag of the last response receives 304 if no topic was registered since then.
+The ETag depends only on the set of topics, so it is the same for all the workers.
+'''
 @app.route("/topics", methods=["GET"])
 def get_topics():
-    return make_response(json.dumps({"topics": topics}), 200)
+    global topics_response
+    _sync_topics()
+    with registry_lock:
+        if topics_response is None:
+            body = json.dumps({"topics": list(topics)})
+            etag = hashlib.sha1(json.dumps(sorted(topics)).encode("utf-8")).hexdigest()
+            topics_response = (body, etag)
+        body, etag = topics_response
+    response = make_response(body, 200)
+    response.set_etag(etag)
+    return response.make_conditional(request)
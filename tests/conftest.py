@@ -0,0 +1,14 @@
+import os, sys, tempfile
+
+# The services read their configuration from the environment when they are imported
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for service in ("common", "db_manager", "query_aggregator"):
+    sys.path.insert(0, os.path.join(ROOT, "src", service))
+
+os.environ.setdefault("DB_PORT", "8086")
+os.environ.setdefault("DOCKER_INFLUXDB_INIT_BUCKET", "test")
+os.environ.setdefault("DOCKER_INFLUXDB_INIT_ORG", "test")
+os.environ.setdefault("DOCKER_INFLUXDB_INIT_ADMIN_TOKEN", "test")
+os.environ.setdefault("DB_MANAGER_PORT", "50000")
+os.environ["QUERY_CACHE_JOURNAL"] = os.path.join(tempfile.mkdtemp(), "dbmanager_writes")
+os.environ["ROLLUPS"] = "false"
@@ -0,0 +1,80 @@
+import base64, json
+from types import SimpleNamespace
+import pytest
+import db_manager
+
+@pytest.mark.parametrize("ns, topic, generator_id", [
+    (0, "t", "g"),
+    (1704067200123456789, "building/floor 1", "sensor-42"),
+    (1704067200000000000, "tópico ☃", ""),
+    (1, "a" * 5, "b" * 7),
+])
+def test_cursor_round_trip(ns, topic, generator_id):
+    cursor = db_manager.encodeCursor(ns, topic, generator_id)
+    # The cursor is safe in a URL and in a JSON string
+    assert "=" not in cursor and "+" not in cursor and "/" not in cursor
+    assert db_manager.decodeCursor(cursor) == (ns, topic, generator_id)
+
+def encode(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode('utf8')).decode('ascii').rstrip("=")
+
+@pytest.mark.parametrize("cursor", [
+    "",
+    "not a cursor!",
+    "bm90IGpzb24",
+    encode([1, "t"]),
+    encode([1, "t", "g", "x"]),
+    encode(["1", "t", "g"]),
+    encode([1.5, "t", "g"]),
+    encode([1, "t", None]),
+    encode({"ns": 1, "topic": "t", "generator_id": "g"}),
+])
+def test_invalid_cursor(cursor):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        db_manager.decodeCursor(cursor)
+
+def test_parse_page():
+    assert db_manager.parsePage({}) == {"limit": None, "desc": False, "after": None}
+    cursor = db_manager.encodeCursor(5, "t", "g")
+    assert db_manager.parsePage({"limit": 10, "order": "desc", "cursor": cursor}) == {"limit": 10, "desc": True, "after": (5, "t", "g")}
+
+@pytest.mark.parametrize("msg", [
+    {"limit": 0},
+    {"limit": -1},
+    {"limit": 1.5},
+    {"limit": "10"},
+    {"limit": True},
+    {"order": "up"},
+    {"cursor": "not a cursor!"},
+])
+def test_invalid_page(msg):
+    with pytest.raises(ValueError):
+        db_manager.parsePage(msg)
+
+def record(ns):
+    return SimpleNamespace(values={"_ns": ns, "topic": "t", "generator_id": f"g{ns}"})
+
+def test_read_page_returns_cursor_of_last_record(monkeypatch):
+    monkeypatch.setattr(db_manager, "shardedRecords", lambda queries: (record(ns) for ns in range(5)))
+    records, cursor = db_manager.readPage(["query"], 3)
+    assert [r.values["_ns"] for r in records] == [0, 1, 2]
+    assert db_manager.decodeCursor(cursor) == (2, "t", "g2")
+
+@pytest.mark.parametrize("limit", [5, 6])
+def test_read_last_page_without_cursor(monkeypatch, limit):
+    monkeypatch.setattr(db_manager, "shardedRecords", lambda queries: (record(ns) for ns in range(5)))
+    records, cursor = db_manager.readPage(["query"], limit)
+    assert len(records) == 5 and cursor is None
+
+def test_next_page_window(monkeypatch):
+    monkeypatch.setattr(db_manager, "QUERY_SHARD_DURATION", 10**15)
+    start, stop = "2024-01-01T00:00:00Z", "2024-01-02T00:00:00Z"
+    ns = db_manager.parseTimestamp("2024-01-01T12:00:00.5Z")[0]
+    # Ascending pages start at the last record, descending pages stop right after it
+    asc = db_manager.planQuery(start, stop, "t", None, page={"limit": 10, "desc": False, "after": (ns, "t", "g")})
+    assert len(asc) == 1 and "range(start: 2024-01-01T12:00:00.500000000Z, stop: 2024-01-02T00:00:00" in asc[0]
+    desc = db_manager.planQuery(start, stop, "t", "g", page={"limit": 10, "desc": True, "after": (ns, "t", "g")})
+    assert len(desc) == 1 and "stop: 2024-01-01T12:00:00.500000001Z" in desc[0]
+    # The records of the same time are kept only after the key of the cursor
+    assert 'r.topic > "t"' in asc[0] and 'r.generator_id > "g"' in asc[0]
+    assert 'r.topic < "t"' in desc[0] and 'r.generator_id < "g"' in desc[0]
@@ -0,0 +1,64 @@
+from datetime import datetime, timezone
+from types import SimpleNamespace
+import pytest
+import db_manager
+import migrate_layout
+
+SECOND = "2024-01-01T12:00:00"
+
+def readings(n, timestamp=SECOND + "Z"):
+    return [{"timestamp": timestamp, "topic": "t", "generator_id": "g", "data": str({"power": {"value": i, "unit": "W"}})} for i in range(n)]
+
+#Writes the points to a bucket keyed as InfluxDB does, by series and time: a point overwrites another with the same key
+def write(store, points):
+    for p in points:
+        store[(tuple(sorted(p._tags.items())), p._time)] = dict(p._fields)
+
+#Reads a bucket as the pivoted records of a Flux query
+def records(store):
+    for (tags, ns), fields in sorted(store.items(), key=lambda item: item[0][1]):
+        values = dict(tags, _ns=ns, **fields)
+        yield SimpleNamespace(values=values, get_time=lambda ns=ns: db_manager.nsTime(ns))
+
+# The readings with the same timestamp are told apart by the nanoseconds below its last digit
+@pytest.mark.parametrize("timestamp, n", [(SECOND + "Z", 1000), (SECOND + ".5Z", 1000), (SECOND + ".123Z", 20)])
+def test_same_time_readings_are_kept(timestamp, n):
+    store = {}
+    write(store, [db_manager.buildPoint(msg) for msg in readings(n, timestamp)])
+    assert len(store) == n
+    # The tiebreak is below the last digit of the timestamp, the records have the received timestamp
+    assert {db_manager.recordToDict(record)["timestamp"] for record in records(store)} == {db_manager.formatTime(db_manager.nsTime(db_manager.parseTimestamp(timestamp)[0]))}
+
+def test_same_reading_is_stored_once():
+    store = {}
+    write(store, [db_manager.buildPoint(msg) for msg in readings(10) + readings(10)])
+    assert len(store) == 10
+
+def test_received_time_without_tiebreak():
+    ns = db_manager.parseTimestamp(SECOND + ".25Z")[0] + 1234567
+    assert db_manager.formatTime(db_manager.receivedTime(db_manager.nsTime(ns), "2")) == SECOND + ".250Z"
+    assert db_manager.formatTime(db_manager.receivedTime(db_manager.nsTime(ns), None)) == SECOND + ".251234Z"
+
+def test_migration_keeps_same_time_readings(monkeypatch):
+    # The previous layout told apart the readings with the same timestamp by a unique id tag
+    old = {}
+    second = db_manager.parseTimestamp(SECOND + "Z")[0]
+    for i, msg in enumerate(readings(1000)):
+        old[((("generator_id", "g"), ("id", str(i)), ("topic", "t")), second)] = {"data": msg["data"]}
+    old[((("generator_id", "g"), ("id", "x"), ("topic", "t")), second + 500 * 10**6)] = {"data": "late"}
+
+    def copy(source, target):
+        query_api = SimpleNamespace(query_stream=lambda org, query: records(source))
+        monkeypatch.setattr(migrate_layout, "client", SimpleNamespace(query_api=lambda: query_api))
+        write_api = SimpleNamespace(write=lambda bucket, org, record: write(target, record))
+        return migrate_layout.copyChunk("source", "target", datetime(2024, 1, 1, tzinfo=timezone.utc), datetime(2024, 1, 2, tzinfo=timezone.utc), write_api)
+
+    new = {}
+    assert copy(old, new) == 1001
+    assert len(new) == 1001
+    timestamps = sorted(db_manager.recordToDict(record)["timestamp"] for record in records(new))
+    assert timestamps == [SECOND + ".500Z"] + [SECOND + "Z"] * 1000
+    # Migrating again the migrated points overwrites them
+    again = dict(new)
+    copy(new, again)
+    assert again == new
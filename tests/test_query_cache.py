@@ -0,0 +1,101 @@
+import collections, time
+import pytest
+import db_manager
+
+MINUTE = 60 * 10**9
+
+def page(limit=None, desc=False, after=None):
+    return {"limit": limit, "desc": desc, "after": after}
+
+@pytest.fixture
+def cache():
+    return db_manager.QueryCache(1024, 0, "")
+
+def test_cache_key_of_past_window():
+    key = db_manager.cacheKey("2024-01-01T00:00:00Z", "2024-01-01T01:00:00Z", "t", "g", ["b", "a", "b"], page(), "json", "gzip")
+    same = db_manager.cacheKey("2024-01-01T00:00:00Z", "2024-01-01T01:00:00Z", "t", "g", ["a", "b"], page(), "json", "gzip")
+    assert key is not None and key == same
+    assert key != db_manager.cacheKey("2024-01-01T00:00:00Z", "2024-01-01T01:00:00Z", "t", "g", ["a", "b"], page(desc=True), "json", "gzip")
+    assert key != db_manager.cacheKey("2024-01-01T00:00:00Z", "2024-01-01T01:00:00Z", "t", "g", ["a", "b"], page(), "csv", "gzip")
+
+@pytest.mark.parametrize("start, stop, paging", [
+    (None, "2024-01-01T01:00:00Z", page()),
+    ("2024-01-01T00:00:00Z", None, page()),
+    ("2024-01-01T00:00:00Z", "2024-01-01T01:00:00Z", page(limit=10)),
+    ("2024-01-01T00:00:00Z", "2024-01-01T01:00:00Z", page(after=(0, "t", "g"))),
+    ("2024-01-01T00:00:00Z", "2999-01-01T00:00:00Z", page()),
+])
+def test_cache_key_not_cacheable(start, stop, paging):
+    assert db_manager.cacheKey(start, stop, "t", "g", None, paging, "json", "gzip") is None
+
+def test_put_and_get(cache):
+    cache.put("k", 0, MINUTE, b"data", cache.begin())
+    assert cache.get("k") == b"data"
+    assert cache.get("other") is None
+    assert cache.stats["hits"] == 1 and cache.stats["misses"] == 1
+
+def test_write_in_window_invalidates(cache):
+    cache.put("k", MINUTE, 2 * MINUTE, b"data", cache.begin())
+    cache.written(3 * MINUTE, 4 * MINUTE)
+    assert cache.get("k") == b"data"
+    cache.written(2 * MINUTE - 1, 3 * MINUTE)
+    assert cache.get("k") is None
+    assert cache.stats["invalidations"] == 1 and cache.size == 0
+
+def test_write_at_stop_keeps_entry(cache):
+    cache.put("k", MINUTE, 2 * MINUTE, b"data", cache.begin())
+    cache.written(2 * MINUTE, 3 * MINUTE)
+    cache.written(0, MINUTE - 1)
+    assert cache.get("k") == b"data"
+
+def test_write_during_query_skips_put(cache):
+    version = cache.begin()
+    cache.written(MINUTE, MINUTE)
+    cache.put("k", 0, 2 * MINUTE, b"data", version)
+    assert cache.get("k") is None
+    cache.put("k", 0, 2 * MINUTE, b"data", cache.begin())
+    assert cache.get("k") == b"data"
+
+def test_unrelated_write_during_query_keeps_put(cache):
+    version = cache.begin()
+    cache.written(5 * MINUTE, 6 * MINUTE)
+    cache.put("k", 0, 2 * MINUTE, b"data", version)
+    assert cache.get("k") == b"data"
+
+def test_forgotten_writes_skip_put(cache):
+    cache.recent = collections.deque(maxlen=2)
+    version = cache.begin()
+    for i in range(3):
+        cache.written(10 * MINUTE * (i + 1), 10 * MINUTE * (i + 1))
+    cache.put("k", 0, MINUTE, b"data", version)
+    assert cache.get("k") is None
+
+def test_eviction_of_least_recently_used(cache):
+    cache.put("a", 0, MINUTE, b"x" * 400, cache.begin())
+    cache.put("b", 0, MINUTE, b"x" * 400, cache.begin())
+    cache.get("a")
+    cache.put("c", 0, MINUTE, b"x" * 400, cache.begin())
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.stats["evictions"] == 1 and cache.size == 800
+
+def test_too_big_response_not_cached(cache):
+    cache.put("k", 0, MINUTE, b"x" * 2048, cache.begin())
+    assert cache.get("k") is None and cache.size == 0
+
+def test_expiration(monkeypatch):
+    cache = db_manager.QueryCache(1024, 10, "")
+    now = time.monotonic()
+    monkeypatch.setattr(db_manager.time, "monotonic", lambda: now)
+    cache.put("k", 0, MINUTE, b"data", cache.begin())
+    monkeypatch.setattr(db_manager.time, "monotonic", lambda: now + 11)
+    assert cache.get("k") is None and cache.size == 0
+
+def test_journal_shares_writes(tmp_path):
+    journal = str(tmp_path / "writes")
+    reader = db_manager.QueryCache(1024, 0, journal)
+    writer = db_manager.QueryCache(1024, 0, journal)
+    reader.put("k", 0, 2 * MINUTE, b"data", reader.begin())
+    assert reader.get("k") == b"data"
+    writer.written(MINUTE, MINUTE)
+    assert reader.get("k") is None
@@ -0,0 +1,115 @@
+from datetime import datetime, timezone
+from types import SimpleNamespace
+import pytest
+import db_manager
+import query_aggregator
+
+MINUTE = db_manager.ROLLUP_RESOLUTION
+BLOCK = db_manager.ROLLUP_BLOCK
+DAY = 24 * 60 * MINUTE
+
+@pytest.fixture
+def now(monkeypatch):
+    # Now is 30 minutes after the start of the block of day 100, the minutes closed end ROLLUP_DELAY before
+    ns = 100 * DAY + 30 * MINUTE
+    monkeypatch.setattr(db_manager.time, "time_ns", lambda: ns)
+    return ns
+
+def test_rollup_end_of_closed_window(now):
+    assert db_manager.rollupEnd(0, 10 * DAY) == 10 * DAY
+    assert db_manager.rollupEnd(0, 10 * DAY + 5 * MINUTE + 1) == 10 * DAY + 5 * MINUTE
+
+def test_rollup_end_stops_at_open_block(now):
+    # The minutes of the current block are closed but its partial aggregates are computed with the block
+    assert db_manager.rollupEnd(0, now) == 100 * DAY
+    assert db_manager.rollupEnd(100 * DAY, now) == 100 * DAY
+
+def test_rollup_end_without_aligned_start(now):
+    assert db_manager.rollupEnd(MINUTE + 1, 10 * DAY) == MINUTE + 1
+
+def test_spans_merge_consecutive_blocks():
+    starts = [0, BLOCK, 2 * BLOCK, 5 * BLOCK, 7 * BLOCK, 8 * BLOCK]
+    assert list(db_manager.spans(starts, BLOCK)) == [(0, 3 * BLOCK), (5 * BLOCK, 6 * BLOCK), (7 * BLOCK, 9 * BLOCK)]
+    assert list(db_manager.spans([], BLOCK)) == []
+
+def test_spans_split_at_max_span():
+    blocks = db_manager.ROLLUP_MAX_SPAN // BLOCK
+    result = list(db_manager.spans([i * BLOCK for i in range(blocks + 1)], BLOCK))
+    assert result == [(0, db_manager.ROLLUP_MAX_SPAN), (db_manager.ROLLUP_MAX_SPAN, db_manager.ROLLUP_MAX_SPAN + BLOCK)]
+
+def test_ensure_rollups_computes_missing_blocks(monkeypatch):
+    covered = [BLOCK, 2 * BLOCK, 4 * BLOCK]
+    records = [SimpleNamespace(get_time=lambda ns=ns: datetime.fromtimestamp(ns // 10**9, timezone.utc)) for ns in covered]
+    query_api = SimpleNamespace(query=lambda org, query: [SimpleNamespace(records=records)])
+    monkeypatch.setattr(db_manager, "client", SimpleNamespace(query_api=lambda: query_api))
+    computed = []
+    monkeypatch.setattr(db_manager, "computeRollups", lambda topic, start_ns, stop_ns: computed.append((topic, start_ns, stop_ns)) or 0)
+    written = []
+    monkeypatch.setattr(db_manager, "sync_write_api", SimpleNamespace(write=lambda bucket, org, record: written.extend(record)))
+
+    with db_manager.app.app_context():
+        db_manager.ensureRollups("t", 5 * MINUTE, 6 * BLOCK)
+    assert computed == [("t", 0, BLOCK), ("t", 3 * BLOCK, 4 * BLOCK), ("t", 5 * BLOCK, 6 * BLOCK)]
+    assert len(written) == 3
+
+class Response:
+    def __init__(self, body, status_code=200):
+        self.body = body
+        self.status_code = status_code
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        pass
+
+def aggregate(monkeypatch, rollups, raw, msg, specs, frequency=None):
+    requests = []
+    def postToDB(URL, json):
+        requests.append((URL.rsplit("/", 1)[1], json))
+        if URL.endswith("/rollup"):
+            return Response(rollups[json["field"]])
+        return Response(raw) if raw else Response(None, 404)
+    monkeypatch.setattr(query_aggregator, "postToDB", postToDB)
+    with query_aggregator.app.app_context():
+        return query_aggregator.aggregateRollups(msg, specs, frequency), requests
+
+MSG = {"start": "2024-01-01T00:00:00Z", "stop": "2024-01-01T02:00:00Z", "topic": "t", "generator_id": "g"}
+
+def test_rollups_merged_with_raw_data(monkeypatch):
+    rollups = {"power": {"until": "2024-01-01T01:00:00Z", "numeric": True, "buckets": [
+        {"start": "2024-01-01T00:00:00Z", "unit": "kW", "count": 2, "sum": 3.0, "min": 1.0, "max": 2.0},
+        {"start": "2024-01-01T00:00:00Z", "unit": "W", "count": 1, "sum": 500.0, "min": 500.0, "max": 500.0}]}}
+    raw = [
+        {"timestamp": "2024-01-01T01:30:00Z", "data": "{'power': {'unit': 'W', 'value': 4000}}"},
+        {"timestamp": "2024-01-01T00:59:00Z", "data": "{'power': {'unit': 'kW', 'value': 100}}"}]
+    specs = [{"name": name, "field": "power", "fun": name, "unit": "kW"} for name in ("sum", "count", "min", "max", "avg")]
+    result, requests = aggregate(monkeypatch, rollups, raw, MSG, specs)
+    values = query_aggregator.get_data_dict(result["data"])
+    assert {name: value["value"] for name, value in values.items()} == {"sum": 7.5, "count": 4, "min": 0.5, "max": 4.0, "avg": 1.875}
+    # The raw data is read only after the end of the partial aggregates
+    assert requests[-1] == ("query", dict(MSG, start="2024-01-01T01:00:00Z"))
+
+def test_following_fields_stop_at_first_until(monkeypatch):
+    rollups = {
+        "power": {"until": "2024-01-01T01:00:00Z", "numeric": True, "buckets": []},
+        "energy": {"until": "2024-01-01T01:00:00Z", "numeric": True, "buckets": []}}
+    specs = [{"name": field, "field": field, "fun": "sum", "unit": "kW"} for field in ("power", "energy")]
+    result, requests = aggregate(monkeypatch, rollups, None, MSG, specs)
+    assert [query["stop"] for path, query in requests if path == "rollup"] == [MSG["stop"], "2024-01-01T01:00:00Z"]
+    assert not result
+
+def test_rollups_with_frequency(monkeypatch):
+    rollups = {"power": {"until": "2024-01-01T02:00:00Z", "numeric": True, "buckets": [
+        {"start": "2024-01-01T00:00:00Z", "unit": "kW", "count": 1, "sum": 1.0, "min": 1.0, "max": 1.0},
+        {"start": "2024-01-01T01:00:00Z", "unit": "kW", "count": 1, "sum": 2.0, "min": 2.0, "max": 2.0}]}}
+    specs = [{"name": "power", "field": "power", "fun": "sum", "unit": "kW"}]
+    result, requests = aggregate(monkeypatch, rollups, None, MSG, specs, frequency=60)
+    assert [record["timestamp"] for record in result] == ["2024-01-01T01:00:00Z", "2024-01-01T02:00:00Z"]
+    assert [path for path, query in requests] == ["rollup"]
+
+def test_not_numeric_falls_back_to_raw_data(monkeypatch):
+    rollups = {"power": {"until": "2024-01-01T02:00:00Z", "numeric": False, "buckets": []}}
+    specs = [{"name": "power", "field": "power", "fun": "sum", "unit": "kW"}]
+    result, _ = aggregate(monkeypatch, rollups, None, MSG, specs)
+    assert result is None
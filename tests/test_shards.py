@@ -0,0 +1,47 @@
+import threading
+from types import SimpleNamespace
+import pytest
+import db_manager
+
+@pytest.fixture
+def shards(monkeypatch):
+    # A query is the number of records of its shard
+    closed = []
+    def query_stream(org, query):
+        if int(query) < 0:
+            raise RuntimeError("Shard failed")
+        def records():
+            try:
+                for i in range(int(query)):
+                    yield SimpleNamespace(values={"shard": query, "i": i})
+            finally:
+                closed.append(query)
+        return records()
+    monkeypatch.setattr(db_manager, "client", SimpleNamespace(query_api=lambda: SimpleNamespace(query_stream=query_stream)))
+    monkeypatch.setattr(db_manager, "QUERY_SHARD_BUFFER", 3)
+    return closed
+
+def test_records_in_order_of_shards(shards):
+    queries = ["5", "0", "7", "2", "4", "6"]
+    records = [(r.values["shard"], r.values["i"]) for r in db_manager.shardedRecords(queries)]
+    assert records == [(q, i) for q in queries for i in range(int(q))]
+
+def test_failed_shard_raises(shards):
+    with pytest.raises(RuntimeError):
+        list(db_manager.shardedRecords(["2", "-1", "3"]))
+
+def test_slow_client_does_not_block_other_queries(shards):
+    # The readers of a query whose client stopped reading wait with their buffers full
+    slow = [db_manager.shardedRecords(["100"] * 8) for _ in range(4)]
+    for records in slow:
+        next(records)
+    done = threading.Event()
+    def fast():
+        assert len(list(db_manager.shardedRecords(["10"] * 8))) == 80
+        done.set()
+    threading.Thread(target=fast, daemon=True).start()
+    try:
+        assert done.wait(5)
+    finally:
+        for records in slow:
+            records.close()
@@ -0,0 +1,163 @@
+import json, math, random, statistics
+from datetime import datetime, timedelta, timezone
+import pytest
+import query_aggregator
+from query_aggregator import Partial, DDSketch, partial_functions
+
+def test_partial_functions():
+    values = [3.0, -1.5, 7.25, 0.0, 2.0]
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    partial = Partial()
+    # The values are not received in the order of their timestamps
+    for i in (2, 0, 4, 1, 3):
+        partial.add(values[i], start + timedelta(seconds=i))
+    result = {name: partial_functions[name](partial) for name in ("sum", "avg", "min", "max", "count", "variance", "stddev", "first", "last")}
+    assert result == pytest.approx({
+        "sum": sum(values), "avg": statistics.mean(values), "min": -1.5, "max": 7.25, "count": 5,
+        "variance": statistics.pvariance(values), "stddev": statistics.pstdev(values), "first": 3.0, "last": 2.0})
+
+def test_partial_last_of_equal_timestamps():
+    ts = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    partial = Partial()
+    partial.add(1.0, ts)
+    partial.add(2.0, ts)
+    assert partial_functions["first"](partial) == 1.0 and partial_functions["last"](partial) == 2.0
+
+@pytest.mark.parametrize("values", [
+    [float(v) for v in range(1, 1001)],
+    [float(v) for v in range(-500, 501)],
+    [random.Random(0).lognormvariate(0, 2) for _ in range(10000)],
+])
+def test_sketch_quantiles_within_accuracy(values):
+    sketch = DDSketch()
+    for value in values:
+        sketch.add(value)
+    ordered = sorted(values)
+    for q in query_aggregator.percentiles.values():
+        exact = ordered[math.floor(q * (len(ordered) - 1))]
+        assert abs(sketch.quantile(q) - exact) <= query_aggregator.SKETCH_ACCURACY * abs(exact)
+
+def test_merged_sketches_have_the_quantiles_of_all_the_values():
+    rng = random.Random(2)
+    values = [rng.lognormvariate(0, 2) * rng.choice((-1, 1)) for _ in range(10000)] + [0.0] * 10
+    whole, left, right = DDSketch(), DDSketch(), DDSketch()
+    for i, value in enumerate(values):
+        whole.add(value)
+        (left if i % 3 else right).add(value)
+    left.merge(right)
+    assert left.count == whole.count
+    for q in (0, 0.01, 0.25, 0.5, 0.75, 0.95, 0.99, 1):
+        assert left.quantile(q) == whole.quantile(q)
+
+def test_sketches_with_different_accuracy_not_merged():
+    with pytest.raises(ValueError):
+        DDSketch(0.01).merge(DDSketch(0.02))
+
+def test_merged_partials():
+    rng = random.Random(3)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    values = [(start + timedelta(seconds=i), rng.uniform(-100, 100)) for i in range(1000)]
+    whole, left, right = Partial(True), Partial(True), Partial(True)
+    for ts, value in values:
+        whole.add(value, ts)
+        (left if ts.second < 30 else right).add(value, ts)
+    left.merge(right)
+    left.merge(Partial(True))
+    names = ("sum", "avg", "min", "max", "count", "variance", "stddev", "first", "last", "p50", "p95", "p99")
+    assert {name: partial_functions[name](left) for name in names} == pytest.approx({name: partial_functions[name](whole) for name in names})
+
+def test_sketch_collapses_smallest_bins():
+    sketch = DDSketch(max_bins=64)
+    values = [1.01 ** i for i in range(1000)]
+    for value in values:
+        sketch.add(value)
+    assert len(sketch.positive) <= 64 and sum(sketch.positive.values()) == len(values)
+    # The high quantiles keep their accuracy
+    exact = values[math.floor(0.99 * (len(values) - 1))]
+    assert abs(sketch.quantile(0.99) - exact) <= query_aggregator.SKETCH_ACCURACY * exact
+
+class StreamedResponse:
+    status_code = 200
+
+    def __init__(self, items, query=None):
+        # The DB service returns the records in [start, stop)
+        start = query_aggregator.parse_timestamp(query["start"]) if query and query.get("start") else None
+        stop = query_aggregator.parse_timestamp(query["stop"]) if query and query.get("stop") else None
+        items = [item for item in items if (start is None or query_aggregator.parse_timestamp(item["timestamp"]) >= start)
+                 and (stop is None or query_aggregator.parse_timestamp(item["timestamp"]) < stop)]
+        self.lines = [json.dumps(item).encode('utf8') for item in items]
+
+    def iter_lines(self, chunk_size):
+        return iter(self.lines)
+
+    def raise_for_status(self):
+        pass
+
+def records(n):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    rng = random.Random(1)
+    return [{
+        "timestamp": query_aggregator.format_timestamp(start + timedelta(seconds=37 * i)),
+        "generator_id": "g",
+        "topic": "t",
+        "data": str({"power": {"unit": "W", "value": rng.uniform(0, 5000)}, "temperature": {"unit": "Celsius", "value": rng.uniform(-10, 40)}})
+    } for i in range(n)]
+
+def values_of(result):
+    result = result if isinstance(result, list) else [result]
+    return [(record["timestamp"], {name: value["value"] for name, value in query_aggregator.get_data_dict(record["data"]).items()}) for record in result]
+
+@pytest.mark.parametrize("msg, frequency", [
+    ({"start": "2024-01-01T00:00:00Z", "stop": "2024-01-01T06:00:00Z", "topic": "t"}, None),
+    ({"start": "2024-01-01T00:00:00Z", "stop": "2024-01-01T06:00:00Z", "topic": "t"}, 45),
+    ({"topic": "t"}, None),
+    ({"topic": "t"}, 45),
+])
+def test_stream_matches_python_engine(monkeypatch, msg, frequency):
+    items = records(500)
+    specs = [{"name": f"{field}_{fun}", "field": field, "fun": fun, "unit": unit}
+             for field, unit in (("power", "kW"), ("temperature", "Kelvin"))
+             for fun in ("sum", "avg", "min", "max", "count", "variance", "stddev", "first", "last")]
+    monkeypatch.setattr(query_aggregator, "postToDB", lambda URL, json, stream: StreamedResponse(items, json))
+    with query_aggregator.app.app_context():
+        if frequency is not None and not msg.get("start"):
+            msg = dict(msg, start=items[0]["timestamp"])
+        streamed = query_aggregator.streamAggregate(msg, specs, frequency)
+        expected = query_aggregator.create_aggregated_result(msg, specs, frequency, items)
+    streamed, expected = values_of(streamed), values_of(expected)
+    assert [ts for ts, _ in streamed] == [ts for ts, _ in expected]
+    for (_, values), (_, expected_values) in zip(streamed, expected):
+        assert values == pytest.approx(expected_values, rel=1e-9)
+
+def test_stream_single_record(monkeypatch):
+    items = records(1)
+    specs = [{"name": "power", "field": "power", "fun": "sum", "unit": "kW"}]
+    monkeypatch.setattr(query_aggregator, "postToDB", lambda URL, json, stream: StreamedResponse(items, json))
+    with query_aggregator.app.app_context():
+        assert query_aggregator.streamAggregate({"topic": "t"}, specs, None) == items
+        monkeypatch.setattr(query_aggregator, "postToDB", lambda URL, json, stream: StreamedResponse([], json))
+        assert query_aggregator.streamAggregate({"topic": "t"}, specs, None) is None
+
+@pytest.mark.parametrize("frequency", [None, 45])
+def test_slices_merged(monkeypatch, frequency):
+    items = records(500)
+    msg = {"start": "2024-01-01T00:00:00Z", "stop": "2024-01-01T06:00:00Z", "topic": "t"}
+    specs = [{"name": fun, "field": "power", "fun": fun, "unit": "kW"} for fun in ("sum", "count", "variance", "first", "last", "p50", "p99")]
+    queries = []
+    def postToDB(URL, json, stream):
+        queries.append((json["start"], json["stop"]))
+        return StreamedResponse(items, json)
+    monkeypatch.setattr(query_aggregator, "postToDB", postToDB)
+    with query_aggregator.app.app_context():
+        monkeypatch.setattr(query_aggregator, "STREAM_PARTITIONS", 1)
+        whole = values_of(query_aggregator.streamAggregate(msg, specs, frequency))
+        queries.clear()
+        monkeypatch.setattr(query_aggregator, "STREAM_PARTITIONS", 7)
+        sliced = values_of(query_aggregator.streamAggregate(msg, specs, frequency))
+    # The slices cover the window without overlapping
+    queries.sort()
+    assert len(queries) == 7 and queries[0][0] == msg["start"] and queries[-1][1] == msg["stop"]
+    assert all(a[1] == b[0] for a, b in zip(queries, queries[1:]))
+    assert [ts for ts, _ in sliced] == [ts for ts, _ in whole]
+    for (_, values), (_, whole_values) in zip(sliced, whole):
+        assert values == pytest.approx(whole_values, rel=1e-9)